@@ -0,0 +1,380 @@
+"""
+Fleet-wide pump temperature anomaly detection
+
+The temperature history of every pump is loaded with one query and laid
+out as a NumPy matrix, one row per pump and one column per check, with the
+latest check in the last column. Rolling baselines, an EWMA and z-scores
+are then computed for all pumps at once, and each pump's scores are stored
+in pump_anomaly together with the reasons it is flagged:
+
+- high: the latest temperature is at or above HIGH_TEMP_LIMIT
+- spike: the latest temperature is Z_THRESHOLD standard deviations above
+  the pump's own baseline
+- drift: the EWMA of recent checks is DRIFT_THRESHOLD standard deviations
+  above the baseline, which catches a pump creeping upward one degree at a
+  time without any single check standing out
+
+The baseline of a check is the BASELINE_LENGTH checks before it, skipping
+the RECENT_LENGTH checks right before it so a drift does not drag its own
+baseline along. Only pumps checked within RECENT_DAYS are flagged.
+
+Scores are recomputed by a background thread in each worker, a moment
+after a commit that changed maintenance logs and every
+ANOMALY_REFRESH_SECONDS, which also catches the date changing and logs
+written outside the session. Each run first compares the data version
+stored with the scores, so workers do not repeat each other's work.
+Readers such as the dashboard only read pump_anomaly. The scores change
+after the commit that changed the logs, so readers key their cached
+results and ETags on scores_version as well as the data version.
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from flask import request, jsonify
+from sqlalchemy import select, event, func
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from data_version import get_data_version, conditional_json
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Checks of each pump that are scored, and how far back they are loaded
+HISTORY_LENGTH = 52
+LOOKBACK_DAYS = 730
+
+BASELINE_LENGTH = 12
+RECENT_LENGTH = 3
+MIN_BASELINE_POINTS = 4
+EWMA_ALPHA = 0.3
+
+# A baseline steadier than this would turn half a degree into an anomaly
+MIN_STD = 1.0
+
+Z_THRESHOLD = 3.0
+DRIFT_THRESHOLD = 2.0
+HIGH_TEMP_LIMIT = 80.0
+RECENT_DAYS = 14
+
+# Seconds a refresh waits after a commit, so a burst of saves is scored once
+SETTLE_SECONDS = 2.0
+
+# Session.info flag set when a flush changed maintenance logs
+PENDING_FLAG = 'anomaly_refresh_pending'
+
+def history_matrix(equipment_ids, values, length=HISTORY_LENGTH):
+    """Lay out values sorted by pump and time as a (pumps, length) matrix
+
+    Each row holds a pump's last length values, right-aligned so the latest
+    is in the last column, with NaN before a short history. Returns the
+    pump ids, the matrix and each value's row and column (column -1 when
+    the value is too old to fit).
+    """
+    pumps, starts, counts = np.unique(equipment_ids, return_index=True, return_counts=True)
+    rows = np.repeat(np.arange(len(pumps)), counts)
+    # 0 for each pump's latest value, 1 for the one before, ...
+    from_end = np.repeat(starts + counts, counts) - np.arange(len(values)) - 1
+    columns = np.where(from_end < length, length - 1 - from_end, -1)
+
+    matrix = np.full((len(pumps), length), np.nan)
+    fits = columns >= 0
+    matrix[rows[fits], columns[fits]] = values[fits]
+    return pumps, matrix, rows, columns
+
+def rolling_baseline(matrix, length=BASELINE_LENGTH, gap=RECENT_LENGTH):
+    """Mean, standard deviation and count of the baseline of every column
+
+    The baseline of column t is columns t - gap - length to t - gap - 1;
+    missing values are ignored.
+    """
+    pumps, columns = matrix.shape
+    padded = np.concatenate([np.full((pumps, length + gap), np.nan), matrix], axis=1)
+    windows = sliding_window_view(padded, length, axis=1)[:, :columns]
+
+    present = ~np.isnan(windows)
+    counts = present.sum(axis=2)
+    filled = np.where(present, windows, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = filled.sum(axis=2) / counts
+        deviations = np.where(present, windows - means[:, :, None], 0.0)
+        stds = np.sqrt((deviations ** 2).sum(axis=2) / np.maximum(counts - 1, 1))
+    return means, stds, counts
+
+def ewma(matrix, alpha=EWMA_ALPHA):
+    """Exponentially weighted moving average of each row's values, NaN skipped"""
+    average = np.full(matrix.shape[0], np.nan)
+    # One step per column, each step covers every pump
+    for column in matrix.T:
+        present = ~np.isnan(column)
+        updated = np.where(np.isnan(average), column, alpha * column + (1 - alpha) * average)
+        average = np.where(present, updated, average)
+    return average
+
+def score_histories(matrix):
+    """Scores of the latest check of every pump, as a dict of arrays"""
+    latest = matrix[:, -1]
+    means, stds, counts = rolling_baseline(matrix)
+    baseline = means[:, -1]
+    spread = np.maximum(np.nan_to_num(stds[:, -1], nan=MIN_STD), MIN_STD)
+    smoothed = ewma(matrix)
+    has_baseline = counts[:, -1] >= MIN_BASELINE_POINTS
+
+    zscore = np.where(has_baseline, (latest - baseline) / spread, np.nan)
+    drift = np.where(has_baseline, (smoothed - baseline) / spread, np.nan)
+    return {
+        'latest': latest,
+        'baseline': np.where(has_baseline, baseline, np.nan),
+        'baseline_std': np.where(has_baseline, spread, np.nan),
+        'ewma': smoothed,
+        'zscore': zscore,
+        'drift': drift,
+        'high': latest >= HIGH_TEMP_LIMIT,
+        'spike': np.nan_to_num(zscore, nan=0.0) >= Z_THRESHOLD,
+        'drifting': np.nan_to_num(drift, nan=0.0) >= DRIFT_THRESHOLD
+    }
+
+def _number(value, digits=2):
+    return None if np.isnan(value) else round(float(value), digits)
+
+class AnomalyEngine:
+    """Recomputes pump_anomaly from the maintenance log temperatures"""
+    def __init__(self, log_table, anomaly_table, refresh_seconds=300.0, settle_seconds=SETTLE_SECONDS):
+        self.log = log_table
+        self.anomaly = anomaly_table
+        self.last_stats = None
+        self.refresh_seconds = refresh_seconds
+        self.settle_seconds = settle_seconds
+        self._refresh_current = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def run_in_background(self, refresh_current):
+        """Let start() and schedule() run refresh_current in a background thread"""
+        self._refresh_current = refresh_current
+
+    def start(self):
+        """Start the background refresher if it is enabled and not running yet"""
+        if self._refresh_current is None:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='anomaly-refresher', daemon=True)
+                self._thread.start()
+
+    def schedule(self):
+        """Have the background refresher bring pump_anomaly up to date soon"""
+        self._wake.set()
+        self.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._refresh_current()
+            except Exception as e:
+                logger.error(f"Error refreshing pump anomalies: {e}")
+            if self._wake.wait(self.refresh_seconds):
+                time.sleep(self.settle_seconds)
+            self._wake.clear()
+
+    def load(self, connection, since):
+        """Every temperature checked since a date, in one query
+
+        Returns equipment ids, check dates (as day ordinals) and temperatures
+        as arrays sorted by pump and date.
+        """
+        log = self.log
+        rows = connection.execute(
+            select(log.c.equipment_id, log.c.check_date, log.c.pump_temp)
+            .where(log.c.pump_temp.isnot(None), log.c.check_date >= since)
+            .order_by(log.c.equipment_id, log.c.check_date, log.c.log_id)
+        ).all()
+        count = len(rows)
+        equipment_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=count)
+        days = np.fromiter((row[1].toordinal() for row in rows), dtype=np.int64, count=count)
+        temps = np.fromiter((row[2] for row in rows), dtype=np.float64, count=count)
+        return equipment_ids, days, temps
+
+    def compute(self, connection, today, data_version):
+        """Score every pump and return (pump_anomaly rows, reading count)"""
+        equipment_ids, days, temps = self.load(connection, today - timedelta(days=LOOKBACK_DAYS))
+        if not len(temps):
+            return [], 0
+
+        pumps, matrix, rows, columns = history_matrix(equipment_ids, temps)
+        last_days = np.zeros(len(pumps), dtype=np.int64)
+        latest = columns == HISTORY_LENGTH - 1
+        last_days[rows[latest]] = days[latest]
+
+        scores = score_histories(matrix)
+        recent = last_days >= (today - timedelta(days=RECENT_DAYS)).toordinal()
+        computed_at = datetime.utcnow()
+
+        anomaly_rows = []
+        for index, equipment_id in enumerate(pumps.tolist()):
+            reasons = [
+                reason for reason, flags in (('high', scores['high']), ('spike', scores['spike']), ('drift', scores['drifting']))
+                if flags[index]
+            ]
+            flagged = bool(reasons) and bool(recent[index])
+            anomaly_rows.append({
+                'equipment_id': equipment_id,
+                'last_check_date': datetime.fromordinal(int(last_days[index])).date(),
+                'last_temp': _number(scores['latest'][index]),
+                'baseline_temp': _number(scores['baseline'][index]),
+                'baseline_std': _number(scores['baseline_std'][index]),
+                'ewma_temp': _number(scores['ewma'][index]),
+                'zscore': _number(scores['zscore'][index]),
+                'drift_score': _number(scores['drift'][index]),
+                'reasons': ','.join(reasons) if flagged else None,
+                'is_flagged': flagged,
+                'data_version': data_version,
+                'computed_at': computed_at
+            })
+        return anomaly_rows, len(temps)
+
+    def stored_version(self, connection):
+        return connection.execute(select(self.anomaly.c.data_version).limit(1)).scalar()
+
+    def scores_version(self, connection):
+        """(version text, time) of the stored scores, which changes whenever they are recomputed"""
+        computed_at = connection.execute(select(func.max(self.anomaly.c.computed_at))).scalar()
+        if isinstance(computed_at, str):
+            # SQLite returns aggregates of DateTime columns as plain strings
+            computed_at = datetime.fromisoformat(computed_at)
+        return (computed_at.isoformat() if computed_at else 'none'), computed_at
+
+    def refresh(self, engine, data_version, today=None, force=False):
+        """Recompute pump_anomaly unless it already matches data_version
+
+        Returns timing statistics when it recomputed, None otherwise.
+        """
+        today = today or datetime.now().date()
+        data_version = f"{today.isoformat()}|{data_version}"
+
+        start = time.perf_counter()
+        with engine.connect() as connection:
+            if not force and self.stored_version(connection) == data_version:
+                return None
+            anomaly_rows, reading_count = self.compute(connection, today, data_version)
+        computed = time.perf_counter()
+
+        try:
+            with engine.begin() as connection:
+                connection.execute(self.anomaly.delete())
+                if anomaly_rows:
+                    connection.execute(self.anomaly.insert(), anomaly_rows)
+        except IntegrityError:
+            # Another worker stored the same scores first
+            logger.info("Pump anomalies were refreshed by another worker")
+        written = time.perf_counter()
+
+        self.last_stats = {
+            'pumps': len(anomaly_rows),
+            'readings': reading_count,
+            'flagged': sum(1 for row in anomaly_rows if row['is_flagged']),
+            'compute_ms': round((computed - start) * 1000, 1),
+            'write_ms': round((written - computed) * 1000, 1),
+            'data_version': data_version
+        }
+        logger.info(f"Recomputed pump anomalies: {self.last_stats}")
+        return self.last_stats
+
+def setup_anomaly_engine(app, db, log_model, anomaly_model, equipment_model):
+    """Register the anomaly API routes and return the engine behind them
+
+    Scores are kept current by a background thread unless
+    ANOMALY_BACKGROUND_REFRESH is false, in which case only
+    /admin/anomalies/recompute updates them.
+    """
+    app.config.setdefault('ANOMALY_BACKGROUND_REFRESH', os.environ.get('ANOMALY_BACKGROUND_REFRESH', 'true').lower() == 'true')
+    app.config.setdefault('ANOMALY_REFRESH_SECONDS', float(os.environ.get('ANOMALY_REFRESH_SECONDS', '300')))
+    engine = AnomalyEngine(log_model.__table__, anomaly_model.__table__, app.config['ANOMALY_REFRESH_SECONDS'])
+    log_table_name = log_model.__table__.name
+
+    def refresh_current():
+        with app.app_context():
+            try:
+                token, _ = get_data_version(db.session)
+                engine.refresh(db.engine, token)
+            finally:
+                db.session.remove()
+
+    if app.config['ANOMALY_BACKGROUND_REFRESH']:
+        engine.run_in_background(refresh_current)
+
+    @event.listens_for(Session, "after_flush")
+    def flag_log_changes(session, flush_context):
+        if any(isinstance(obj, log_model) for obj in session.new | session.deleted | session.dirty):
+            session.info[PENDING_FLAG] = True
+
+    @event.listens_for(Session, "do_orm_execute")
+    def flag_bulk_log_changes(orm_execute_state):
+        if orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = getattr(orm_execute_state.statement, 'table', None)
+            if table is not None and table.name == log_table_name:
+                orm_execute_state.session.info[PENDING_FLAG] = True
+
+    @event.listens_for(Session, "after_commit")
+    def schedule_refresh(session):
+        if session.info.pop(PENDING_FLAG, None):
+            engine.schedule()
+
+    @event.listens_for(Session, "after_rollback")
+    def clear_pending(session):
+        session.info.pop(PENDING_FLAG, None)
+
+    @app.route('/api/anomalies')
+    def anomalies():
+        """Scored pumps, flagged ones only unless ?all=true, highest drift first"""
+        include_all = request.args.get('all', '').lower() == 'true'
+
+        engine.start()
+
+        def build_payload():
+            query = db.session.query(anomaly_model, equipment_model.equipment_name).join(
+                equipment_model, equipment_model.equipment_id == anomaly_model.equipment_id
+            )
+            if not include_all:
+                query = query.filter(anomaly_model.is_flagged.is_(True))
+            rows = query.order_by(anomaly_model.drift_score.desc().nullslast(), anomaly_model.equipment_id).all()
+            return {
+                'anomalies': [dict(anomaly.to_dict(), equipment_name=name) for anomaly, name in rows],
+                'thresholds': {
+                    'high_temp': HIGH_TEMP_LIMIT,
+                    'zscore': Z_THRESHOLD,
+                    'drift': DRIFT_THRESHOLD,
+                    'recent_days': RECENT_DAYS
+                }
+            }
+
+        try:
+            scores_version, computed_at = engine.scores_version(db.session)
+            key = f"anomalies|{include_all}|{datetime.now().date()}|{scores_version}"
+            return conditional_json(db.session, key, build_payload, modified_at=computed_at)
+        except Exception as e:
+            logger.error(f"Error loading pump anomalies: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/admin/anomalies/recompute', methods=['POST'])
+    @app.admin_required
+    def recompute_anomalies():
+        """Recompute every pump's anomaly scores now and report the timings"""
+        try:
+            token, _ = get_data_version(db.session)
+            stats = engine.refresh(db.engine, token, force=True)
+            return jsonify({
+                "status": "success",
+                "message": f"Scored {stats['pumps']} pumps, {stats['flagged']} flagged",
+                "stats": stats,
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception as e:
+            logger.error(f"Error recomputing pump anomalies: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    return engine
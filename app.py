@@ -1,5 +1,5 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import login_required, current_user
 from datetime import datetime, timedelta
@@ -12,6 +12,7 @@ import shutil
 from pathlib import Path
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
+from sqlalchemy.orm import validates
 
 def resource_path(relative_path):
     """Get absolute path to resource, works for dev and PyInstaller"""
@@ -119,13 +120,26 @@ db = SQLAlchemy(app)
 from auth import setup_auth
 login_manager = setup_auth(app)
 
+# Initialize slow-query logging
+from query_monitor import setup_query_monitor
+setup_query_monitor(app)
+
+# Initialize JSON response compression
+from response_compression import setup_compression
+setup_compression(app)
+
+# Initialize request coalescing for expensive read endpoints
+from single_flight import setup_coalescing, coalesced
+setup_coalescing(app)
+
+from work_weeks import iso_week_key, week_key, week_label
+from lookups import lookup_name
+
 def get_work_week(date_obj=None):
-    """Calculate the work week in YYYY-WW format."""
+    """Calculate the work week in YYYY-WW format, using the ISO year."""
     if date_obj is None:
         date_obj = datetime.now()
-    year = date_obj.year
-    week = date_obj.isocalendar()[1]
-    return f"{year}-WW{week:02d}"
+    return week_label(iso_week_key(date_obj))
 
 def parse_temperature(temp_str):
     """Parse temperature string to float with error handling."""
@@ -136,14 +150,64 @@ def parse_temperature(temp_str):
     except ValueError:
         return None
 
+class PumpModel(db.Model):
+    """A pump model equipment refers to by pump_model_id, see lookups"""
+    pump_model_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    name_key = db.Column(db.String(100), nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"PumpModel({self.pump_model_id}: {self.name})"
+
+class OilType(db.Model):
+    """An oil type equipment refers to by oil_type_id, see lookups"""
+    oil_type_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    name_key = db.Column(db.String(100), nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"OilType({self.oil_type_id}: {self.name})"
+
+class Person(db.Model):
+    """A pump owner or person logging checks, referred to by owner_id and user_id, see lookups"""
+    person_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    name_key = db.Column(db.String(100), nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"Person({self.person_id}: {self.name})"
+
+class ServiceType(db.Model):
+    """A service maintenance logs refer to by service_id, see lookups"""
+    service_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    name_key = db.Column(db.String(50), nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"ServiceType({self.service_id}: {self.name})"
+
 class Equipment(db.Model):
     equipment_id = db.Column(db.Integer, primary_key=True)
     equipment_name = db.Column(db.String(100), nullable=False)
-    pump_model = db.Column(db.String(100))
-    oil_type = db.Column(db.String(100))
-    pump_owner = db.Column(db.String(100))
     status = db.Column(db.String(50), default='active')
     notes = db.Column(db.Text)
+    change_seq = db.Column(db.Integer, index=True)
+    # Lookup ids of the pump model, oil type and owner, see lookups
+    pump_model_id = db.Column(db.Integer, db.ForeignKey('pump_model.pump_model_id'), index=True)
+    oil_type_id = db.Column(db.Integer, db.ForeignKey('oil_type.oil_type_id'), index=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('person.person_id'), index=True)
+    pump_model_entry = db.relationship(PumpModel, lazy='joined')
+    oil_type_entry = db.relationship(OilType, lazy='joined')
+    owner_entry = db.relationship(Person, lazy='joined')
+    pump_model = lookup_name('pump_model', 'pump_model_id', 'pump_model_entry', PumpModel)
+    oil_type = lookup_name('oil_type', 'oil_type_id', 'oil_type_entry', OilType)
+    pump_owner = lookup_name('pump_owner', 'owner_id', 'owner_entry', Person)
+    # Whether the weekly log lists the pump, kept current by eligibility
+    is_eligible = db.Column(db.Boolean, default=True, index=True)
+    # Position of the pump in the week coverage bitmaps, see week_coverage
+    coverage_bit = db.Column(db.Integer)
+    # When the pump was added; None for pumps from before this was kept and bulk loads
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     maintenance_logs = db.relationship('MaintenanceLog', backref='equipment', lazy=True, cascade="all, delete-orphan")
 
@@ -162,12 +226,36 @@ class Equipment(db.Model):
             'notes': self.notes
         }
 
+class EligibilityRule(db.Model):
+    """Text that, found in a pump's oil_type or equipment_name, keeps it off the weekly log"""
+    rule_id = db.Column(db.Integer, primary_key=True)
+    field = db.Column(db.String(50), nullable=False)
+    pattern = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.String(200))
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"EligibilityRule({self.rule_id}: {self.field} contains {self.pattern})"
+
+    def to_dict(self):
+        """Convert eligibility rule to dictionary"""
+        return {
+            'rule_id': self.rule_id,
+            'field': self.field,
+            'pattern': self.pattern,
+            'description': self.description,
+            'active': self.active,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
 class MaintenanceLog(db.Model):
     log_id = db.Column(db.Integer, primary_key=True)
     equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.equipment_id', ondelete='CASCADE'), nullable=False)
     work_week = db.Column(db.String(10))
+    # iso_year * 100 + week, kept in step with work_week, see work_weeks
+    week_key = db.Column(db.Integer, index=True)
     check_date = db.Column(db.Date, nullable=False)
-    user_name = db.Column(db.String(100))
 
     oil_level_ok = db.Column(db.Boolean, default=False)
     oil_condition_ok = db.Column(db.Boolean, default=False)
@@ -175,12 +263,423 @@ class MaintenanceLog(db.Model):
 
     pump_temp = db.Column(db.Float)
 
-    service = db.Column(db.String(50), default='None Required')
     service_notes = db.Column(db.Text)
+    change_seq = db.Column(db.Integer, index=True)
+    # Lookup ids of the service and the person who logged the check, see
+    # lookups; new logs get the 'None Required' service
+    service_id = db.Column(db.Integer, db.ForeignKey('service_type.service_id'), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('person.person_id'), index=True)
+    service_entry = db.relationship(ServiceType, lazy='joined')
+    user_entry = db.relationship(Person, lazy='joined')
+    service = lookup_name('service', 'service_id', 'service_entry', ServiceType)
+    user_name = lookup_name('user_name', 'user_id', 'user_entry', Person)
+
+    __table_args__ = (
+        # A pump's logs in date order, read by needs_attention and equipment_stats
+        db.Index('ix_maintenance_log_equipment_history', 'equipment_id', 'check_date', 'log_id'),
+    )
 
     def __repr__(self):
         return f"MaintenanceLog({self.log_id}: {self.check_date} for Equipment {self.equipment_id})"
 
+    @validates('work_week')
+    def _set_week_key(self, key, work_week):
+        self.week_key = week_key(work_week)
+        return work_week
+
+    def to_dict(self):
+        """Convert maintenance log object to dictionary"""
+        return {
+            'log_id': self.log_id,
+            'equipment_id': self.equipment_id,
+            'work_week': self.work_week,
+            'check_date': self.check_date.isoformat() if self.check_date else None,
+            'user_name': self.user_name,
+            'oil_level_ok': self.oil_level_ok,
+            'oil_condition_ok': self.oil_condition_ok,
+            'oil_filter_ok': self.oil_filter_ok,
+            'pump_temp': self.pump_temp,
+            'service': self.service,
+            'service_notes': self.service_notes,
+            'change_seq': self.change_seq
+        }
+
+class EquipmentStats(db.Model):
+    """Running statistics of a pump's maintenance logs, kept by equipment_stats"""
+    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.equipment_id', ondelete='CASCADE'), primary_key=True)
+    log_count = db.Column(db.Integer, nullable=False, default=0)
+    temp_count = db.Column(db.Integer, nullable=False, default=0)
+    temp_mean = db.Column(db.Float)
+    temp_m2 = db.Column(db.Float, nullable=False, default=0.0)
+    first_check_date = db.Column(db.Date)
+    last_check_date = db.Column(db.Date)
+    last_service = db.Column(db.String(100))
+    last_service_date = db.Column(db.Date)
+    oil_add_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"EquipmentStats({self.equipment_id}: {self.log_count} logs)"
+
+    @property
+    def temp_std(self):
+        """Sample standard deviation of the pump's temperatures"""
+        if self.temp_count < 2:
+            return None
+        return (self.temp_m2 / (self.temp_count - 1)) ** 0.5
+
+    def missed_weeks(self, today=None):
+        """Weeks without a check since the week of the last check, not counting this week"""
+        if self.last_check_date is None:
+            return None
+        today = today or datetime.now().date()
+        last_monday = self.last_check_date - timedelta(days=self.last_check_date.weekday())
+        this_monday = today - timedelta(days=today.weekday())
+        return max(0, (this_monday - last_monday).days // 7 - 1)
+
+    @property
+    def oil_adds_per_month(self):
+        """Oil services per month between the first and last check"""
+        if self.first_check_date is None:
+            return None
+        months = max(1.0, (self.last_check_date - self.first_check_date).days / 30.44)
+        return self.oil_add_count / months
+
+    def to_dict(self, today=None):
+        """Convert equipment stats to dictionary"""
+        return {
+            'equipment_id': self.equipment_id,
+            'log_count': self.log_count,
+            'temp_count': self.temp_count,
+            'temp_mean': round(self.temp_mean, 2) if self.temp_mean is not None else None,
+            'temp_std': round(self.temp_std, 2) if self.temp_std is not None else None,
+            'first_check_date': self.first_check_date.isoformat() if self.first_check_date else None,
+            'last_check_date': self.last_check_date.isoformat() if self.last_check_date else None,
+            'last_service': self.last_service,
+            'last_service_date': self.last_service_date.isoformat() if self.last_service_date else None,
+            'missed_weeks': self.missed_weeks(today),
+            'oil_add_count': self.oil_add_count,
+            'oil_adds_per_month': round(self.oil_adds_per_month, 2) if self.oil_adds_per_month is not None else None
+        }
+
+class PumpAttention(db.Model):
+    """Last check and repeat oil services of a pump, kept by needs_attention"""
+    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.equipment_id', ondelete='CASCADE'), primary_key=True)
+    log_count = db.Column(db.Integer, nullable=False, default=0)
+    last_check_date = db.Column(db.Date, index=True)
+    previous_check_date = db.Column(db.Date)
+    last_oil_date = db.Column(db.Date)
+    repeat_oil_count = db.Column(db.Integer, nullable=False, default=0)
+    last_repeat_oil_date = db.Column(db.Date, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"PumpAttention({self.equipment_id}: last checked {self.last_check_date})"
+
+    @property
+    def last_gap_days(self):
+        """Days between the last two checks"""
+        if self.last_check_date is None or self.previous_check_date is None:
+            return None
+        return (self.last_check_date - self.previous_check_date).days
+
+    def to_dict(self):
+        """Convert needs-attention figures to dictionary"""
+        return {
+            'equipment_id': self.equipment_id,
+            'log_count': self.log_count,
+            'last_check_date': self.last_check_date.isoformat() if self.last_check_date else None,
+            'previous_check_date': self.previous_check_date.isoformat() if self.previous_check_date else None,
+            'last_gap_days': self.last_gap_days,
+            'last_oil_date': self.last_oil_date.isoformat() if self.last_oil_date else None,
+            'repeat_oil_count': self.repeat_oil_count,
+            'last_repeat_oil_date': self.last_repeat_oil_date.isoformat() if self.last_repeat_oil_date else None
+        }
+
+class WorkWeekSummary(db.Model):
+    """Maintenance totals of a work week, kept by work_week_summary"""
+    work_week = db.Column(db.String(10), primary_key=True)
+    week_key = db.Column(db.Integer, index=True)
+    eligible_pumps = db.Column(db.Integer, nullable=False, default=0)
+    pumps_checked = db.Column(db.Integer, nullable=False, default=0)
+    log_count = db.Column(db.Integer, nullable=False, default=0)
+    oil_add_count = db.Column(db.Integer, nullable=False, default=0)
+    drain_replace_count = db.Column(db.Integer, nullable=False, default=0)
+    high_temp_count = db.Column(db.Integer, nullable=False, default=0)
+    temp_count = db.Column(db.Integer, nullable=False, default=0)
+    temp_sum = db.Column(db.Float)
+    # Bitmap of the equipment_ids checked that week, see week_coverage
+    coverage = db.Column(db.LargeBinary)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"WorkWeekSummary({self.work_week}: {self.pumps_checked}/{self.eligible_pumps} checked)"
+
+    @property
+    def avg_temp(self):
+        if not self.temp_count or self.temp_sum is None:
+            return None
+        return self.temp_sum / self.temp_count
+
+    @property
+    def compliance_rate(self):
+        """Percentage of eligible pumps checked that week"""
+        if not self.eligible_pumps:
+            return None
+        return self.pumps_checked / self.eligible_pumps * 100
+
+    def to_dict(self):
+        """Convert work week summary to dictionary"""
+        return {
+            'work_week': self.work_week,
+            'week_key': self.week_key,
+            'eligible_pumps': self.eligible_pumps,
+            'pumps_checked': self.pumps_checked,
+            'compliance_rate': round(self.compliance_rate, 1) if self.compliance_rate is not None else None,
+            'log_count': self.log_count,
+            'oil_add_count': self.oil_add_count,
+            'drain_replace_count': self.drain_replace_count,
+            'high_temp_count': self.high_temp_count,
+            'avg_temp': round(self.avg_temp, 1) if self.avg_temp is not None else None
+        }
+
+class CalendarWeek(db.Model):
+    """An ISO week with its dates and fiscal period, filled by work_weeks"""
+    week_key = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    iso_year = db.Column(db.Integer, nullable=False)
+    iso_week = db.Column(db.Integer, nullable=False)
+    label = db.Column(db.String(10), nullable=False, unique=True)
+    week_start = db.Column(db.Date, nullable=False)
+    week_end = db.Column(db.Date, nullable=False)
+    fiscal_year = db.Column(db.Integer, nullable=False)
+    fiscal_quarter = db.Column(db.Integer, nullable=False)
+    fiscal_period = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"CalendarWeek({self.label}: {self.week_start} to {self.week_end})"
+
+    def to_dict(self):
+        """Convert calendar week to dictionary"""
+        return {
+            'week_key': self.week_key,
+            'work_week': self.label,
+            'week_start': self.week_start.isoformat(),
+            'week_end': self.week_end.isoformat(),
+            'fiscal_year': self.fiscal_year,
+            'fiscal_quarter': self.fiscal_quarter,
+            'fiscal_period': self.fiscal_period
+        }
+
+class TableVersion(db.Model):
+    """Change counter per table, used to build cache validators for the API"""
+    table_name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"TableVersion({self.table_name}: {self.version})"
+
+class ChangeEvent(db.Model):
+    """Maintenance log change published to live clients through /api/events"""
+    event_id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    event_type = db.Column(db.String(20), nullable=False)
+    equipment_id = db.Column(db.Integer)
+    work_week = db.Column(db.String(10))
+    payload = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f"ChangeEvent({self.event_id}: {self.event_type} for Equipment {self.equipment_id})"
+
+class ChangeSequence(db.Model):
+    """Named counters handing out change sequence numbers for /api/changes and coverage bits"""
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"ChangeSequence({self.name}: {self.value})"
+
+class ChangeTombstone(db.Model):
+    """Deleted equipment or maintenance log, kept for /api/changes consumers"""
+    change_seq = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    entity = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.Integer)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"ChangeTombstone({self.change_seq}: {self.entity} {self.entity_id})"
+
+class TemperatureReading(db.Model):
+    """Temperature reported by a logger attached to a pump, timestamps in UTC"""
+    reading_id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.equipment_id', ondelete='CASCADE'), nullable=False)
+    ts = db.Column(db.DateTime, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_temperature_reading_equipment_ts', 'equipment_id', 'ts'),
+    )
+
+    def __repr__(self):
+        return f"TemperatureReading({self.equipment_id} at {self.ts}: {self.value})"
+
+class TemperatureReadingArchive(db.Model):
+    """Raw reading moved out of temperature_reading by the retention policy"""
+    reading_id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=False)
+    equipment_id = db.Column(db.Integer, nullable=False)
+    ts = db.Column(db.DateTime, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_temperature_reading_archive_equipment_ts', 'equipment_id', 'ts'),
+    )
+
+    def __repr__(self):
+        return f"TemperatureReadingArchive({self.equipment_id} at {self.ts}: {self.value})"
+
+class TemperatureHourly(db.Model):
+    """Minimum, maximum, sum and count of a pump's readings in one hour (UTC)"""
+    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.equipment_id', ondelete='CASCADE'), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    min_value = db.Column(db.Float, nullable=False)
+    max_value = db.Column(db.Float, nullable=False)
+    sum_value = db.Column(db.Float, nullable=False)
+    reading_count = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_temperature_hourly_bucket_start', 'bucket_start'),
+    )
+
+    def __repr__(self):
+        return f"TemperatureHourly({self.equipment_id} at {self.bucket_start}: {self.reading_count} readings)"
+
+class TemperatureDaily(db.Model):
+    """Minimum, maximum, sum and count of a pump's readings in one day (UTC)"""
+    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.equipment_id', ondelete='CASCADE'), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    min_value = db.Column(db.Float, nullable=False)
+    max_value = db.Column(db.Float, nullable=False)
+    sum_value = db.Column(db.Float, nullable=False)
+    reading_count = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_temperature_daily_bucket_start', 'bucket_start'),
+    )
+
+    def __repr__(self):
+        return f"TemperatureDaily({self.equipment_id} on {self.bucket_start:%Y-%m-%d}: {self.reading_count} readings)"
+
+class PumpAnomaly(db.Model):
+    """Latest temperature anomaly scores of a pump, recomputed by anomaly_engine"""
+    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.equipment_id', ondelete='CASCADE'), primary_key=True)
+    last_check_date = db.Column(db.Date, nullable=False)
+    last_temp = db.Column(db.Float)
+    baseline_temp = db.Column(db.Float)
+    baseline_std = db.Column(db.Float)
+    ewma_temp = db.Column(db.Float)
+    zscore = db.Column(db.Float)
+    drift_score = db.Column(db.Float)
+    reasons = db.Column(db.String(50))
+    is_flagged = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    data_version = db.Column(db.String(200), nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"PumpAnomaly({self.equipment_id}: {self.reasons or 'normal'})"
+
+    def to_dict(self):
+        """Convert anomaly scores to dictionary"""
+        return {
+            'equipment_id': self.equipment_id,
+            'last_check_date': self.last_check_date.isoformat() if self.last_check_date else None,
+            'last_temp': self.last_temp,
+            'baseline_temp': self.baseline_temp,
+            'baseline_std': self.baseline_std,
+            'ewma_temp': self.ewma_temp,
+            'zscore': self.zscore,
+            'drift_score': self.drift_score,
+            'reasons': self.reasons.split(',') if self.reasons else [],
+            'is_flagged': self.is_flagged,
+            'computed_at': self.computed_at.isoformat() if self.computed_at else None
+        }
+
+class IdempotencyKey(db.Model):
+    """Stored response of a request sent with an Idempotency-Key header"""
+    key = db.Column(db.String(100), primary_key=True)
+    request_hash = db.Column(db.String(40), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"IdempotencyKey({self.key}: {self.status_code})"
+
+# Bump table versions whenever equipment or logs change
+from data_version import setup_data_versions, bump_table_versions, conditional_json, get_data_version
+setup_data_versions(TableVersion, [Equipment, MaintenanceLog])
+
+# Lookup tables behind the pump model, oil type, person and service values
+from lookups import setup_lookups, intern_rows, used_names, backfill_lookups, name_in
+setup_lookups(Equipment, MaintenanceLog, PumpModel, OilType, Person, ServiceType)
+
+# Publish maintenance log changes to live clients
+from change_events import setup_change_events, publish_events, log_row_events
+setup_change_events(app, db, ChangeEvent, MaintenanceLog)
+
+# Replay stored responses for retried offline sync batches
+from idempotency import setup_idempotency, idempotent_response, MAX_IDEMPOTENCY_KEY_LENGTH
+setup_idempotency(app, db, IdempotencyKey)
+
+# Hourly and daily rollups of logger readings, and raw reading retention
+from temperature_rollups import setup_temperature_rollups
+temperature_rollups = setup_temperature_rollups(
+    app, db, TemperatureReading, TemperatureReadingArchive, TemperatureHourly, TemperatureDaily, Equipment
+)
+
+# Temperature anomaly scores for the dashboard and /api/anomalies
+from anomaly_engine import setup_anomaly_engine
+anomaly_engine = setup_anomaly_engine(app, db, MaintenanceLog, PumpAnomaly, Equipment)
+
+# Buffered ingestion of logger temperature readings
+from readings_ingest import setup_readings_ingest
+reading_buffer = setup_readings_ingest(app, db, TemperatureReading, Equipment, temperature_rollups)
+
+# Weekly log eligibility flag and the rules that set it
+from eligibility import setup_eligibility, weekly_log_filter, backfill_eligibility
+setup_eligibility(app, db, EligibilityRule, Equipment)
+
+# Keep each pump's running statistics current as its logs change
+from equipment_stats import setup_equipment_stats, record_log_changes, backfill_equipment_stats, LOG_FIELDS as STATS_LOG_FIELDS
+setup_equipment_stats(EquipmentStats, MaintenanceLog, Equipment)
+
+# Needs-attention queue of overdue pumps and repeat oil services
+from needs_attention import setup_needs_attention, mark_pumps_changed, attention_query, attention_item, backfill_attention
+setup_needs_attention(app, db, PumpAttention, MaintenanceLog, Equipment)
+
+# Integer week keys and the calendar_week dimension
+from work_weeks import setup_work_weeks, backfill_week_keys
+setup_work_weeks(app, db, CalendarWeek)
+
+# Weekly totals behind /api/compliance-trend
+from work_week_summary import setup_work_week_summary, mark_weeks_changed, backfill_week_summaries, rebuild_week_summaries
+setup_work_week_summary(app, db, WorkWeekSummary, MaintenanceLog, Equipment, CalendarWeek, get_work_week)
+
+# In-memory week coverage bitmaps for /api/week-coverage and the Hall of Fame
+from week_coverage import setup_week_coverage, popcount, backfill_coverage_bits
+coverage_index = setup_week_coverage(app, db, WorkWeekSummary, Equipment, Person, MaintenanceLog, get_work_week)
+
+# Full-text search over log notes and equipment for /api/search
+from search import setup_search, ensure_search_index
+setup_search(app, db)
+
+# Streaming CSV, NDJSON and XLSX exports of maintenance logs
+from export import setup_export
+setup_export(app, db, MaintenanceLog, Equipment, Person)
+
+# Stamp equipment and log changes with sequence numbers for /api/changes
+from change_sync import setup_change_sync, next_change_seqs, backfill_change_seqs
+setup_change_sync(app, db, ChangeSequence, ChangeTombstone, [Equipment, MaintenanceLog])
+
 @app.route('/')
 def index():
     # If user is authenticated, redirect to dashboard
@@ -620,6 +1119,52 @@ def db_status():
             "timestamp": datetime.now().isoformat()
         }), 500
 
+DASHBOARD_ATTENTION_LIMIT = 10
+
+def dashboard_aggregates(today, current_work_week, token):
+    """Dashboard figures as plain data so they can be shared between requests
+
+    token is the data version the figures are computed at.
+    """
+    equipment_needs_oil = db.session.query(Equipment).join(MaintenanceLog).filter(
+        name_in(MaintenanceLog, 'service', ['Add Oil', 'Drain & Replace Oil']),
+        MaintenanceLog.check_date >= (today - timedelta(days=14))
+    ).all()
+
+    # Pumps running hot or drifting above their own baseline, scored in the
+    # background by anomaly_engine
+    anomaly_engine.start()
+    equipment_high_temp = db.session.query(Equipment, PumpAnomaly).join(
+        PumpAnomaly, PumpAnomaly.equipment_id == Equipment.equipment_id
+    ).filter(
+        PumpAnomaly.is_flagged.is_(True)
+    ).order_by(PumpAnomaly.drift_score.desc().nullslast(), Equipment.equipment_id).all()
+
+    # Pumps overdue for a check or needing oil again and again
+    needs_attention = attention_query(
+        db.session, PumpAttention, Equipment, today.date()
+    ).limit(DASHBOARD_ATTENTION_LIMIT).all()
+
+    current_logs = MaintenanceLog.query.filter(
+        MaintenanceLog.week_key == week_key(current_work_week)
+    ).order_by(MaintenanceLog.equipment_id).all()
+
+    # Share of the weekly log's pumps checked this week, from the coverage bitmaps
+    maintained_count, equipment_count = coverage_index.load(db.session, token).coverage(current_work_week)
+    maintenance_rate = (maintained_count / equipment_count * 100) if equipment_count > 0 else 0
+
+    return {
+        'equipment_needs_oil': [equipment.to_dict() for equipment in equipment_needs_oil],
+        'equipment_high_temp': [
+            dict(equipment.to_dict(), anomaly=anomaly.to_dict()) for equipment, anomaly in equipment_high_temp
+        ],
+        'needs_attention': [
+            attention_item(equipment, attention, today.date()) for equipment, attention in needs_attention
+        ],
+        'current_logs': [log.to_dict() for log in current_logs],
+        'maintenance_rate': maintenance_rate
+    }
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
@@ -627,33 +1172,19 @@ def dashboard():
         today = datetime.now()
         current_work_week = get_work_week(today)
 
-        equipment_needs_oil = db.session.query(Equipment).join(MaintenanceLog).filter(
-            MaintenanceLog.service.in_(['Add Oil', 'Drain & Replace Oil']),
-            MaintenanceLog.check_date >= (today - timedelta(days=14))
-        ).all()
-
-        equipment_high_temp = db.session.query(Equipment).join(MaintenanceLog).filter(
-            MaintenanceLog.pump_temp >= 80,
-            MaintenanceLog.check_date >= (today - timedelta(days=14))
-        ).all()
-
-        current_logs = MaintenanceLog.query.filter(
-            MaintenanceLog.work_week == current_work_week
-        ).order_by(MaintenanceLog.equipment_id).all()
-
-        equipment_count = Equipment.query.count()
-        maintained_count = db.session.query(Equipment).join(MaintenanceLog).filter(
-            MaintenanceLog.check_date >= (today - timedelta(days=7))
-        ).distinct().count()
-        maintenance_rate = (maintained_count / equipment_count * 100) if equipment_count > 0 else 0
+        # Viewers opening the dashboard together share one computation. The
+        # anomaly scores are rewritten after commits, so they key it as well
+        token, _ = get_data_version(db.session)
+        scores_version, _ = anomaly_engine.scores_version(db.session)
+        aggregates = coalesced(
+            f"dashboard|{today.date()}|{current_work_week}|{token}|{scores_version}",
+            lambda: dashboard_aggregates(today, current_work_week, token)
+        )
 
         return render_template(
             'dashboard.html',
-            equipment_needs_oil=equipment_needs_oil,
-            equipment_high_temp=equipment_high_temp,
-            current_logs=current_logs,
-            maintenance_rate=maintenance_rate,
-            current_work_week=current_work_week
+            current_work_week=current_work_week,
+            **aggregates
         )
     except Exception as e:
         logger.error(f"Error in dashboard: {e}")
@@ -665,7 +1196,8 @@ def dashboard():
 def equipment_list():
     try:
         equipment = Equipment.query.order_by(Equipment.equipment_id).all()
-        return render_template('equipment_list.html', equipment=equipment)
+        stats = {row.equipment_id: row for row in EquipmentStats.query.all()}
+        return render_template('equipment_list.html', equipment=equipment, stats=stats, today=datetime.now().date())
     except Exception as e:
         logger.error(f"Error in equipment_list: {e}")
         flash(f"An error occurred while loading equipment list.", "danger")
@@ -677,7 +1209,9 @@ def equipment_detail(equipment_id):
     try:
         equipment = Equipment.query.get_or_404(equipment_id)
         maintenance_logs = MaintenanceLog.query.filter_by(equipment_id=equipment_id).order_by(MaintenanceLog.check_date.desc()).all()
-        return render_template('equipment_detail.html', equipment=equipment, logs=maintenance_logs)
+        stats = db.session.get(EquipmentStats, equipment_id)
+        return render_template('equipment_detail.html', equipment=equipment, logs=maintenance_logs, stats=stats,
+                               today=datetime.now().date())
     except Exception as e:
         logger.error(f"Error in equipment_detail for ID {equipment_id}: {e}")
         flash(f"An error occurred while loading equipment details.", "danger")
@@ -735,40 +1269,39 @@ def weekly_log():
         current_work_week = get_work_week(today)
 
         work_week = request.args.get('work_week', current_work_week)
+        work_week_key = week_key(work_week)
+        if work_week_key is None:
+            flash(f"Invalid work week: {work_week}. Please use a week like {current_work_week}.", "danger")
+            return redirect(url_for('weekly_log'))
 
         # Check if we need to reset the weekly log
         # If the requested work week is the current week, check if we need to reset
         if work_week == current_work_week:
             # Get the most recent log for this week
-            most_recent_log = MaintenanceLog.query.filter_by(work_week=work_week).order_by(MaintenanceLog.check_date.desc()).first()
+            most_recent_log = MaintenanceLog.query.filter_by(week_key=work_week_key).order_by(MaintenanceLog.check_date.desc()).first()
 
             # If there's a log and it's from a previous week, we should reset
-            if most_recent_log and most_recent_log.check_date.isocalendar()[1] != today.isocalendar()[1]:
+            if most_recent_log and iso_week_key(most_recent_log.check_date) != work_week_key:
                 # Delete all logs for this week to reset
-                logs_to_delete = MaintenanceLog.query.filter_by(work_week=work_week).all()
+                logs_to_delete = MaintenanceLog.query.filter_by(week_key=work_week_key).all()
                 for log in logs_to_delete:
                     db.session.delete(log)
                 db.session.commit()
                 flash(f"Weekly log has been reset for {work_week}", "info")
 
-        # Get all equipment first to count how many are filtered out
-        all_equipment = Equipment.query.order_by(Equipment.equipment_id).all()
+        # Count all equipment first to see how many are filtered out
+        all_equipment_count = Equipment.query.count()
 
-        # Filter out equipment with "scroll" in oil_type or "spare" in equipment_name
-        equipment_list = Equipment.query.filter(
-            # For oil_type, handle NULL values and exclude "scroll" (case insensitive)
-            (Equipment.oil_type.is_(None) | ~Equipment.oil_type.ilike('%scroll%')),
-            # Exclude equipment with "spare" in name (case insensitive)
-            ~Equipment.equipment_name.ilike('%spare%')
-        ).order_by(Equipment.equipment_id).all()
+        # Leave out the pumps the eligibility rules exclude, such as scroll pumps and spares
+        equipment_list = Equipment.query.filter(weekly_log_filter(Equipment)).order_by(Equipment.equipment_id).all()
 
         # Calculate how many items were filtered out
-        filtered_out_count = len(all_equipment) - len(equipment_list)
+        filtered_out_count = all_equipment_count - len(equipment_list)
         if filtered_out_count > 0:
-            logger.info(f"Filtered out {filtered_out_count} equipment items with 'scroll' in oil type or 'spare' in name")
+            logger.info(f"Filtered out {filtered_out_count} equipment items excluded by the eligibility rules")
 
         existing_logs = {}
-        logs = MaintenanceLog.query.filter_by(work_week=work_week).all()
+        logs = MaintenanceLog.query.filter_by(week_key=work_week_key).all()
         for log in logs:
             existing_logs[log.equipment_id] = log
 
@@ -787,30 +1320,68 @@ def weekly_log():
 
                 user_name = request.form.get('user_name', '')
 
+                # Collect all rows first and write them with one bulk insert and
+                # one bulk update instead of a statement per equipment
+                rows = []
                 for equipment in equipment_list:
-                    log = existing_logs.get(equipment.equipment_id)
-                    if not log:
-                        log = MaintenanceLog(
-                            equipment_id=equipment.equipment_id,
-                            work_week=work_week,
-                            check_date=check_date,
-                            user_name=user_name,
-                        )
-                        db.session.add(log)
-                    else:
-                        log.user_name = user_name
-                        log.check_date = check_date
-
                     equipment_key = f"equipment_{equipment.equipment_id}"
-                    log.oil_level_ok = equipment_key + "_oil_level_ok" in request.form
-                    log.oil_condition_ok = equipment_key + "_oil_condition_ok" in request.form
-                    log.oil_filter_ok = equipment_key + "_oil_filter_ok" in request.form
-
                     temp_value = request.form.get(equipment_key + "_pump_temp")
-                    log.pump_temp = parse_temperature(temp_value)
 
-                    log.service = request.form.get(equipment_key + "_service", 'None Required')
-                    log.service_notes = request.form.get(equipment_key + "_service_notes", '')
+                    rows.append((equipment, {
+                        'user_name': user_name,
+                        'check_date': check_date,
+                        'oil_level_ok': equipment_key + "_oil_level_ok" in request.form,
+                        'oil_condition_ok': equipment_key + "_oil_condition_ok" in request.form,
+                        'oil_filter_ok': equipment_key + "_oil_filter_ok" in request.form,
+                        'pump_temp': parse_temperature(temp_value),
+                        'service': request.form.get(equipment_key + "_service", 'None Required'),
+                        'service_notes': request.form.get(equipment_key + "_service_notes", '')
+                    }))
+
+                # Bulk operations skip the flush that sets the lookup ids
+                intern_rows(db.session.connection(), MaintenanceLog, [row for _, row in rows])
+
+                new_rows = []
+                updated_rows = []
+                event_rows = []
+                stats_changes = []
+                for equipment, row in rows:
+                    log = existing_logs.get(equipment.equipment_id)
+                    if not log:
+                        row['equipment_id'] = equipment.equipment_id
+                        row['work_week'] = work_week
+                        row['week_key'] = work_week_key
+                        new_rows.append(row)
+                        stats_changes.append((None, row))
+                    else:
+                        row['log_id'] = log.log_id
+                        updated_rows.append(row)
+                        stats_changes.append((
+                            {field: getattr(log, field) for field in STATS_LOG_FIELDS},
+                            dict(row, equipment_id=equipment.equipment_id)
+                        ))
+                    event_rows.append(dict(row, equipment_id=equipment.equipment_id, work_week=work_week))
+
+                if new_rows or updated_rows:
+                    first_seq = next_change_seqs(db.session, len(new_rows) + len(updated_rows))
+                    for change_seq, row in enumerate(new_rows + updated_rows, start=first_seq):
+                        row['change_seq'] = change_seq
+
+                if new_rows:
+                    db.session.bulk_insert_mappings(MaintenanceLog, new_rows)
+                if updated_rows:
+                    db.session.bulk_update_mappings(MaintenanceLog, updated_rows)
+                if new_rows or updated_rows:
+                    # Bulk operations skip the flush events that bump the
+                    # version, stamp change sequence numbers, publish change
+                    # events and update equipment stats
+                    bump_table_versions(db.session, [MaintenanceLog.__tablename__])
+                    publish_events(db.session, log_row_events(event_rows))
+                    record_log_changes(db.session, [
+                        (old, {field: new[field] for field in STATS_LOG_FIELDS}) for old, new in stats_changes
+                    ])
+                    mark_pumps_changed(db.session, [row['equipment_id'] for row in event_rows])
+                    mark_weeks_changed(db.session, [work_week])
 
                 db.session.commit()
                 flash('Weekly maintenance log saved successfully', 'success')
@@ -843,7 +1414,7 @@ def maintenance_logs():
         query = MaintenanceLog.query
 
         if work_week:
-            query = query.filter(MaintenanceLog.work_week == work_week)
+            query = query.filter(MaintenanceLog.week_key == week_key(work_week))
 
         if equipment_id:
             try:
@@ -852,10 +1423,13 @@ def maintenance_logs():
             except ValueError:
                 pass
 
-        logs = query.order_by(MaintenanceLog.check_date.desc(), MaintenanceLog.equipment_id).all()
+        # Eager load equipment so the template does not issue one query per log
+        logs = query.options(db.joinedload(MaintenanceLog.equipment)).order_by(
+            MaintenanceLog.check_date.desc(), MaintenanceLog.equipment_id
+        ).all()
 
-        work_weeks = db.session.query(MaintenanceLog.work_week).distinct().order_by(MaintenanceLog.work_week.desc()).all()
-        work_weeks = [ww[0] for ww in work_weeks if ww[0]]
+        week_keys = db.session.query(MaintenanceLog.week_key).distinct().order_by(MaintenanceLog.week_key.desc()).all()
+        work_weeks = [week_label(key) for key, in week_keys if key]
 
         equipment_list = Equipment.query.order_by(Equipment.equipment_id).all()
 
@@ -974,30 +1548,25 @@ def dropdown_options(field):
         return jsonify([])
 
     try:
-        if field in ['pump_model', 'oil_type', 'pump_owner']:
-            values = db.session.query(getattr(Equipment, field)).distinct().all()
-            values = [val[0] for val in values if val[0] is not None]
+        # Values come from the lookup tables, limited to the ones still in use
+        if field == 'pump_model':
+            values = used_names(db.session, PumpModel, (Equipment, 'pump_model_id'))
+        elif field == 'oil_type':
+            values = used_names(db.session, OilType, (Equipment, 'oil_type_id'))
+        elif field == 'pump_owner':
+            values = used_names(db.session, Person, (Equipment, 'owner_id'))
         elif field == 'service':
             # Get standard service options plus any custom ones from the database
             standard_options = [
                 'None Required', 'Add Oil', 'Drain & Replace Oil',
                 'Swap Pump for Spare', 'Drain Oil Filter', "Other (see 'Service Notes')"
             ]
-            custom_values = db.session.query(MaintenanceLog.service).distinct().all()
-            custom_values = [val[0] for val in custom_values if val[0] is not None
-                            and val[0] not in standard_options]
+            custom_values = used_names(db.session, ServiceType, (MaintenanceLog, 'service_id'))
+            custom_values = [val for val in custom_values if val not in standard_options]
             values = standard_options + custom_values
         elif field == 'user_name':
-            # Get unique user names from maintenance logs
-            user_values = db.session.query(MaintenanceLog.user_name).distinct().all()
-            user_values = [val[0] for val in user_values if val[0] is not None and val[0].strip() != '']
-
-            # Also include pump owners as potential employees
-            owner_values = db.session.query(Equipment.pump_owner).distinct().all()
-            owner_values = [val[0] for val in owner_values if val[0] is not None and val[0].strip() != '']
-
-            # Combine and remove duplicates
-            values = list(set(user_values + owner_values))
+            # People who logged checks, and pump owners as potential employees
+            values = used_names(db.session, Person, (MaintenanceLog, 'user_id'), (Equipment, 'owner_id'))
 
         values.sort()
         return jsonify(values)
@@ -1040,9 +1609,13 @@ def save_equipment_log(equipment_id, work_week):
     try:
         equipment = Equipment.query.get_or_404(equipment_id)
 
+        if week_key(work_week) is None:
+            flash(f"Invalid work week: {work_week}. Please use a week like {get_work_week()}.", "danger")
+            return redirect(url_for('weekly_log'))
+
         existing_log = MaintenanceLog.query.filter_by(
             equipment_id=equipment_id,
-            work_week=work_week
+            week_key=week_key(work_week)
         ).first()
 
         # Use the hidden or visible check_date field
@@ -1109,14 +1682,17 @@ def save_equipment_log(equipment_id, work_week):
 
             flash(f'Maintenance log for {equipment.equipment_name} created successfully', 'success')
 
+        # Flush first to learn the person the user name was interned as
+        db.session.flush()
+        user_id = (existing_log or new_log).user_id
         db.session.commit()
 
         # Update Hall of Fame scores when a maintenance log is saved
         try:
             # If the user is a pump owner, update their score
-            if user_name and user_name.strip() != '':
+            if user_id is not None:
                 # Check if this user is a pump owner
-                is_pump_owner = Equipment.query.filter(Equipment.pump_owner == user_name).first() is not None
+                is_pump_owner = Equipment.query.filter(Equipment.owner_id == user_id).first() is not None
 
                 if is_pump_owner:
                     logger.info(f"Updating Hall of Fame score for pump owner: {user_name}")
@@ -1135,133 +1711,483 @@ def save_equipment_log(equipment_id, work_week):
         flash(f"Error saving maintenance log: {str(e)}", "danger")
         return redirect(url_for('weekly_log', work_week=work_week))
 
-@app.route('/api/chart-data')
-def chart_data():
-    try:
-        logs = MaintenanceLog.query.join(Equipment).filter(
-            MaintenanceLog.pump_temp.isnot(None),
-            MaintenanceLog.check_date >= (datetime.now() - timedelta(days=60))
-        ).order_by(MaintenanceLog.check_date).all()
+# Most rows accepted by one weekly log API request
+MAX_LOG_ROWS_PER_REQUEST = 500
 
-        temp_data = {}
-        dates = set()
+def parse_log_row(row):
+    """Validate the log fields of one weekly log row from the JSON API
 
-        for log in logs:
-            equipment_name = log.equipment.equipment_name
-            date_str = log.check_date.strftime('%Y-%m-%d')
-            dates.add(date_str)
+    Only fields present in row are returned, so a row can change a single
+    field. Returns (fields, errors) where errors maps field names to messages.
+    """
+    fields = {}
+    errors = {}
 
-            if equipment_name not in temp_data:
-                temp_data[equipment_name] = {}
+    if 'check_date' in row:
+        try:
+            fields['check_date'] = datetime.strptime(str(row['check_date']), '%Y-%m-%d').date()
+        except ValueError:
+            errors['check_date'] = f"Invalid date format: {row['check_date']}. Please use YYYY-MM-DD format."
 
-            temp_data[equipment_name][date_str] = log.pump_temp
+    for name in ('oil_level_ok', 'oil_condition_ok', 'oil_filter_ok'):
+        if name in row:
+            if isinstance(row[name], bool):
+                fields[name] = row[name]
+            else:
+                errors[name] = 'Must be true or false'
 
-        sorted_dates = sorted(list(dates))
-        chart_data = {
-            'labels': sorted_dates,
-            'datasets': []
-        }
+    if 'pump_temp' in row:
+        value = row['pump_temp']
+        if value is None or (isinstance(value, str) and value.strip() == ''):
+            fields['pump_temp'] = None
+        else:
+            try:
+                if isinstance(value, bool):
+                    raise ValueError
+                fields['pump_temp'] = float(value)
+            except (TypeError, ValueError):
+                errors['pump_temp'] = f"Invalid temperature: {value}"
+
+    for name, max_length in (('user_name', 100), ('service', 50), ('service_notes', None)):
+        if name not in row:
+            continue
+        value = row[name]
+        if value is not None and not isinstance(value, str):
+            errors[name] = 'Must be text'
+            continue
+        value = (value or '').strip()
+        if max_length and len(value) > max_length:
+            errors[name] = f"Must be at most {max_length} characters"
+            continue
+        fields[name] = value
+
+    if 'service' in fields and fields['service'] in ('', 'custom'):
+        fields['service'] = 'None Required'
+
+    return fields, errors
+
+def save_log_rows(rows, work_week=None):
+    """Apply weekly log row changes in the current transaction, without committing
+
+    Rows carry their own work_week unless one is given for all of them. A
+    row with a base_change_seq is only applied while the stored log is still
+    at that version (null meaning there was no log); otherwise the stored
+    log is returned as a conflict; the pumps of such rows are locked first,
+    so two syncs against the same version cannot both apply. Returns
+    (saved rows, errors, conflicts).
+    """
+    errors = []
+    changes = []
+    for row in rows:
+        equipment_id = row.get('equipment_id')
+        row_week = work_week or row.get('work_week')
+        if isinstance(equipment_id, bool) or not isinstance(equipment_id, int):
+            errors.append({'equipment_id': equipment_id, 'work_week': row_week, 'field': 'equipment_id', 'message': 'Must be an integer'})
+            continue
+        if week_key(row_week) is None:
+            errors.append({'equipment_id': equipment_id, 'work_week': row_week, 'field': 'work_week', 'message': 'Must look like 2025-WW07'})
+            continue
+        fields, field_errors = parse_log_row(row)
+        for field, message in field_errors.items():
+            errors.append({'equipment_id': equipment_id, 'work_week': row_week, 'field': field, 'message': message})
+        if not field_errors:
+            changes.append((equipment_id, row_week, row, fields))
+
+    if any('base_change_seq' in row for _, _, row, _ in changes):
+        # Checked rows are compared with the stored logs, so hold the pumps
+        # until the commit: a second sync against the same base waits here
+        # and then sees the first one's change as a conflict. A no-op UPDATE
+        # locks the rows on PostgreSQL and takes the write lock on SQLite,
+        # where SELECT ... FOR UPDATE does nothing.
+        equipment_table = Equipment.__table__
+        db.session.connection().execute(
+            equipment_table.update()
+            .where(equipment_table.c.equipment_id.in_({equipment_id for equipment_id, _, _, _ in changes}))
+            .values(change_seq=equipment_table.c.change_seq)
+        )
 
-        colors = [
-            '#4e73df', '#1cc88a', '#36b9cc', '#f6c23e', '#e74a3b', '#6f42c1',
-            '#5a5c69', '#858796', '#2e59d9', '#17a673', '#2c9faf', '#f8f9fc',
-            '#e74a3b', '#fd7e14', '#f6c23e', '#20c9a6', '#28a745', '#6610f2',
-            '#6f42c1', '#e83e8c', '#e74a3b', '#fd7e14', '#ffc107', '#28a745'
-        ]
-
-        for i, (equipment_name, temp_values) in enumerate(temp_data.items()):
-            dataset = {
-                'label': equipment_name,
-                'data': [temp_values.get(date, None) for date in sorted_dates],
-                'borderColor': colors[i % len(colors)],
-                'backgroundColor': 'transparent',
-                'pointRadius': 3
-            }
-            chart_data['datasets'].append(dataset)
+    # One query for the equipment and its existing logs in the weeks involved
+    equipment_by_id = {}
+    logs = {}
+    if changes:
+        found = db.session.query(Equipment, MaintenanceLog).outerjoin(
+            MaintenanceLog,
+            (MaintenanceLog.equipment_id == Equipment.equipment_id)
+            & MaintenanceLog.week_key.in_({week_key(row_week) for _, row_week, _, _ in changes})
+        ).filter(Equipment.equipment_id.in_({equipment_id for equipment_id, _, _, _ in changes})).all()
+        for equipment, log in found:
+            equipment_by_id[equipment.equipment_id] = equipment
+            if log is not None:
+                logs.setdefault((equipment.equipment_id, week_label(log.week_key)), log)
+
+    saved = {}
+    conflicts = []
+    for equipment_id, row_week, row, fields in changes:
+        equipment = equipment_by_id.get(equipment_id)
+        if equipment is None:
+            errors.append({'equipment_id': equipment_id, 'work_week': row_week, 'field': None, 'message': f"Equipment {equipment_id} not found"})
+            continue
+
+        key = (equipment_id, row_week)
+        log = logs.get(key)
+        if 'base_change_seq' in row and key not in saved:
+            current_seq = log.change_seq if log is not None else None
+            if row['base_change_seq'] != current_seq:
+                conflicts.append({
+                    'equipment_id': equipment_id,
+                    'work_week': row_week,
+                    'base_change_seq': row['base_change_seq'],
+                    'current': log.to_dict() if log is not None else None
+                })
+                continue
+
+        if log is None:
+            # Auto-fill with pump owner for first edit, as the form does
+            log = MaintenanceLog(
+                equipment_id=equipment_id,
+                work_week=row_week,
+                check_date=datetime.now().date(),
+                user_name=equipment.pump_owner or '',
+                oil_level_ok=False,
+                oil_condition_ok=False,
+                oil_filter_ok=False,
+                service='None Required',
+                service_notes=''
+            )
+            if not fields.get('user_name'):
+                fields.pop('user_name', None)
+            db.session.add(log)
+            logs[key] = log
+
+        for name, value in fields.items():
+            setattr(log, name, value)
+        saved[key] = log
+
+    # Serialize before a commit expires the objects
+    db.session.flush()
+    return [log.to_dict() for log in saved.values()], errors, conflicts
+
+def log_rows_payload(row_count, saved_rows, errors, conflicts):
+    """Build the JSON response body and status code for saved weekly log rows"""
+    if saved_rows and (errors or conflicts):
+        status, status_code = "partial", 200
+    elif saved_rows or not (errors or conflicts):
+        status, status_code = "success", 200
+    elif errors:
+        status, status_code = "error", 400
+    else:
+        status, status_code = "conflict", 409
+
+    return {
+        "status": status,
+        "message": f"Saved {len(saved_rows)} of {row_count} rows",
+        "rows": saved_rows,
+        "errors": errors,
+        "conflicts": conflicts,
+        "timestamp": datetime.now().isoformat()
+    }, status_code
+
+def read_log_rows(data):
+    """Get the list of row objects from a weekly log API request body, or None"""
+    rows = data.get('rows', [data]) if isinstance(data, dict) else data
+    if not isinstance(rows, list) or not rows or not all(isinstance(row, dict) for row in rows):
+        return None
+    return rows
+
+@app.route('/api/weekly-log/<work_week>/rows', methods=['POST'])
+@login_required
+def save_weekly_log_rows(work_week):
+    """Save one or many weekly log rows and return the saved rows
+
+    Accepts a single row object or {"rows": [...]}. Each row has an
+    equipment_id plus the log fields to change; a new log gets the same
+    defaults as save_equipment_log. Valid rows are saved even when others
+    fail validation, and the errors are returned per row and field.
+    """
+    rows = read_log_rows(request.get_json(silent=True))
+    if rows is None:
+        return jsonify({"error": 'Expected a row object or {"rows": [...]} with at least one row'}), 400
+    if len(rows) > MAX_LOG_ROWS_PER_REQUEST:
+        return jsonify({"error": f"At most {MAX_LOG_ROWS_PER_REQUEST} rows can be saved per request"}), 400
+
+    try:
+        saved_rows, errors, conflicts = save_log_rows(rows, work_week)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error saving weekly log rows: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        maintenance_counts = db.session.query(
-            Equipment.equipment_name,
-            db.func.count(MaintenanceLog.log_id)
-        ).join(MaintenanceLog).group_by(Equipment.equipment_id).all()
+    payload, status_code = log_rows_payload(len(rows), saved_rows, errors, conflicts)
+    return jsonify(payload), status_code
 
-        maintenance_data = {
+@app.route('/api/weekly-log/sync', methods=['POST'])
+@login_required
+def sync_weekly_log():
+    """Apply a batch of queued offline weekly log edits exactly once
+
+    Batches need an Idempotency-Key header: a retry with the same key gets
+    the stored response of the first attempt instead of applying the rows
+    again. Rows carry their work_week and the base_change_seq they were
+    edited against, so edits to a row someone else changed meanwhile come
+    back as conflicts instead of overwriting it.
+    """
+    key = request.headers.get('Idempotency-Key', '').strip()
+    if not key or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        return jsonify({"error": f"An Idempotency-Key header of at most {MAX_IDEMPOTENCY_KEY_LENGTH} characters is required"}), 400
+
+    rows = read_log_rows(request.get_json(silent=True))
+    if rows is None:
+        return jsonify({"error": 'Expected {"rows": [...]} with at least one row'}), 400
+    if len(rows) > MAX_LOG_ROWS_PER_REQUEST:
+        return jsonify({"error": f"At most {MAX_LOG_ROWS_PER_REQUEST} rows can be synced per request"}), 400
+
+    def apply_batch():
+        saved_rows, errors, conflicts = save_log_rows(rows)
+        return log_rows_payload(len(rows), saved_rows, errors, conflicts)
+
+    return idempotent_response(key, request.get_data(), apply_batch)
+
+@app.route('/service-worker.js')
+def service_worker():
+    """Serve the service worker from the site root so it can control every page"""
+    response = send_from_directory(app.static_folder, 'js/service_worker.js', mimetype='application/javascript')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def calculate_hall_of_fame():
+    """Calculate the Hall of Fame scores for pump owners
+
+    Each week an owner earns 10 points for the eligible equipment they
+    maintained themselves that week, scaled by the eligible equipment they
+    own, counted with per-person week coverage bitmaps.
+    """
+    index = coverage_index.load(db.session)
+    people_weeks = index.load_people_weeks(db.session)
+
+    # Calculate total score: sum of (equipment maintained * 10 / equipment owned) for each week
+    hall_of_fame = []
+    for owner_id, owned_pumps in index.owners.items():
+        owned_equipment_count = popcount(owned_pumps)
+        weekly_pumps = people_weeks.get(owner_id, {})
+        total_score = 0
+        for week, maintained_pumps in weekly_pumps.items():
+            weekly_score = popcount(maintained_pumps) * 10 / owned_equipment_count
+            total_score += weekly_score
+
+        hall_of_fame.append({
+            'name': index.owner_names.get(owner_id),
+            'score': round(total_score, 1),
+            'equipment_owned': owned_equipment_count,
+            'weeks_active': len(weekly_pumps)
+        })
+
+    # Sort by score (highest first)
+    hall_of_fame.sort(key=lambda x: x['score'], reverse=True)
+
+    # Add rank
+    for i, entry in enumerate(hall_of_fame):
+        entry['rank'] = i + 1
+
+    return hall_of_fame
+
+# Colors for the legacy chart payload, compact payloads are styled by the client
+CHART_COLORS = [
+    '#4e73df', '#1cc88a', '#36b9cc', '#f6c23e', '#e74a3b', '#6f42c1',
+    '#5a5c69', '#858796', '#2e59d9', '#17a673', '#2c9faf', '#f8f9fc',
+    '#e74a3b', '#fd7e14', '#f6c23e', '#20c9a6', '#28a745', '#6610f2',
+    '#6f42c1', '#e83e8c', '#e74a3b', '#fd7e14', '#ffc107', '#28a745'
+]
+
+def build_temperature_chart(params, compact=False):
+    """Temperature readings per pump, bucketed and downsampled as params request"""
+    from chart_series import bucket_expression, aggregate_expression
+
+    # Bucket and aggregate the readings in SQL so the response size
+    # depends on the window and bucket, not on the number of logs
+    bucket = bucket_expression(MaintenanceLog.check_date, params['bucket'], db.engine.dialect.name)
+    readings = db.session.query(
+        Equipment.equipment_name,
+        bucket.label('bucket'),
+        aggregate_expression(MaintenanceLog.pump_temp, params['agg'])
+    ).select_from(MaintenanceLog).join(Equipment).filter(
+        MaintenanceLog.pump_temp.isnot(None),
+        MaintenanceLog.check_date >= (datetime.now() - timedelta(days=params['window'])).date()
+    ).group_by(Equipment.equipment_name, bucket).order_by(bucket).all()
+
+    return temperature_chart_payload(readings, params, compact)
+
+def temperature_chart_payload(readings, params, compact=False):
+    """Downsampled chart payload for (equipment name, bucket label, value) rows"""
+    from chart_series import build_series, encode_compact_series
+
+    sorted_dates, temp_data = build_series(readings, params['max_points'])
+    if compact:
+        return encode_compact_series(sorted_dates, temp_data)
+
+    chart_data = {
+        'labels': sorted_dates,
+        'datasets': [],
+        'resolution': params
+    }
+    for i, (equipment_name, temp_values) in enumerate(temp_data.items()):
+        dataset = {
+            'label': equipment_name,
+            'data': [temp_values.get(date, None) for date in sorted_dates],
+            'borderColor': CHART_COLORS[i % len(CHART_COLORS)],
+            'backgroundColor': 'transparent',
+            'pointRadius': 3
+        }
+        chart_data['datasets'].append(dataset)
+    return chart_data
+
+def build_maintenance_chart(compact=False):
+    """Number of maintenance logs per pump"""
+    maintenance_counts = db.session.query(
+        Equipment.equipment_name,
+        db.func.count(MaintenanceLog.log_id)
+    ).join(MaintenanceLog).group_by(Equipment.equipment_id).all()
+
+    if compact:
+        return {
             'labels': [item[0] for item in maintenance_counts],
-            'datasets': [{
-                'data': [item[1] for item in maintenance_counts],
-                'backgroundColor': colors[:len(maintenance_counts)]
-            }]
+            'values': [item[1] for item in maintenance_counts]
         }
 
-        # Calculate Hall of Fame scores
-        # Get all pump owners, excluding those who only own scroll pumps or spare equipment
-        eligible_equipment = Equipment.query.filter(
-            (Equipment.oil_type.is_(None) | ~Equipment.oil_type.ilike('%scroll%')),
-            ~Equipment.equipment_name.ilike('%spare%')
-        ).all()
+    return {
+        'labels': [item[0] for item in maintenance_counts],
+        'datasets': [{
+            'data': [item[1] for item in maintenance_counts],
+            'backgroundColor': CHART_COLORS[:len(maintenance_counts)]
+        }]
+    }
 
-        # Get unique eligible pump owners
-        eligible_owners = set()
-        for equip in eligible_equipment:
-            if equip.pump_owner and equip.pump_owner.strip() != '':
-                eligible_owners.add(equip.pump_owner)
-
-        # Calculate scores for each eligible pump owner
-        hall_of_fame = []
-        for owner in eligible_owners:
-            # Count eligible equipment owned by this owner (excluding scroll and spare)
-            owned_equipment_count = Equipment.query.filter(
-                Equipment.pump_owner == owner,
-                (Equipment.oil_type.is_(None) | ~Equipment.oil_type.ilike('%scroll%')),
-                ~Equipment.equipment_name.ilike('%spare%')
-            ).count()
-
-            if owned_equipment_count == 0:
-                continue
+def compact_payload(payload, resolution=None):
+    """Add the compact format flag to a chart payload"""
+    from chart_series import COMPACT_FORMAT_VERSION
 
-            # Get all maintenance logs by this owner for eligible equipment only
-            owner_logs = MaintenanceLog.query.join(Equipment).filter(
-                MaintenanceLog.user_name == owner,
-                (Equipment.oil_type.is_(None) | ~Equipment.oil_type.ilike('%scroll%')),
-                ~Equipment.equipment_name.ilike('%spare%')
-            ).all()
-
-            # Group logs by week to calculate weekly scores
-            weekly_scores = {}
-            for log in owner_logs:
-                week = log.work_week
-                if week not in weekly_scores:
-                    weekly_scores[week] = set()  # Use set to avoid counting the same equipment twice in a week
-                weekly_scores[week].add(log.equipment_id)
-
-            # Calculate total score: sum of (equipment maintained * 10 / equipment owned) for each week
-            total_score = 0
-            for week, equipment_ids in weekly_scores.items():
-                weekly_score = len(equipment_ids) * 10 / owned_equipment_count
-                total_score += weekly_score
-
-            hall_of_fame.append({
-                'name': owner,
-                'score': round(total_score, 1),
-                'equipment_owned': owned_equipment_count,
-                'weeks_active': len(weekly_scores)
-            })
+    payload['format'] = 'compact'
+    payload['version'] = COMPACT_FORMAT_VERSION
+    if resolution is not None:
+        payload['resolution'] = resolution
+    return payload
 
-        # Sort by score (highest first)
-        hall_of_fame.sort(key=lambda x: x['score'], reverse=True)
+@app.route('/api/chart-data')
+def chart_data():
+    """All dashboard chart data in one response
 
-        # Add rank
-        for i, entry in enumerate(hall_of_fame):
-            entry['rank'] = i + 1
+    Optional query parameters control the temperature chart resolution:
+    window (days, default 60), bucket (day, week or month), agg (avg, min
+    or max) and max_points (per pump, default 200). format=compact returns
+    the columnar payload from chart_series.encode_compact_series, without
+    styling; clients that do not ask for it get the Chart.js datasets. The
+    dashboard loads the three parts from their own endpoints below.
+    """
+    from chart_series import parse_chart_params
 
-        return jsonify({
-            'temperature_chart': chart_data,
-            'maintenance_chart': maintenance_data,
-            'hall_of_fame': hall_of_fame
-        })
+    try:
+        params = parse_chart_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    compact = request.args.get('format') == 'compact'
+
+    def build_payload():
+        payload = {
+            'temperature_chart': build_temperature_chart(params, compact),
+            'maintenance_chart': build_maintenance_chart(compact),
+            'hall_of_fame': calculate_hall_of_fame()
+        }
+        return compact_payload(payload, params) if compact else payload
+
+    try:
+        # The window ends today, so the date is part of the cache key
+        key = f"chart-data|{sorted(params.items())}|{compact}|{datetime.now().date()}"
+        return conditional_json(db.session, key, build_payload)
     except Exception as e:
         logger.error(f"Error generating chart data: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/chart-data/temperature')
+def chart_data_temperature():
+    """Temperature chart data, takes the same parameters as /api/chart-data"""
+    from chart_series import parse_chart_params
+
+    try:
+        params = parse_chart_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    compact = request.args.get('format') == 'compact'
+
+    def build_payload():
+        payload = {'temperature_chart': build_temperature_chart(params, compact)}
+        return compact_payload(payload, params) if compact else payload
+
+    try:
+        key = f"temperature|{sorted(params.items())}|{compact}|{datetime.now().date()}"
+        return conditional_json(db.session, key, build_payload)
+    except Exception as e:
+        logger.error(f"Error generating temperature chart data: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/chart-data/readings')
+def chart_data_readings():
+    """Logger temperature chart data, takes the same parameters as /api/chart-data
+
+    bucket may also be minute or hour. The data comes from the coarsest of
+    the daily rollups, hourly rollups and raw readings that still covers the
+    window at the requested resolution, reported as resolution.source.
+    """
+    from chart_series import parse_chart_params, READING_BUCKETS
+
+    try:
+        params = parse_chart_params(request.args, READING_BUCKETS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    compact = request.args.get('format') == 'compact'
+
+    def build_payload():
+        readings, source = temperature_rollups.chart_rows(db.session, params, db.engine.dialect.name)
+        resolution = dict(params, source=source)
+        chart = temperature_chart_payload(readings, resolution, compact)
+        payload = {'temperature_chart': chart}
+        return compact_payload(payload, resolution) if compact else payload
+
+    try:
+        # Readings arrive continuously and are not part of the data version,
+        # so concurrent requests share one result for the coalescing TTL
+        key = f"readings|{sorted(params.items())}|{compact}"
+        return jsonify(coalesced(key, build_payload))
+    except Exception as e:
+        logger.error(f"Error generating reading chart data: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/chart-data/maintenance-counts')
+def chart_data_maintenance_counts():
+    """Maintenance log counts per pump"""
+    compact = request.args.get('format') == 'compact'
+
+    def build_payload():
+        payload = {'maintenance_chart': build_maintenance_chart(compact)}
+        return compact_payload(payload) if compact else payload
+
+    try:
+        return conditional_json(db.session, f"maintenance-counts|{compact}", build_payload)
+    except Exception as e:
+        logger.error(f"Error generating maintenance chart data: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/chart-data/hall-of-fame')
+def chart_data_hall_of_fame():
+    """Hall of Fame scores for pump owners"""
+    try:
+        return conditional_json(db.session, "hall-of-fame", lambda: {'hall_of_fame': calculate_hall_of_fame()})
+    except Exception as e:
+        logger.error(f"Error generating Hall of Fame: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.errorhandler(500)
 def internal_error(error):
     flash(f"An error occurred: {str(error)}", "danger")
@@ -1286,5 +2212,30 @@ if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
 with app.app_context():
     db.create_all()
 
+    # Add columns introduced since the tables were created, move the text
+    # columns the lookup ids replaced into the lookup tables (the columns
+    # stay until schema_migrations.py is run to drop them), then number the
+    # rows that have no change sequence yet
+    from schema_migrations import run_migrations
+    run_migrations(db.engine)
+    backfill_lookups(db.engine)
+    backfill_eligibility(db.engine)
+    backfill_coverage_bits(db.engine)
+    ensure_search_index(db.engine)
+    # Key logs by ISO week before numbering changes, as relabelled logs are renumbered
+    try:
+        if backfill_week_keys(db.engine, MaintenanceLog.__table__, [WorkWeekSummary.__table__]):
+            with db.engine.begin() as connection:
+                rebuild_week_summaries(connection)
+    except Exception as e:
+        logger.error(f"Error assigning week keys: {e}")
+    try:
+        backfill_change_seqs(db.engine)
+    except Exception as e:
+        logger.error(f"Error assigning change sequence numbers: {e}")
+    backfill_equipment_stats(db.engine)
+    backfill_attention(db.engine)
+    backfill_week_summaries(db.engine)
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -2,6 +2,7 @@
 Authentication module for the Vacuum Pump Maintenance application
 """
 import os
+import hmac
 import json
 import logging
 import sys
@@ -164,6 +165,37 @@ def setup_auth(app):
             flash(f'Login error: {str(e)}', 'danger')
             return redirect(url_for('index'))
 
+    # Add load-test login route, only when a load-test token is configured.
+    # It is never registered on Render so it cannot be enabled in production.
+    load_test_token = os.environ.get('LOAD_TEST_TOKEN', '')
+    if load_test_token and not os.environ.get('RENDER'):
+        logger.warning("LOAD_TEST_TOKEN is set, /load-test/login bypasses Google OAuth")
+
+        @app.route('/load-test/login', methods=['POST'])
+        def load_test_login():
+            """Log in a test user without Google OAuth for local load testing"""
+            token = request.headers.get('X-Load-Test-Token', '')
+            if not hmac.compare_digest(token, load_test_token):
+                return jsonify({'status': 'error', 'message': 'Invalid load-test token'}), 403
+
+            user_name = request.form.get('name', 'Load Test User')
+            user_email = request.form.get('email') or f"{user_name.lower().replace(' ', '.')}@loadtest.local"
+            user = User(id=f"loadtest:{user_email}", email=user_email, name=user_name)
+
+            # Store user in session
+            if 'users' not in session:
+                session['users'] = {}
+
+            session['users'][user.id] = {
+                'id': user.id,
+                'email': user.email,
+                'name': user.name,
+                'picture': user.picture
+            }
+
+            login_user(user)
+            return jsonify({'status': 'success', 'user': user.email, 'admin': is_admin_email(user.email)})
+
     # Add admin required decorator
     def admin_required(f):
         @wraps(f)
@@ -258,6 +290,13 @@ def is_allowed_email(email):
         logger.error(f"Error checking email domain: {e}")
         return False
 
+def bearer_token_matches(expected_token):
+    """Check the request's Authorization: Bearer header against a configured API token"""
+    header = request.headers.get('Authorization', '')
+    if not expected_token or not header.startswith('Bearer '):
+        return False
+    return hmac.compare_digest(header[len('Bearer '):].strip(), expected_token)
+
 def is_admin_email(email):
     """Check if email is an admin email"""
     # Get admin emails from environment variable
@@ -0,0 +1,405 @@
+"""
+Live change events for the Vacuum Pump Maintenance application
+
+Every committed insert, update or delete of a maintenance log writes a
+compact event row to change_event in the same transaction. A broker thread
+in each worker picks new rows up and fans them out to the Server-Sent
+Events streams of that worker. On PostgreSQL the transaction also sends a
+NOTIFY so brokers wake up as soon as it commits; the broker still polls
+in case notifications are not delivered (for example through a
+transaction-mode connection pooler). On SQLite the broker only polls.
+
+Each stream holds a request thread, so the streams of a worker are capped.
+A client turned away is told to retry after a random few seconds, and
+while clients are being turned away the streams that end tell their
+browsers to wait longer than that before reconnecting, so the open slots
+pass to the waiting clients instead of going back to the same holders.
+Events older than CHANGE_EVENTS_RETENTION_HOURS are pruned after commits
+that publish events, whether or not anyone is listening.
+"""
+import os
+import json
+import time
+import queue
+import random
+import select
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from flask import Response, request, jsonify
+from flask_login import login_required
+from sqlalchemy import event, inspect, func
+from sqlalchemy.orm import Session
+from lookups import stored_attribute
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'vpm_change_events'
+
+# Maintenance log fields sent to clients
+EVENT_FIELDS = (
+    'check_date', 'user_name', 'oil_level_ok', 'oil_condition_ok',
+    'oil_filter_ok', 'pump_temp', 'service', 'service_notes'
+)
+
+# Events newer than this may still be overtaken by a slower transaction
+# that got a lower event_id, so they are re-read until they settle
+SETTLE_SECONDS = 10
+
+# Events returned per broker fetch and per stream replay
+FETCH_LIMIT = 500
+
+# Seconds between deletions of expired events in each worker
+PRUNE_INTERVAL = 3600
+
+# Session.info flag set when a flush published events
+PUBLISHED_FLAG = 'change_events_published'
+
+# Reconnect delays in milliseconds: a client turned away retries after
+# REFUSED_RETRY, and while clients are turned away an ending stream makes
+# its browser wait YIELD_RETRY so the waiting clients get the slot first.
+# Both are spread at random so clients do not come back together.
+RECONNECT_RETRY = (2000, 4000)
+REFUSED_RETRY = (2000, 8000)
+YIELD_RETRY = (10000, 20000)
+
+_change_event = None
+_log_model = None
+_last_prune = 0.0
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+def _log_event(event_type, equipment_id, work_week, log_id=None, fields=None, change_seq=None):
+    return {
+        'type': event_type,
+        'equipment_id': equipment_id,
+        'work_week': work_week,
+        'log_id': log_id,
+        'change_seq': change_seq,
+        'fields': {name: _json_value(value) for name, value in (fields or {}).items()}
+    }
+
+def publish_events(session, events):
+    """Write change events in the session's transaction
+
+    Bulk operations such as bulk_insert_mappings skip the flush events, so
+    code using them must publish their events itself.
+    """
+    if not events or _change_event is None:
+        return
+
+    session.info[PUBLISHED_FLAG] = True
+    connection = session.connection()
+    now = datetime.utcnow()
+    connection.execute(_change_event.insert(), [{
+        'created_at': now,
+        'event_type': item['type'],
+        'equipment_id': item['equipment_id'],
+        'work_week': item['work_week'],
+        'payload': json.dumps(item)
+    } for item in events])
+
+    if connection.dialect.name == 'postgresql':
+        # Delivered to listeners when the transaction commits
+        connection.exec_driver_sql(f"NOTIFY {NOTIFY_CHANNEL}")
+
+def log_row_events(rows, event_type='log_saved'):
+    """Build change events from maintenance log row dicts, as used by the bulk saves"""
+    return [
+        _log_event(event_type, row.get('equipment_id'), row.get('work_week'), row.get('log_id'),
+                   {name: row[name] for name in EVENT_FIELDS if name in row}, row.get('change_seq'))
+        for row in rows
+    ]
+
+def _flush_events(session):
+    """Collect change events for the maintenance logs in a flush"""
+    events = []
+    for obj in session.new:
+        if isinstance(obj, _log_model):
+            fields = {name: getattr(obj, name) for name in EVENT_FIELDS}
+            events.append(_log_event('log_saved', obj.equipment_id, obj.work_week, obj.log_id, fields, obj.change_seq))
+
+    for obj in session.dirty:
+        if not isinstance(obj, _log_model):
+            continue
+        state = inspect(obj)
+        fields = {
+            name: getattr(obj, name) for name in EVENT_FIELDS
+            if state.attrs[stored_attribute(_log_model, name)].history.has_changes()
+        }
+        if fields:
+            events.append(_log_event('log_saved', obj.equipment_id, obj.work_week, obj.log_id, fields, obj.change_seq))
+
+    for obj in session.deleted:
+        if isinstance(obj, _log_model):
+            events.append(_log_event('log_deleted', obj.equipment_id, obj.work_week, obj.log_id))
+    return events
+
+def prune_events(engine, retention_hours):
+    """Delete events older than retention_hours, at most once per PRUNE_INTERVAL in each worker"""
+    global _last_prune
+    if time.time() - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = time.time()
+    cutoff = datetime.utcnow() - timedelta(hours=retention_hours)
+    try:
+        with engine.begin() as connection:
+            connection.execute(_change_event.delete().where(_change_event.c.created_at < cutoff))
+    except Exception as e:
+        logger.error(f"Error pruning change events: {e}")
+
+def _retry_ms(bounds):
+    return random.randint(*bounds)
+
+def _format_event(event_id, payload):
+    return f"id: {event_id}\nevent: change\ndata: {payload}\n\n"
+
+class ChangeBroker:
+    """Fans change events out to the event streams of this worker"""
+    def __init__(self, engine, table, poll_interval=2.0, max_streams=16):
+        self.engine = engine
+        self.table = table
+        self.poll_interval = poll_interval
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._thread = None
+        self._settled_id = None
+        self._recent = {}
+        self._last_refused = 0.0
+
+    def subscribe(self):
+        """Get a queue receiving (event_id, payload) tuples, or None when at capacity"""
+        with self._lock:
+            if len(self._subscribers) >= self.max_streams:
+                self._last_refused = time.time()
+                return None
+            subscriber = queue.Queue(maxsize=FETCH_LIMIT)
+            self._subscribers.add(subscriber)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='change-broker', daemon=True)
+                self._thread.start()
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def turning_away(self, within):
+        """Whether a client was refused a stream in the last `within` seconds"""
+        return time.time() - self._last_refused < within
+
+    def fetch_since(self, event_id, limit=FETCH_LIMIT):
+        """Get stored events newer than event_id, oldest first"""
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                self.table.select()
+                .where(self.table.c.event_id > event_id)
+                .order_by(self.table.c.event_id)
+                .limit(limit)
+            ).fetchall()
+        return [(row.event_id, row.payload) for row in rows]
+
+    def _latest_id(self):
+        with self.engine.connect() as connection:
+            return connection.execute(func.max(self.table.c.event_id).select()).scalar() or 0
+
+    def _deliver(self):
+        now = time.time()
+        for event_id, payload in self.fetch_since(self._settled_id):
+            if event_id in self._recent:
+                continue
+            self._recent[event_id] = now
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for subscriber in subscribers:
+                try:
+                    subscriber.put_nowait((event_id, payload))
+                except queue.Full:
+                    # A stream that cannot keep up is closed, its client reconnects
+                    self.unsubscribe(subscriber)
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+                    subscriber.put_nowait((None, None))
+
+        # Events seen long enough ago can no longer be overtaken
+        settled = [event_id for event_id, seen_at in self._recent.items() if now - seen_at > SETTLE_SECONDS]
+        if settled:
+            self._settled_id = max(self._settled_id, max(settled))
+            for event_id in settled:
+                del self._recent[event_id]
+
+    def _listen_connection(self):
+        """Open a dedicated LISTEN connection on PostgreSQL, None elsewhere"""
+        if self.engine.dialect.name != 'postgresql':
+            return None
+        try:
+            connection = self.engine.raw_connection()
+            # Keep this connection out of the pool for the life of the worker
+            connection.detach()
+            connection.connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            cursor.close()
+            return connection.connection
+        except Exception as e:
+            logger.warning(f"Could not LISTEN for change events, polling instead: {e}")
+            return None
+
+    def _wait(self, listen_connection):
+        if listen_connection is None:
+            time.sleep(self.poll_interval)
+            return listen_connection
+        try:
+            select.select([listen_connection], [], [], self.poll_interval)
+            listen_connection.poll()
+            listen_connection.notifies.clear()
+            return listen_connection
+        except Exception as e:
+            logger.warning(f"Lost change event LISTEN connection, polling instead: {e}")
+            return None
+
+    def _run(self):
+        listen_connection = self._listen_connection()
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    # Start from the latest event again when the next stream opens
+                    self._thread = None
+                    self._settled_id = None
+                    self._recent = {}
+                    break
+            try:
+                if self._settled_id is None:
+                    self._settled_id = self._latest_id()
+                self._deliver()
+            except Exception as e:
+                logger.error(f"Error delivering change events: {e}")
+            listen_connection = self._wait(listen_connection)
+
+        if listen_connection is not None:
+            try:
+                listen_connection.close()
+            except Exception:
+                pass
+
+def setup_change_events(app, db, change_event_model, log_model):
+    """Publish maintenance log changes and serve them at /api/events"""
+    global _change_event, _log_model
+    _change_event = change_event_model.__table__
+    _log_model = log_model
+
+    app.config.setdefault('CHANGE_EVENTS_POLL_INTERVAL', float(os.environ.get('CHANGE_EVENTS_POLL_INTERVAL', '2')))
+    app.config.setdefault('CHANGE_EVENTS_RETENTION_HOURS', float(os.environ.get('CHANGE_EVENTS_RETENTION_HOURS', '24')))
+    # Streams hold a request thread each, mostly asleep on their queue, so
+    # half of the worker's threads (WEB_THREADS, passed to gunicorn as
+    # --threads) go to them unless SSE_MAX_STREAMS says otherwise
+    web_threads = int(os.environ.get('WEB_THREADS', '32'))
+    app.config.setdefault('SSE_MAX_STREAMS', int(os.environ.get('SSE_MAX_STREAMS', max(1, web_threads // 2))))
+    app.config.setdefault('SSE_STREAM_SECONDS', float(os.environ.get('SSE_STREAM_SECONDS', '55')))
+    app.config.setdefault('SSE_HEARTBEAT_SECONDS', float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15')))
+
+    brokers = {}
+
+    def get_broker():
+        engine = db.engine
+        broker = brokers.get(id(engine))
+        if broker is None:
+            broker = ChangeBroker(
+                engine, _change_event,
+                poll_interval=app.config['CHANGE_EVENTS_POLL_INTERVAL'],
+                max_streams=app.config['SSE_MAX_STREAMS']
+            )
+            brokers[id(engine)] = broker
+        return broker
+
+    @event.listens_for(Session, "after_flush")
+    def publish_flushed_logs(session, flush_context):
+        try:
+            publish_events(session, _flush_events(session))
+        except Exception as e:
+            logger.error(f"Error publishing change events: {e}")
+            raise
+
+    @event.listens_for(Session, "after_commit")
+    def prune_after_publishing(session):
+        if session.info.pop(PUBLISHED_FLAG, None):
+            prune_events(db.engine, app.config['CHANGE_EVENTS_RETENTION_HOURS'])
+
+    @event.listens_for(Session, "after_rollback")
+    def clear_published(session):
+        session.info.pop(PUBLISHED_FLAG, None)
+
+    @app.route('/api/events')
+    @login_required
+    def change_event_stream():
+        """Server-Sent Events stream of maintenance log changes
+
+        Streams end after SSE_STREAM_SECONDS so a worker thread is never held
+        for long; browsers reconnect and send Last-Event-ID to resume.
+        """
+        broker = get_broker()
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_event_id = None
+
+        subscriber = broker.subscribe()
+        if subscriber is None:
+            retry_ms = _retry_ms(REFUSED_RETRY)
+            response = jsonify({"error": "Too many open event streams, try again later", "retry_ms": retry_ms})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(-(-retry_ms // 1000))
+            return response
+
+        try:
+            replay = broker.fetch_since(last_event_id) if last_event_id is not None else []
+        except Exception as e:
+            broker.unsubscribe(subscriber)
+            logger.error(f"Error replaying change events: {e}")
+            return jsonify({"error": str(e)}), 500
+
+        stream_seconds = app.config['SSE_STREAM_SECONDS']
+        heartbeat_seconds = app.config['SSE_HEARTBEAT_SECONDS']
+
+        def stream():
+            sent = set()
+            try:
+                yield f"retry: {_retry_ms(RECONNECT_RETRY)}\n\n"
+                for event_id, payload in replay:
+                    sent.add(event_id)
+                    yield _format_event(event_id, payload)
+
+                deadline = time.time() + stream_seconds
+                while True:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        event_id, payload = subscriber.get(timeout=min(heartbeat_seconds, remaining))
+                    except queue.Empty:
+                        yield ": keep-alive\n\n"
+                        continue
+                    if event_id is None:
+                        break
+                    if event_id not in sent:
+                        yield _format_event(event_id, payload)
+                if broker.turning_away(stream_seconds):
+                    # Let the clients turned away take this slot
+                    yield f"retry: {_retry_ms(YIELD_RETRY)}\n\n"
+            finally:
+                broker.unsubscribe(subscriber)
+
+        return Response(stream(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+
+    return get_broker
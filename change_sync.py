@@ -0,0 +1,288 @@
+"""
+Delta sync for clients and integrations of the Vacuum Pump Maintenance
+application
+
+Every insert or update of a synced row (equipment and maintenance logs)
+stamps it with the next value of a single change counter, and every delete
+leaves a tombstone with its own value. The counter row is updated inside
+the writing transaction, so concurrent writers queue on its row lock and
+sequence numbers become visible in order: once a consumer has seen
+sequence N, nothing at or below N can appear later.
+
+/api/changes?since=<cursor> returns the changes after a cursor as NDJSON,
+one change per line, followed by a line with the next cursor:
+
+    {"seq": 41, "entity": "maintenance_log", "op": "upsert", "id": 7, "data": {...}}
+    {"seq": 42, "entity": "equipment", "op": "delete", "id": 3}
+    {"seq": 43, "entity": "maintenance_log", "op": "reset"}
+    {"cursor": 43, "has_more": false}
+
+A reset means every row of that entity with a lower sequence was removed
+in bulk (for example by a database restore), so the consumer should drop
+them. Start with since=0 to get a full copy.
+"""
+import os
+import json
+import logging
+from datetime import datetime
+from itertools import count
+from flask import Response, request, jsonify
+from flask_login import current_user
+from auth import bearer_token_matches
+from sqlalchemy import event, inspect, func, select, bindparam
+from sqlalchemy.orm import Session
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Name of the single row of the change counter table
+COUNTER_NAME = 'changes'
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 5000
+
+_sequence = None
+_tombstone = None
+_synced_models = {}
+
+def _advance_counter(connection, amount, name=COUNTER_NAME):
+    """Add amount to a counter, the change counter by default, and return its new value
+
+    The update holds the counter row lock until the transaction ends.
+    """
+    statement = (
+        _sequence.update()
+        .where(_sequence.c.name == name)
+        .values(value=_sequence.c.value + amount)
+    )
+    if getattr(connection.dialect, 'full_returning', False):
+        # One round trip on PostgreSQL
+        value = connection.execute(statement.returning(_sequence.c.value)).scalar()
+        if value is not None:
+            return value
+        connection.execute(_sequence.insert().values(name=name, value=amount))
+        return amount
+
+    result = connection.execute(statement)
+    if result.rowcount == 0:
+        connection.execute(_sequence.insert().values(name=name, value=amount))
+        return amount
+    return connection.execute(select(_sequence.c.value).where(_sequence.c.name == name)).scalar()
+
+def next_counter_values(connection, name, amount):
+    """Reserve amount consecutive values of another named counter, returning the first
+
+    Values start at 0. Writers queue on the counter row like they do on the
+    change counter, so no value is handed out twice.
+    """
+    return _advance_counter(connection, amount, name) - amount
+
+def next_change_seqs(session, amount):
+    """Reserve amount consecutive change sequence numbers in the session's transaction
+
+    Returns the first of them. Bulk operations such as bulk_insert_mappings
+    skip the flush events, so code using them must put change_seq values
+    from here into its rows itself.
+    """
+    return _advance_counter(session.connection(), amount) - amount + 1
+
+def stamp_rows(connection, table, keys):
+    """Give the rows of a synced table with these primary keys the next change sequence numbers
+
+    For bulk UPDATE statements, which skip the flush that stamps changed
+    rows. connection can be a session, to run the update through it.
+    """
+    if not keys:
+        return
+    keys = sorted(keys)
+    counter_connection = connection if hasattr(connection, 'dialect') else connection.connection()
+    first = _advance_counter(counter_connection, len(keys)) - len(keys) + 1
+    primary_key = list(table.primary_key.columns)[0]
+    connection.execute(
+        table.update().where(primary_key == bindparam('row_key')).values(change_seq=bindparam('row_seq')),
+        [{'row_key': key, 'row_seq': change_seq} for change_seq, key in enumerate(keys, start=first)]
+    )
+
+def write_resets(connection, entities):
+    """Record that every row of these synced entities was removed in bulk
+
+    Consumers drop the rows they hold with a lower sequence number when
+    they read the reset. For deletes that skip the flush, such as the
+    --replace load of generate_fleet_data.py.
+    """
+    entities = sorted(set(entities) & set(_synced_models))
+    if not entities:
+        return
+    first = _advance_counter(connection, len(entities)) - len(entities) + 1
+    now = datetime.utcnow()
+    connection.execute(_tombstone.insert(), [
+        {'change_seq': change_seq, 'entity': entity, 'entity_id': None, 'deleted_at': now}
+        for change_seq, entity in enumerate(entities, start=first)
+    ])
+
+def get_change_head(connection):
+    """Highest change sequence number committed so far"""
+    return connection.execute(select(_sequence.c.value).where(_sequence.c.name == COUNTER_NAME)).scalar() or 0
+
+def backfill_change_seqs(engine):
+    """Give rows written outside the ORM, such as bulk loads, a change sequence
+
+    Rows without one get the counter plus their primary key, so the numbers
+    are distinct and above everything already handed out.
+    """
+    with engine.begin() as connection:
+        base = _advance_counter(connection, 0)
+        filled = 0
+        for table_name in sorted(_synced_models):
+            table = _synced_models[table_name].__table__
+            primary_key = list(table.primary_key.columns)[0]
+            highest = connection.execute(
+                select(func.max(primary_key)).where(table.c.change_seq.is_(None))
+            ).scalar()
+            if highest is None:
+                continue
+            result = connection.execute(
+                table.update().where(table.c.change_seq.is_(None)).values(change_seq=primary_key + base)
+            )
+            filled += result.rowcount
+            base += highest
+        if filled:
+            connection.execute(
+                _sequence.update().where(_sequence.c.name == COUNTER_NAME).values(value=base)
+            )
+            logger.info(f"Assigned change sequence numbers to {filled} rows")
+    return filled
+
+def _stamp_flush(session):
+    """Stamp changed synced objects and record tombstones for deleted ones"""
+    synced = tuple(_synced_models.values())
+    changed = [obj for obj in session.new if isinstance(obj, synced)]
+    changed.extend(
+        obj for obj in session.dirty
+        if isinstance(obj, synced) and session.is_modified(obj, include_collections=False)
+    )
+    deleted = [obj for obj in session.deleted if isinstance(obj, synced)]
+    if not changed and not deleted:
+        return
+
+    seqs = count(next_change_seqs(session, len(changed) + len(deleted)))
+    for obj in changed:
+        obj.change_seq = next(seqs)
+
+    if deleted:
+        now = datetime.utcnow()
+        session.connection().execute(_tombstone.insert(), [{
+            'change_seq': next(seqs),
+            'entity': obj.__table__.name,
+            'entity_id': inspect(obj).identity[0],
+            'deleted_at': now
+        } for obj in deleted])
+
+def read_changes(session, since, limit):
+    """Get (changes, cursor, has_more) for up to limit changes after since
+
+    Only changes up to the committed head are read, so a transaction that
+    commits while the page is being read cannot leave a gap behind the
+    returned cursor.
+    """
+    head = get_change_head(session.connection())
+    candidates = []
+
+    for entity, model in _synced_models.items():
+        rows = model.query.filter(model.change_seq > since, model.change_seq <= head) \
+            .order_by(model.change_seq).limit(limit + 1).all()
+        primary_key = inspect(model).primary_key[0].name
+        candidates.extend({
+            'seq': row.change_seq,
+            'entity': entity,
+            'op': 'upsert',
+            'id': getattr(row, primary_key),
+            'data': row.to_dict()
+        } for row in rows)
+
+    tombstones = session.execute(
+        select(_tombstone)
+        .where(_tombstone.c.change_seq > since, _tombstone.c.change_seq <= head)
+        .order_by(_tombstone.c.change_seq)
+        .limit(limit + 1)
+    ).fetchall()
+    for tombstone in tombstones:
+        change = {'seq': tombstone.change_seq, 'entity': tombstone.entity}
+        if tombstone.entity_id is None:
+            change['op'] = 'reset'
+        else:
+            change['op'] = 'delete'
+            change['id'] = tombstone.entity_id
+        candidates.append(change)
+
+    candidates.sort(key=lambda change: change['seq'])
+    changes = candidates[:limit]
+    has_more = len(candidates) > limit
+    if has_more:
+        cursor = changes[-1]['seq']
+    else:
+        # Everything up to the head has been returned
+        cursor = max(since, head)
+    return changes, cursor, has_more
+
+def setup_change_sync(app, db, sequence_model, tombstone_model, synced_models):
+    """Stamp synced models with change sequence numbers and serve /api/changes"""
+    global _sequence, _tombstone
+    _sequence = sequence_model.__table__
+    _tombstone = tombstone_model.__table__
+    for model in synced_models:
+        _synced_models[model.__table__.name] = model
+
+    app.config.setdefault('CHANGES_API_TOKEN', os.environ.get('CHANGES_API_TOKEN', ''))
+
+    @event.listens_for(Session, "before_flush")
+    def stamp_flushed_changes(session, flush_context, instances):
+        try:
+            _stamp_flush(session)
+        except Exception as e:
+            logger.error(f"Error stamping change sequence numbers: {e}")
+            raise
+
+    @event.listens_for(Session, "do_orm_execute")
+    def record_bulk_deletes(orm_execute_state):
+        # Query.delete() bypasses the flush, and the deleted ids are unknown,
+        # so consumers are told to drop everything older instead
+        if not orm_execute_state.is_delete:
+            return
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None and table.name in _synced_models:
+            write_resets(orm_execute_state.session.connection(), [table.name])
+
+    @app.route('/api/changes')
+    def changes():
+        """Changes to equipment and maintenance logs after a cursor, as NDJSON
+
+        Accessible to signed-in users, or to integrations sending
+        CHANGES_API_TOKEN as a bearer token.
+        """
+        if not (bearer_token_matches(app.config['CHANGES_API_TOKEN']) or current_user.is_authenticated or app.config.get('LOGIN_DISABLED')):
+            return jsonify({"error": "Authentication required"}), 401
+
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"error": "since and limit must be integers"}), 400
+        if since < 0:
+            return jsonify({"error": "since must not be negative"}), 400
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        try:
+            changes, cursor, has_more = read_changes(db.session, since, limit)
+        except Exception as e:
+            logger.error(f"Error reading changes since {since}: {e}")
+            return jsonify({"error": str(e)}), 500
+
+        lines = [json.dumps(change) for change in changes]
+        lines.append(json.dumps({'cursor': cursor, 'has_more': has_more}))
+        response = Response('\n'.join(lines) + '\n', mimetype='application/x-ndjson')
+        response.headers['X-Next-Cursor'] = str(cursor)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    return _sequence
@@ -0,0 +1,199 @@
+"""
+Time-series helpers for the dashboard charts
+
+Readings are bucketed by day, week or month in SQL and each series is then
+downsampled with Largest-Triangle-Three-Buckets (LTTB), which keeps the
+visual shape of a line while capping the number of points per series. The
+compact format sends the series as sparse, delta-encoded columns instead of
+padded Chart.js datasets.
+"""
+import logging
+from datetime import date, datetime
+from sqlalchemy import func
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+BUCKETS = ('day', 'week', 'month')
+# Logger readings can also be charted by the minute or hour
+READING_BUCKETS = ('minute', 'hour') + BUCKETS
+AGGREGATES = {
+    'avg': func.avg,
+    'min': func.min,
+    'max': func.max
+}
+
+DEFAULT_WINDOW_DAYS = 60
+MAX_WINDOW_DAYS = 3660
+DEFAULT_MAX_POINTS = 200
+MAX_POINTS_LIMIT = 2000
+
+# Version of the compact chart payload, bumped whenever its layout changes
+COMPACT_FORMAT_VERSION = 2
+COMPACT_VALUE_SCALE = 100
+
+def parse_chart_params(args, buckets=BUCKETS):
+    """Read and validate the chart resolution parameters from a request
+
+    Returns a dict with window (days), bucket, agg and max_points, or raises
+    ValueError with a message suitable for the client.
+    """
+    try:
+        window = int(args.get('window', DEFAULT_WINDOW_DAYS))
+        max_points = int(args.get('max_points', DEFAULT_MAX_POINTS))
+    except (TypeError, ValueError):
+        raise ValueError('window and max_points must be integers')
+
+    bucket = args.get('bucket', 'day')
+    agg = args.get('agg', 'avg')
+    if bucket not in buckets:
+        raise ValueError(f"bucket must be one of: {', '.join(buckets)}")
+    if agg not in AGGREGATES:
+        raise ValueError(f"agg must be one of: {', '.join(AGGREGATES)}")
+
+    return {
+        'window': max(1, min(window, MAX_WINDOW_DAYS)),
+        'bucket': bucket,
+        'agg': agg,
+        'max_points': max(3, min(max_points, MAX_POINTS_LIMIT))
+    }
+
+def bucket_expression(column, bucket, dialect_name):
+    """SQL expression truncating a date column to the start of its bucket
+
+    The result is a 'YYYY-MM-DD' string on every dialect, or 'YYYY-MM-DD
+    HH:MM' for minute and hour buckets, so buckets can be used as chart
+    labels directly. Weeks start on Monday.
+    """
+    if dialect_name == 'postgresql':
+        label_format = 'YYYY-MM-DD HH24:MI' if bucket in ('minute', 'hour') else 'YYYY-MM-DD'
+        return func.to_char(func.date_trunc(bucket, column), label_format)
+
+    # SQLite
+    if bucket == 'minute':
+        return func.strftime('%Y-%m-%d %H:%M', column)
+    if bucket == 'hour':
+        return func.strftime('%Y-%m-%d %H:00', column)
+    if bucket == 'week':
+        return func.date(column, 'weekday 0', '-6 days')
+    if bucket == 'month':
+        return func.strftime('%Y-%m-01', column)
+    return func.date(column)
+
+def aggregate_expression(column, agg):
+    """SQL aggregate for a bucket of readings"""
+    return AGGREGATES[agg](column)
+
+def label_ordinal(label):
+    """Day number of a 'YYYY-MM-DD' bucket label, used as the x value for LTTB
+
+    Labels with a time of day give a fractional day number.
+    """
+    if isinstance(label, datetime):
+        return label.toordinal() + (label.hour * 60 + label.minute) / 1440
+    if isinstance(label, date):
+        return label.toordinal()
+    if len(label) >= 16:
+        moment = datetime.strptime(label[:16], '%Y-%m-%d %H:%M')
+        return moment.toordinal() + (moment.hour * 60 + moment.minute) / 1440
+    return datetime.strptime(label[:10], '%Y-%m-%d').toordinal()
+
+def lttb(points, threshold):
+    """Downsample (x, y, ...) points to at most threshold points with LTTB
+
+    The first and last points are always kept. Points are returned unchanged,
+    so extra fields such as the bucket label travel with them.
+    """
+    count = len(points)
+    if threshold >= count or threshold < 3:
+        return list(points)
+
+    sampled = [points[0]]
+    every = (count - 2) / (threshold - 2)
+    selected = 0
+
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third corner of the triangle
+        average_start = int((i + 1) * every) + 1
+        average_end = min(int((i + 2) * every) + 1, count)
+        average_points = points[average_start:average_end]
+        average_x = sum(p[0] for p in average_points) / len(average_points)
+        average_y = sum(p[1] for p in average_points) / len(average_points)
+
+        # Pick the point in this bucket forming the largest triangle
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        selected_x, selected_y = points[selected][0], points[selected][1]
+        max_area = -1.0
+        next_selected = range_start
+        for j in range(range_start, range_end):
+            area = abs(
+                (selected_x - average_x) * (points[j][1] - selected_y)
+                - (selected_x - points[j][0]) * (average_y - selected_y)
+            )
+            if area > max_area:
+                max_area = area
+                next_selected = j
+
+        sampled.append(points[next_selected])
+        selected = next_selected
+
+    sampled.append(points[-1])
+    return sampled
+
+def build_series(rows, max_points):
+    """Group (name, label, value) rows into downsampled series
+
+    Returns (labels, series) where labels is the sorted union of the bucket
+    labels that survived downsampling and series maps each name to a
+    {label: value} dict, in the order the names first appear in rows.
+    """
+    points_by_name = {}
+    for name, label, value in rows:
+        if value is None:
+            continue
+        points_by_name.setdefault(name, []).append((label_ordinal(label), float(value), label))
+
+    labels = set()
+    series = {}
+    for name, points in points_by_name.items():
+        points.sort(key=lambda p: p[0])
+        kept = lttb(points, max_points)
+        series[name] = {p[2]: round(p[1], 2) for p in kept}
+        labels.update(series[name])
+
+    return sorted(labels), series
+
+def delta_encode(values):
+    """Replace each integer after the first with its difference from the previous one"""
+    encoded = []
+    previous = 0
+    for value in values:
+        encoded.append(value - previous)
+        previous = value
+    return encoded
+
+def encode_compact_series(labels, series):
+    """Encode series as a shared label array plus sparse, delta-encoded columns
+
+    Series are stored column-wise: 'names' holds the series names and, at the
+    same position, 'i' the label indexes and 'v' the values multiplied by
+    'scale' of the points that series has. Both are delta-encoded so runs of
+    similar readings become small integers. Styling is left to the client.
+    """
+    positions = {label: index for index, label in enumerate(labels)}
+    names = []
+    indexes = []
+    values = []
+    for name, series_values in series.items():
+        points = sorted((positions[label], value) for label, value in series_values.items())
+        names.append(name)
+        indexes.append(delta_encode([index for index, _ in points]))
+        values.append(delta_encode([int(round(value * COMPACT_VALUE_SCALE)) for _, value in points]))
+    return {
+        't': labels,
+        'scale': COMPACT_VALUE_SCALE,
+        'names': names,
+        'i': indexes,
+        'v': values
+    }
@@ -0,0 +1,257 @@
+"""
+Query-count budget check for every route in app.py
+
+Seeds an in-memory SQLite database at several scales, requests each route
+through the Flask test client and counts the SQL statements it issues. The
+check fails when a route exceeds its budget in query_budgets.json or when its
+statement count grows with the size of the database, which is how an N+1
+query pattern shows up.
+
+Usage:
+    python check_query_budgets.py            # check against the budget file
+    python check_query_budgets.py --update   # rewrite budgets from this run
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+# Always run against a private in-memory database, never the configured one
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ['SUPABASE_DB_HOST'] = ''
+os.environ['SUPABASE_DB_PASSWORD'] = ''
+os.environ.setdefault('SLOW_QUERY_LOG', 'false')
+# Readings are written by ?flush=true only, so the background flusher and
+# its retention runs never add statements to another route's count
+os.environ['READINGS_FLUSH_SECONDS'] = '3600'
+os.environ['READINGS_FLUSH_ROWS'] = str(10 ** 9)
+# Anomaly scores are only read by the routes, keep their refresher off the database
+os.environ['ANOMALY_BACKGROUND_REFRESH'] = 'false'
+
+from app import app, db, MaintenanceLog, get_work_week
+from query_monitor import QueryCounter
+from generate_fleet_data import generate_equipment, iter_maintenance_logs, bulk_load, is_eligible
+
+logger = logging.getLogger(__name__)
+
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_budgets.json')
+
+# Database sizes the routes are checked at: (name, copies of the seed fleet, years of logs)
+SCALES = [
+    ('small', 1, 0.25),
+    ('medium', 4, 1),
+    ('large', 16, 2)
+]
+
+USER_NAME = 'Mfg (Jonathan)'
+
+def weekly_log_form(context):
+    """Form data for a full weekly log submission"""
+    form = {'check_date': context['today'], 'user_name': USER_NAME}
+    for equipment_id in context['equipment_ids']:
+        key = f"equipment_{equipment_id}"
+        form[f"{key}_oil_level_ok"] = 'on'
+        form[f"{key}_pump_temp"] = '72.5'
+        form[f"{key}_service"] = 'None Required'
+    return form
+
+def equipment_log_form(context):
+    """Form data for a single row saved from the weekly log"""
+    return {
+        'check_date': context['today'],
+        'user_name': USER_NAME,
+        'oil_level_ok': 'on',
+        'pump_temp': '74.0',
+        'service': 'Add Oil',
+        'service_notes': 'Topped up'
+    }
+
+def weekly_log_rows_json(context):
+    """JSON body for a batch of rows saved through the weekly log row API"""
+    return {'rows': [{
+        'equipment_id': equipment_id,
+        'check_date': context['today'],
+        'user_name': USER_NAME,
+        'oil_level_ok': True,
+        'pump_temp': '73.5',
+        'service': 'None Required'
+    } for equipment_id in context['equipment_ids'][:5]]}
+
+def weekly_log_sync_json(context):
+    """JSON body for an offline sync batch of new logs for the current week"""
+    return {'rows': [{
+        'equipment_id': equipment_id,
+        'work_week': context['work_week'],
+        'base_change_seq': None,
+        'check_date': context['today'],
+        'user_name': USER_NAME,
+        'oil_level_ok': True,
+        'pump_temp': '71.0'
+    } for equipment_id in context['equipment_ids'][5:10]]}
+
+def weekly_log_row_json(context):
+    """JSON body for a single row saved through the weekly log row API"""
+    return dict(equipment_log_form(context), equipment_id=context['equipment_id'], oil_level_ok=True,
+                pump_temp='75.5', service_notes='Checked again')
+
+def readings_json(context):
+    """JSON body for a batch of temperature readings from a logger"""
+    ts = datetime.utcnow().replace(microsecond=0)
+    return [[equipment_id, (ts - timedelta(minutes=minute)).isoformat(), 70.0 + minute / 10]
+            for equipment_id in context['equipment_ids'][:10] for minute in range(10)]
+
+# (name, method, path template, body builder, expected status); POST sends a
+# form, POST_JSON a JSON body
+ROUTES = [
+    ('dashboard', 'GET', '/dashboard', None, 200),
+    ('equipment_list', 'GET', '/equipment', None, 200),
+    ('equipment_detail', 'GET', '/equipment/{equipment_id}', None, 200),
+    ('weekly_log', 'GET', '/weekly-log?work_week={work_week}', None, 200),
+    ('weekly_log_post', 'POST', '/weekly-log?work_week={past_work_week}', weekly_log_form, 302),
+    ('maintenance_logs', 'GET', '/maintenance/logs', None, 200),
+    ('maintenance_logs_week', 'GET', '/maintenance/logs?work_week={work_week}', None, 200),
+    ('edit_maintenance_log', 'GET', '/maintenance/log/{log_id}/edit', None, 200),
+    ('chart_data', 'GET', '/api/chart-data', None, 200),
+    ('chart_data_temperature', 'GET', '/api/chart-data/temperature?format=compact', None, 200),
+    ('chart_data_maintenance_counts', 'GET', '/api/chart-data/maintenance-counts', None, 200),
+    ('chart_data_hall_of_fame', 'GET', '/api/chart-data/hall-of-fame', None, 200),
+    ('dropdown_options_pump_owner', 'GET', '/api/dropdown-options/pump_owner', None, 200),
+    ('dropdown_options_service', 'GET', '/api/dropdown-options/service', None, 200),
+    ('dropdown_options_user_name', 'GET', '/api/dropdown-options/user_name', None, 200),
+    ('save_equipment_log', 'POST', '/save_equipment_log/{equipment_id}/{past_work_week}', equipment_log_form, 302),
+    ('changes', 'GET', '/api/changes?since=0&limit=500', None, 200),
+    ('weekly_log_row', 'POST_JSON', '/api/weekly-log/{past_work_week}/rows', weekly_log_row_json, 200),
+    ('weekly_log_rows_batch', 'POST_JSON', '/api/weekly-log/{work_week}/rows', weekly_log_rows_json, 200),
+    ('weekly_log_sync', 'POST_JSON', '/api/weekly-log/sync', weekly_log_sync_json, 200),
+    ('readings', 'POST_JSON', '/api/readings?flush=true', readings_json, 202),
+    ('chart_data_readings', 'GET', '/api/chart-data/readings?window=7&bucket=hour', None, 200),
+    ('anomalies', 'GET', '/api/anomalies', None, 200),
+    ('needs_attention', 'GET', '/api/needs-attention?sort=repeat_oil_count', None, 200),
+    ('compliance_trend', 'GET', '/api/compliance-trend?weeks=520', None, 200),
+    ('week_coverage', 'GET', '/api/week-coverage?weeks=52', None, 200),
+    ('calendar_weeks', 'GET', '/api/calendar-weeks', None, 200),
+    ('search', 'GET', '/api/search?q=oil', None, 200),
+    ('export_logs_csv', 'GET', '/api/export/logs.csv?work_week={work_week}', None, 200),
+    ('export_logs_xlsx', 'GET', '/api/export/logs.xlsx?work_week={work_week}', None, 200)
+]
+
+def seed_database(scale, years, seed=42):
+    """Create a fresh schema and fill it with a generated fleet"""
+    db.drop_all()
+    db.create_all()
+
+    equipment_rows = generate_equipment(scale, seed)
+    result = bulk_load(db.engine, equipment_rows, iter_maintenance_logs(equipment_rows, years, seed))
+
+    today = datetime.now().date()
+    eligible_ids = [e['equipment_id'] for e in equipment_rows if is_eligible(e)]
+    return {
+        'today': today.strftime('%Y-%m-%d'),
+        'work_week': get_work_week(today),
+        # Writes go to last week, which is complete apart from the pumps nobody checked
+        'past_work_week': get_work_week(today - timedelta(weeks=1)),
+        'equipment_id': eligible_ids[0],
+        'equipment_ids': eligible_ids,
+        'log_id': db.session.query(db.func.min(MaintenanceLog.log_id)).scalar(),
+        'equipment_count': result['equipment_count'],
+        'log_count': result['logs_count']
+    }
+
+def measure_routes(client, context):
+    """Request every route once and return its statement count"""
+    counts = {}
+    failures = []
+    for name, method, path, form_builder, expected_status in ROUTES:
+        url = path.format(**context)
+        data = form_builder(context) if form_builder else None
+
+        with QueryCounter() as counter:
+            if method == 'POST':
+                response = client.post(url, data=data)
+            elif method == 'POST_JSON':
+                # The database is rebuilt for every scale, so the key is new each time
+                response = client.post(url, json=data, headers={'Idempotency-Key': name})
+            else:
+                response = client.get(url)
+            # Streamed bodies run their queries as they are read
+            response.get_data()
+
+        counts[name] = counter.count
+        if response.status_code != expected_status:
+            failures.append(f"{name}: expected HTTP {expected_status}, got {response.status_code} for {method} {url}")
+    return counts, failures
+
+def load_budgets():
+    if not os.path.exists(BUDGET_FILE):
+        return {}
+    with open(BUDGET_FILE, 'r') as f:
+        return json.load(f).get('routes', {})
+
+def save_budgets(results):
+    budgets = {}
+    for name, _, _, _, _ in ROUTES:
+        budgets[name] = max(scale_counts[name] for scale_counts in results.values())
+    with open(BUDGET_FILE, 'w') as f:
+        json.dump({
+            'description': 'Maximum SQL statements per request, checked by check_query_budgets.py',
+            'routes': budgets
+        }, f, indent=2)
+        f.write('\n')
+    return budgets
+
+def run_checks(update=False):
+    """Measure every route at every scale and compare against the budgets"""
+    app.config['TESTING'] = True
+    app.config['LOGIN_DISABLED'] = True
+    app.config['SLOW_QUERY_LOG'] = False
+    # Measure the real work of every request, not a shared cached result
+    app.config['COALESCE_ENABLED'] = False
+
+    results = {}
+    failures = []
+    with app.app_context():
+        for scale_name, scale, years in SCALES:
+            context = seed_database(scale, years)
+            with app.test_client() as client:
+                counts, scale_failures = measure_routes(client, context)
+            results[scale_name] = counts
+            failures.extend(f"[{scale_name}] {failure}" for failure in scale_failures)
+            print(f"Scale {scale_name}: {context['equipment_count']} equipment, {context['log_count']} logs")
+
+    scale_names = [scale[0] for scale in SCALES]
+    print()
+    print(f"{'route':<32}" + ''.join(f"{name:>8}" for name in scale_names) + f"{'budget':>8}")
+
+    budgets = save_budgets(results) if update else load_budgets()
+    for name, _, _, _, _ in ROUTES:
+        counts = [results[scale][name] for scale in scale_names]
+        budget = budgets.get(name)
+        print(f"{name:<32}" + ''.join(f"{count:>8}" for count in counts) + f"{budget if budget is not None else '-':>8}")
+
+        if counts[-1] > counts[0]:
+            failures.append(f"{name}: statement count grows with data size ({' -> '.join(str(c) for c in counts)})")
+        if budget is None:
+            failures.append(f"{name}: no budget in {os.path.basename(BUDGET_FILE)}")
+        elif max(counts) > budget:
+            failures.append(f"{name}: {max(counts)} statements exceeds budget of {budget}")
+
+    print()
+    if failures:
+        print("Query budget check FAILED:")
+        for failure in failures:
+            print(f"  - {failure}")
+        return False
+
+    print("Query budget check passed")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check per-route SQL statement budgets')
+    parser.add_argument('--update', action='store_true', help='rewrite query_budgets.json from this run')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    success = run_checks(update=args.update)
+    sys.exit(0 if success else 1)
@@ -0,0 +1,133 @@
+"""
+Data versions and conditional GET support for the Vacuum Pump Maintenance
+API endpoints
+
+Every flush that inserts, updates or deletes a tracked row bumps that
+table's counter in table_version inside the same transaction, so a rolled
+back change never bumps it. A data version combines those counters with
+row counts and the highest primary keys, which also catches rows changed
+outside the application, such as a bulk load or a manual restore.
+"""
+import hashlib
+import logging
+from datetime import datetime
+from flask import request, jsonify, make_response
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from werkzeug.http import is_resource_modified
+from single_flight import coalesced
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+_table_version = None
+_tracked_tables = {}
+
+def bump_table_versions(session, table_names):
+    """Increment the change counters of the given tables in the session's transaction
+
+    Bulk operations such as bulk_insert_mappings skip the flush events, so
+    code using them must call this itself. session can also be a
+    connection, for writes made outside the ORM.
+    """
+    table_names = sorted(set(table_names) & set(_tracked_tables))
+    if not table_names or _table_version is None:
+        return
+
+    connection = session if hasattr(session, 'dialect') else session.connection()
+    now = datetime.utcnow()
+    for table_name in table_names:
+        result = connection.execute(
+            _table_version.update()
+            .where(_table_version.c.table_name == table_name)
+            .values(version=_table_version.c.version + 1, updated_at=now)
+        )
+        if result.rowcount == 0:
+            connection.execute(_table_version.insert().values(table_name=table_name, version=1, updated_at=now))
+
+def _changed_tables(session):
+    tables = set()
+    for obj in session.new | session.deleted:
+        tables.add(obj.__table__.name)
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            tables.add(obj.__table__.name)
+    return tables
+
+def get_data_version(session):
+    """Get (token, last modified time) describing the current tracked data
+
+    Runs a single statement: the summed change counters and their latest
+    update time, plus the row count and highest primary key of each tracked
+    table.
+    """
+    columns = [
+        select(func.coalesce(func.sum(_table_version.c.version), 0)).scalar_subquery(),
+        select(func.max(_table_version.c.updated_at)).scalar_subquery()
+    ]
+    for table_name in sorted(_tracked_tables):
+        table = _tracked_tables[table_name]
+        primary_key = list(table.primary_key.columns)[0]
+        columns.append(select(func.count()).select_from(table).scalar_subquery())
+        columns.append(select(func.max(primary_key)).scalar_subquery())
+
+    row = session.execute(select(*columns)).one()
+    last_modified = row[1]
+    if isinstance(last_modified, str):
+        # SQLite returns aggregates of DateTime columns as plain strings
+        last_modified = datetime.fromisoformat(last_modified)
+    token = '-'.join(str(value) for index, value in enumerate(row) if index != 1)
+    return token, last_modified
+
+def conditional_json(session, key, build_payload, modified_at=None):
+    """Return a JSON response that honors If-None-Match and If-Modified-Since
+
+    key identifies the representation (endpoint and parameters). When the
+    client already has the current version a 304 is returned without
+    calling build_payload. Otherwise concurrent requests for the same key
+    and data version share a single build_payload call. Responses built
+    from data outside the tracked tables put its version in key and its
+    last change in modified_at.
+    """
+    token, last_modified = get_data_version(session)
+    if modified_at is not None and (last_modified is None or modified_at > last_modified):
+        last_modified = modified_at
+    etag = hashlib.sha1(f"{key}|{token}".encode('utf-8')).hexdigest()[:20]
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response('', 304)
+    else:
+        response = jsonify(coalesced(f"{key}|{token}", build_payload))
+
+    # Weak because the body may be compressed on the way out
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Let browsers keep the response but revalidate it on every use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def setup_data_versions(table_version_model, tracked_models):
+    """Bump table versions whenever tracked models change through the session"""
+    global _table_version
+    _table_version = table_version_model.__table__
+    for model in tracked_models:
+        _tracked_tables[model.__table__.name] = model.__table__
+
+    @event.listens_for(Session, "after_flush")
+    def bump_flushed_tables(session, flush_context):
+        try:
+            bump_table_versions(session, _changed_tables(session))
+        except Exception as e:
+            logger.error(f"Error bumping table versions: {e}")
+            raise
+
+    @event.listens_for(Session, "do_orm_execute")
+    def bump_bulk_statement_tables(orm_execute_state):
+        # Query.delete() and Query.update() bypass the flush
+        if orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = getattr(orm_execute_state.statement, 'table', None)
+            if table is not None:
+                bump_table_versions(orm_execute_state.session, [table.name])
+
+    return _table_version
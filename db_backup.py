@@ -45,7 +45,8 @@ def backup_database():
                 'oil_type': item.oil_type,
                 'pump_owner': item.pump_owner,
                 'status': item.status,
-                'notes': item.notes
+                'notes': item.notes,
+                'created_at': item.created_at.isoformat() if item.created_at else None
             })
         backup_data['tables']['equipment'] = equipment_list
         logger.info(f"Backed up {len(equipment_list)} equipment records")
@@ -111,8 +112,15 @@ def restore_database(backup_file):
         
         # Restore Equipment table
         equipment_count = 0
+        undated = []
         if 'equipment' in backup_data['tables']:
             for item_data in backup_data['tables']['equipment']:
+                if item_data.get('created_at'):
+                    item_data['created_at'] = datetime.datetime.fromisoformat(item_data['created_at'])
+                else:
+                    # Backups from before added dates were kept
+                    item_data.pop('created_at', None)
+                    undated.append(item_data['equipment_id'])
                 item = Equipment(**item_data)
                 db.session.add(item)
                 equipment_count += 1
@@ -129,6 +137,13 @@ def restore_database(backup_file):
                 db.session.add(log)
                 logs_count += 1
         
+        if undated:
+            # Left without a date instead of the model's default, the time of the restore
+            db.session.flush()
+            db.session.execute(
+                Equipment.__table__.update().where(Equipment.equipment_id.in_(undated)).values(created_at=None)
+            )
+
         # Commit transaction
         db.session.commit()
         
@@ -1,71 +1,26 @@
 """
 Direct database initialization script for Render deployment.
-This script directly creates and populates the SQLite database.
+This script directly creates and populates the application's database.
+Rows are saved through the app's models, which create the current schema
+and write the lookup ids, change sequence numbers and summaries.
 """
-import os
 import sys
-import sqlite3
 from datetime import datetime, timedelta
 import random
 
-# Use the database in the current directory for simplicity
-db_dir = os.path.abspath(os.path.dirname(__file__))
-db_path = os.path.join(db_dir, "vacuum_pump_maintenance.db")
-print(f"Database path: {db_path}")
+from app import app, db, Equipment, MaintenanceLog
 
-# Check if database already exists and has data
-try:
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Check if equipment table exists and has data
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='equipment'")
-    if cursor.fetchone():
-        cursor.execute("SELECT COUNT(*) FROM equipment")
-        count = cursor.fetchone()[0]
+with app.app_context():
+    # Check if database already has data
+    try:
+        count = Equipment.query.count()
         if count > 0:
             print(f"Database already contains {count} equipment records. Setup skipped.")
-            conn.close()
             sys.exit(0)
-except Exception as e:
-    print(f"Error checking database: {e}")
-    # Continue with setup even if there was an error checking
-
-# Create tables
-print("Creating database tables...")
-conn = sqlite3.connect(db_path)
-cursor = conn.cursor()
-
-# Create equipment table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS equipment (
-    equipment_id INTEGER PRIMARY KEY,
-    equipment_name TEXT NOT NULL,
-    pump_model TEXT,
-    oil_type TEXT,
-    pump_owner TEXT,
-    status TEXT DEFAULT 'active',
-    notes TEXT
-)
-''')
-
-# Create maintenance_log table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS maintenance_log (
-    log_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    equipment_id INTEGER NOT NULL,
-    work_week TEXT NOT NULL,
-    check_date DATE NOT NULL,
-    user_name TEXT,
-    oil_level_ok BOOLEAN,
-    oil_condition_ok BOOLEAN,
-    oil_filter_ok BOOLEAN,
-    pump_temp REAL,
-    service TEXT,
-    service_notes TEXT,
-    FOREIGN KEY (equipment_id) REFERENCES equipment (equipment_id) ON DELETE CASCADE
-)
-''')
+    except Exception as e:
+        print(f"Error checking database: {e}")
+        # Continue with setup even if there was an error checking
+        db.session.rollback()
 
 # Sample equipment data (equipment_id, equipment_name, pump_model, oil_type, pump_owner, status, notes)
 equipment_data = [
@@ -83,10 +38,11 @@ equipment_data = [
 
 # Insert equipment data
 print("Inserting equipment data...")
-cursor.executemany(
-    "INSERT INTO equipment (equipment_id, equipment_name, pump_model, oil_type, pump_owner, status, notes) VALUES (?, ?, ?, ?, ?, ?, ?)",
-    equipment_data
-)
+equipment_rows = [
+    dict(equipment_id=equipment_id, equipment_name=name, pump_model=model, oil_type=oil,
+         pump_owner=owner, status=status, notes=notes)
+    for equipment_id, name, model, oil, owner, status, notes in equipment_data
+]
 
 # Generate work weeks for the past 8 weeks
 today = datetime.now()
@@ -103,17 +59,17 @@ print("Generating maintenance logs...")
 services = ["None Required", "Add Oil", "Drain & Replace Oil", "Replace Filter", "Clean Pump", "Major Service"]
 maintenance_logs = []
 
-for equipment_id, _, _, _, _ in equipment_data:
+for equipment_id, *_ in equipment_data:
     for i, work_week in enumerate(work_weeks):
         # Skip some entries to make data more realistic
         if random.random() < 0.2:
             continue
 
         # Generate random data
-        check_date = (today - timedelta(weeks=i, days=random.randint(0, 6))).strftime('%Y-%m-%d')
-        oil_level_ok = 1 if random.random() > 0.2 else 0
-        oil_condition_ok = 1 if random.random() > 0.2 else 0
-        oil_filter_ok = 1 if random.random() > 0.2 else 0
+        check_date = (today - timedelta(weeks=i, days=random.randint(0, 6))).date()
+        oil_level_ok = random.random() > 0.2
+        oil_condition_ok = random.random() > 0.2
+        oil_filter_ok = random.random() > 0.2
         pump_temp = random.uniform(60, 85)
 
         # Determine service based on conditions
@@ -126,32 +82,25 @@ for equipment_id, _, _, _, _ in equipment_data:
         else:
             service = random.choice(services)
 
-        maintenance_logs.append((
-            equipment_id,
-            work_week,
-            check_date,
-            "System",
-            oil_level_ok,
-            oil_condition_ok,
-            oil_filter_ok,
-            pump_temp,
-            service,
-            "Initial setup data"
+        maintenance_logs.append(dict(
+            equipment_id=equipment_id,
+            work_week=work_week,
+            check_date=check_date,
+            user_name="System",
+            oil_level_ok=oil_level_ok,
+            oil_condition_ok=oil_condition_ok,
+            oil_filter_ok=oil_filter_ok,
+            pump_temp=pump_temp,
+            service=service,
+            service_notes="Initial setup data"
         ))
 
 # Insert maintenance logs
-cursor.executemany(
-    """
-    INSERT INTO maintenance_log
-    (equipment_id, work_week, check_date, user_name, oil_level_ok, oil_condition_ok, oil_filter_ok, pump_temp, service, service_notes)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """,
-    maintenance_logs
-)
-
-# Commit changes and close connection
-conn.commit()
+with app.app_context():
+    db.session.add_all([Equipment(**row) for row in equipment_rows])
+    db.session.flush()
+    db.session.add_all([MaintenanceLog(**row) for row in maintenance_logs])
+    db.session.commit()
 print(f"Inserted {len(equipment_data)} equipment records and {len(maintenance_logs)} maintenance logs.")
-conn.close()
 
 print("Database initialization completed successfully!")
@@ -0,0 +1,227 @@
+"""
+Which pumps are part of the weekly log
+
+Scroll pumps need no oil checks and spares are not running, so neither is
+listed on the weekly log or counted against compliance. What keeps a pump
+off the weekly log is configurable in eligibility_rule: each active rule
+names a field, oil_type or equipment_name, and text that excludes the pump
+when found anywhere in that field, ignoring case.
+
+The outcome is stored in the indexed equipment.is_eligible flag, so routes
+filter on the flag instead of scanning every pump's name and oil type with
+leading-wildcard ILIKE patterns. The flag is set whenever equipment is
+added or renamed or its oil type changes, and recomputed for every pump in
+one statement when the rules change. Rows written outside the app, by the
+standalone seed scripts for instance, get theirs on the next start.
+"""
+import logging
+from datetime import datetime
+from flask import request, jsonify
+from sqlalchemy import event, select, func, or_, not_, true
+from sqlalchemy.orm import Session
+from lookups import stored_attribute
+from change_sync import stamp_rows
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+RULE_FIELDS = ('oil_type', 'equipment_name')
+
+# Rules a new database starts with
+DEFAULT_RULES = [
+    {'field': 'oil_type', 'pattern': 'scroll', 'description': 'Scroll pumps need no oil checks'},
+    {'field': 'equipment_name', 'pattern': 'spare', 'description': 'Spares are not running'}
+]
+
+_rule_table = None
+_equipment_model = None
+
+def weekly_log_filter(equipment_model):
+    """SQL condition matching the equipment the weekly log lists"""
+    return equipment_model.is_eligible == true()
+
+def is_eligible(rules, equipment_name, oil_type):
+    """Whether a pump is on the weekly log under rules, a list of (field, pattern)"""
+    values = {'equipment_name': (equipment_name or '').lower(), 'oil_type': (oil_type or '').lower()}
+    return not any(pattern.lower() in values[field] for field, pattern in rules)
+
+def eligible_expression(equipment_model, rules):
+    """SQL computing is_eligible under rules, a list of (field, pattern)"""
+    exclusions = [
+        func.lower(func.coalesce(getattr(equipment_model, field), '')).contains(pattern.lower(), autoescape=True)
+        for field, pattern in rules
+    ]
+    return not_(or_(*exclusions)) if exclusions else true()
+
+def load_rules(connection):
+    """(field, pattern) of every active rule; connection can be a session"""
+    return [
+        (field, pattern) for field, pattern in connection.execute(
+            select(_rule_table.c.field, _rule_table.c.pattern)
+            .where(_rule_table.c.active == true())
+            .order_by(_rule_table.c.rule_id)
+        )
+    ]
+
+def refresh_eligibility(connection, rules=None):
+    """Recompute is_eligible for every pump whose flag is missing or out of date
+
+    Finds the pumps to change, updates them in one statement and gives them
+    new change sequence numbers so /api/changes clients receive the flag.
+    Returns the number of pumps that changed. Run it through the session to
+    have the change picked up by the data version and work week summaries.
+    """
+    rules = load_rules(connection) if rules is None else rules
+    equipment = _equipment_model.__table__
+    computed = eligible_expression(_equipment_model, rules)
+    changed = [equipment_id for equipment_id, in connection.execute(
+        select(equipment.c.equipment_id)
+        .where(or_(equipment.c.is_eligible.is_(None), equipment.c.is_eligible != computed))
+    )]
+    if not changed:
+        return 0
+    connection.execute(
+        equipment.update().where(equipment.c.equipment_id.in_(changed)).values(is_eligible=computed)
+    )
+    stamp_rows(connection, equipment, changed)
+    return len(changed)
+
+def _rule_input(data, rule=None):
+    """Validated (field, pattern, description, active) from a request, or raise ValueError"""
+    field = data.get('field', rule.field if rule else None)
+    pattern = (data.get('pattern', rule.pattern if rule else '') or '').strip()
+    description = data.get('description', rule.description if rule else None)
+    active = data.get('active', rule.active if rule else True)
+    if field not in RULE_FIELDS:
+        raise ValueError(f"field must be one of {', '.join(RULE_FIELDS)}")
+    if not pattern:
+        raise ValueError("pattern must not be empty")
+    if len(pattern) > 100:
+        raise ValueError("pattern must be at most 100 characters")
+    if isinstance(active, str):
+        active = active.lower() in ('1', 'true', 'yes', 'on')
+    return field, pattern, description, bool(active)
+
+def setup_eligibility(app, db, rule_model, equipment_model):
+    """Keep equipment.is_eligible current and register the eligibility rule routes"""
+    global _rule_table, _equipment_model
+    _rule_table = rule_model.__table__
+    _equipment_model = equipment_model
+
+    @event.listens_for(Session, "before_flush")
+    def set_eligibility(session, flush_context, instances):
+        changed = [obj for obj in session.new if isinstance(obj, _equipment_model)]
+        for obj in session.dirty:
+            if isinstance(obj, _equipment_model):
+                state = obj._sa_instance_state
+                if any(state.attrs[stored_attribute(_equipment_model, field)].history.has_changes() for field in RULE_FIELDS):
+                    changed.append(obj)
+        if changed:
+            with session.no_autoflush:
+                rules = load_rules(session)
+            for obj in changed:
+                obj.is_eligible = is_eligible(rules, obj.equipment_name, obj.oil_type)
+
+    def rules_payload():
+        rules = rule_model.query.order_by(rule_model.rule_id).all()
+        eligible = db.session.query(func.count(equipment_model.equipment_id)).filter(
+            weekly_log_filter(equipment_model)
+        ).scalar()
+        return {'rules': [rule.to_dict() for rule in rules], 'eligible_pumps': eligible}
+
+    def save_rules(message):
+        db.session.flush()
+        updated = refresh_eligibility(db.session)
+        db.session.commit()
+        return jsonify(dict(
+            rules_payload(),
+            status="success",
+            message=message,
+            updated_pumps=updated,
+            timestamp=datetime.now().isoformat()
+        ))
+
+    @app.route('/admin/eligibility-rules')
+    @app.admin_required
+    def eligibility_rules():
+        """The rules that keep pumps off the weekly log, and how many pumps it lists"""
+        try:
+            return jsonify(rules_payload())
+        except Exception as e:
+            logger.error(f"Error loading eligibility rules: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/admin/eligibility-rules', methods=['POST'])
+    @app.admin_required
+    def add_eligibility_rule():
+        """Add a rule from JSON or form fields field, pattern, description and active"""
+        try:
+            field, pattern, description, active = _rule_input(request.get_json(silent=True) or request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            db.session.add(rule_model(field=field, pattern=pattern, description=description, active=active))
+            return save_rules(f"Added rule excluding {field} containing '{pattern}'")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error adding eligibility rule: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/admin/eligibility-rules/<int:rule_id>', methods=['PATCH'])
+    @app.admin_required
+    def update_eligibility_rule(rule_id):
+        """Change a rule's field, pattern, description or active flag"""
+        rule = db.session.get(rule_model, rule_id)
+        if rule is None:
+            return jsonify({"error": f"No eligibility rule {rule_id}"}), 404
+        try:
+            rule.field, rule.pattern, rule.description, rule.active = _rule_input(
+                request.get_json(silent=True) or request.form, rule
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            return save_rules(f"Updated rule {rule_id}")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error updating eligibility rule: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/admin/eligibility-rules/<int:rule_id>', methods=['DELETE'])
+    @app.admin_required
+    def delete_eligibility_rule(rule_id):
+        """Remove a rule, putting the pumps only it excluded back on the weekly log"""
+        rule = db.session.get(rule_model, rule_id)
+        if rule is None:
+            return jsonify({"error": f"No eligibility rule {rule_id}"}), 404
+        try:
+            db.session.delete(rule)
+            return save_rules(f"Deleted rule {rule_id}")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error deleting eligibility rule: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    return _rule_table
+
+def backfill_eligibility(engine):
+    """Add the default rules to a new database and set every pump's flag
+
+    The defaults are added whenever eligibility_rule is empty, so deleting
+    every rule brings them back on the next start; deactivate rules to list
+    every pump instead. Safe to run on every start.
+    """
+    try:
+        with engine.begin() as connection:
+            if connection.execute(select(_rule_table.c.rule_id).limit(1)).first() is None:
+                now = datetime.utcnow()
+                connection.execute(_rule_table.insert(), [dict(rule, active=True, created_at=now) for rule in DEFAULT_RULES])
+                logger.info(f"Added {len(DEFAULT_RULES)} default eligibility rules")
+            updated = refresh_eligibility(connection)
+        if updated:
+            logger.info(f"Set the weekly log eligibility of {updated} pumps")
+        return updated
+    except Exception as e:
+        # Usually another worker filled the table first
+        logger.warning(f"Eligibility backfill skipped: {e}")
+        return 0
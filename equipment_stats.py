@@ -0,0 +1,415 @@
+"""
+Running statistics of each pump's maintenance history
+
+equipment_stats holds one row per pump with its number of logs, the count,
+mean and sum of squared deviations of its temperatures (Welford), its first
+and last check dates, its last service and its number of oil services.
+Every flush that adds, edits or deletes maintenance logs updates the rows
+of the pumps involved in the same transaction, so pages can show
+history-aware figures without reading the logs.
+
+Adding a log and changing a temperature are applied incrementally. Removing
+a log that was a pump's first or last check or its last service needs a
+look at the other logs, so that pump is recomputed from its logs instead.
+Bulk deletes with Query.delete() do not say which logs went away and make
+the commit rebuild every pump.
+"""
+import logging
+from datetime import date, datetime
+from sqlalchemy import event, func, select, case, bindparam
+from sqlalchemy.orm import Session
+from upserts import upsert_rows, lock_keys
+from lookups import name_in, name_key, lookup_join, lookup_fields, previous_name
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+LOG_FIELDS = ('equipment_id', 'check_date', 'pump_temp', 'service')
+OIL_SERVICES = ('Add Oil', 'Drain & Replace Oil')
+NO_SERVICES = ('', 'None Required')
+
+# Session.info flag set by bulk deletes of maintenance logs
+REBUILD_FLAG = 'equipment_stats_rebuild'
+# Session.info set of pumps to recompute once the flush has written their logs
+RECOMPUTE_KEY = 'equipment_stats_recompute'
+
+_stats_table = None
+_log_table = None
+_log_model = None
+_equipment_model = None
+
+def welford_add(count, mean, m2, value):
+    """Add a value to a running (count, mean, sum of squared deviations)"""
+    count += 1
+    delta = value - (mean or 0.0)
+    mean = (mean or 0.0) + delta / count
+    m2 += delta * (value - mean)
+    return count, mean, m2
+
+def welford_remove(count, mean, m2, value):
+    """Take a value back out of a running (count, mean, sum of squared deviations)"""
+    if count <= 1:
+        return 0, None, 0.0
+    new_mean = (count * mean - value) / (count - 1)
+    m2 -= (value - mean) * (value - new_mean)
+    return count - 1, new_mean, max(m2, 0.0)
+
+def is_service(service):
+    # In any case, as name_in matches them in SQL
+    return name_key(service) not in {name_key(value) for value in NO_SERVICES}
+
+def is_oil_service(service):
+    return service is not None and name_key(service) in {name_key(value) for value in OIL_SERVICES}
+
+def _empty_stats(equipment_id):
+    return {
+        'equipment_id': equipment_id,
+        'log_count': 0,
+        'temp_count': 0,
+        'temp_mean': None,
+        'temp_m2': 0.0,
+        'first_check_date': None,
+        'last_check_date': None,
+        'last_service': None,
+        'last_service_date': None,
+        'oil_add_count': 0
+    }
+
+def _add_log(stats, log):
+    stats['log_count'] += 1
+    if log['pump_temp'] is not None:
+        stats['temp_count'], stats['temp_mean'], stats['temp_m2'] = welford_add(
+            stats['temp_count'], stats['temp_mean'], stats['temp_m2'], log['pump_temp'])
+
+    check_date = log['check_date']
+    if check_date is not None:
+        if stats['first_check_date'] is None or check_date < stats['first_check_date']:
+            stats['first_check_date'] = check_date
+        if stats['last_check_date'] is None or check_date > stats['last_check_date']:
+            stats['last_check_date'] = check_date
+        if is_service(log['service']) and (stats['last_service_date'] is None or check_date >= stats['last_service_date']):
+            stats['last_service'] = log['service']
+            stats['last_service_date'] = check_date
+
+    if is_oil_service(log['service']):
+        stats['oil_add_count'] += 1
+
+def _remove_log(stats, log):
+    """Remove a log from stats, returning False when the pump must be recomputed"""
+    if stats['log_count'] <= 0:
+        return False
+    check_date = log['check_date']
+    if check_date in (stats['first_check_date'], stats['last_check_date']):
+        return False
+    if is_service(log['service']) and stats['last_service_date'] is not None and check_date >= stats['last_service_date']:
+        return False
+
+    stats['log_count'] -= 1
+    if log['pump_temp'] is not None:
+        if stats['temp_count'] <= 0:
+            return False
+        stats['temp_count'], stats['temp_mean'], stats['temp_m2'] = welford_remove(
+            stats['temp_count'], stats['temp_mean'], stats['temp_m2'], log['pump_temp'])
+    if is_oil_service(log['service']):
+        stats['oil_add_count'] = max(0, stats['oil_add_count'] - 1)
+    return True
+
+def _replace_log(stats, old, new):
+    """Apply an edit that only changed a log's temperature, False if it did more"""
+    if any(old[field] != new[field] for field in ('equipment_id', 'check_date', 'service')):
+        return False
+    if old['pump_temp'] is not None:
+        if stats['temp_count'] <= 0:
+            return False
+        stats['temp_count'], stats['temp_mean'], stats['temp_m2'] = welford_remove(
+            stats['temp_count'], stats['temp_mean'], stats['temp_m2'], old['pump_temp'])
+    if new['pump_temp'] is not None:
+        stats['temp_count'], stats['temp_mean'], stats['temp_m2'] = welford_add(
+            stats['temp_count'], stats['temp_mean'], stats['temp_m2'], new['pump_temp'])
+    return True
+
+def _as_date(value):
+    # SQLite can hand back aggregates of date columns as strings
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value
+
+def _stats_row(equipment_id, now):
+    return dict(_empty_stats(equipment_id), updated_at=now)
+
+def rebuild_equipment_stats(connection, equipment_ids=None):
+    """Recompute the stats of the given pumps, or of every pump, from their logs
+
+    Takes two statements: one aggregate over the logs and one picking each
+    pump's last service with ROW_NUMBER(), then the upsert. Pumps left
+    without logs are deleted with one more. On PostgreSQL the given pumps'
+    rows are locked first, see upserts.
+    """
+    log = _log_table
+    stats_table = _stats_table
+    now = datetime.utcnow()
+    pump_filter = []
+    if equipment_ids is not None:
+        equipment_ids = sorted(set(equipment_ids))
+        pump_filter = [log.c.equipment_id.in_(equipment_ids)]
+        lock_keys(connection, stats_table, 'equipment_id', equipment_ids, lambda equipment_id: _stats_row(equipment_id, now))
+
+    # The sum of squared deviations is taken from each pump's mean, as
+    # Welford's running M2 is, rather than as sum(x²) - n·mean², which
+    # loses precision to cancellation
+    means = select(
+        log.c.equipment_id, func.avg(log.c.pump_temp).label('temp_mean')
+    ).where(*pump_filter).group_by(log.c.equipment_id).subquery()
+    deviation = log.c.pump_temp - means.c.temp_mean
+    totals = connection.execute(
+        select(
+            log.c.equipment_id,
+            func.count(log.c.log_id),
+            func.count(log.c.pump_temp),
+            func.max(means.c.temp_mean),
+            func.sum(deviation * deviation),
+            func.min(log.c.check_date),
+            func.max(log.c.check_date),
+            func.sum(case((name_in(_log_model, 'service', OIL_SERVICES), 1), else_=0))
+        ).select_from(log.join(means, means.c.equipment_id == log.c.equipment_id))
+        .where(*pump_filter).group_by(log.c.equipment_id)
+    ).all()
+
+    service, service_join = lookup_join(_log_model, 'service')
+    ranked = select(
+        log.c.equipment_id,
+        service.c.name.label('service'),
+        log.c.check_date,
+        func.row_number().over(
+            partition_by=log.c.equipment_id,
+            order_by=(log.c.check_date.desc(), log.c.log_id.desc())
+        ).label('position')
+    ).select_from(log.join(service, service_join)).where(
+        ~name_in(_log_model, 'service', NO_SERVICES), *pump_filter
+    ).subquery()
+    last_services = {
+        row.equipment_id: (row.service, _as_date(row.check_date))
+        for row in connection.execute(select(ranked).where(ranked.c.position == 1))
+    }
+
+    rows = []
+    for equipment_id, log_count, temp_count, temp_mean, temp_m2, first_date, last_date, oil_count in totals:
+        temp_mean = float(temp_mean) if temp_mean is not None else None
+        temp_m2 = float(temp_m2) if temp_count else 0.0
+        last_service, last_service_date = last_services.get(equipment_id, (None, None))
+        rows.append({
+            'equipment_id': equipment_id,
+            'log_count': log_count,
+            'temp_count': temp_count,
+            'temp_mean': temp_mean,
+            'temp_m2': temp_m2,
+            'first_check_date': _as_date(first_date),
+            'last_check_date': _as_date(last_date),
+            'last_service': last_service,
+            'last_service_date': last_service_date,
+            'oil_add_count': int(oil_count or 0),
+            'updated_at': now
+        })
+
+    upsert_rows(connection, stats_table, rows, 'equipment_id')
+
+    rebuilt = [row['equipment_id'] for row in rows]
+    if equipment_ids is None:
+        connection.execute(stats_table.delete().where(stats_table.c.equipment_id.notin_(rebuilt)))
+    else:
+        emptied = sorted(set(equipment_ids) - set(rebuilt))
+        if emptied:
+            connection.execute(stats_table.delete().where(stats_table.c.equipment_id.in_(emptied)))
+    return len(rows)
+
+def apply_log_changes(connection, changes):
+    """Update the stats of the pumps touched by (old log, new log) pairs
+
+    Logs are dicts with LOG_FIELDS; old is None for an added log and new is
+    None for a deleted one. Returns the ids of the pumps that could not be
+    updated incrementally and must be recomputed once the logs are written.
+    """
+    changes = [(old, new) for old, new in changes if old != new]
+    if not changes:
+        return set()
+
+    pump_ids = set()
+    for old, new in changes:
+        for log in (old, new):
+            if log is not None:
+                pump_ids.add(log['equipment_id'])
+
+    stats_table = _stats_table
+    # Concurrent saves on the same pump would otherwise both read the row
+    # and one of their updates be lost; on PostgreSQL the rows are locked
+    # first, inserted as placeholders where missing, see upserts
+    now = datetime.utcnow()
+    lock_keys(connection, stats_table, 'equipment_id', pump_ids, lambda equipment_id: _stats_row(equipment_id, now))
+    current = {
+        row.equipment_id: dict(row._mapping)
+        for row in connection.execute(select(stats_table).where(stats_table.c.equipment_id.in_(pump_ids)))
+    }
+    updated = {}
+    recompute = set()
+    for old, new in changes:
+        if old is not None and new is not None and old['equipment_id'] not in recompute:
+            stats = updated.setdefault(old['equipment_id'], current.get(old['equipment_id']) or _empty_stats(old['equipment_id']))
+            if _replace_log(stats, old, new):
+                continue
+        if old is not None and old['equipment_id'] not in recompute:
+            stats = updated.setdefault(old['equipment_id'], current.get(old['equipment_id']) or _empty_stats(old['equipment_id']))
+            if not _remove_log(stats, old):
+                recompute.add(old['equipment_id'])
+        if new is not None and new['equipment_id'] not in recompute:
+            stats = updated.setdefault(new['equipment_id'], current.get(new['equipment_id']) or _empty_stats(new['equipment_id']))
+            _add_log(stats, new)
+
+    inserts = []
+    updates = []
+    for equipment_id, stats in updated.items():
+        if equipment_id in recompute:
+            continue
+        stats['updated_at'] = now
+        if equipment_id in current:
+            updates.append({f"new_{key}": value for key, value in stats.items()})
+        else:
+            inserts.append(stats)
+    if updates:
+        # One executemany for every pump, whatever the batch size
+        columns = [column.name for column in stats_table.columns if column.name != 'equipment_id']
+        connection.execute(
+            stats_table.update()
+            .where(stats_table.c.equipment_id == bindparam('new_equipment_id'))
+            .values({name: bindparam(f"new_{name}") for name in columns}),
+            updates
+        )
+    upsert_rows(connection, stats_table, inserts, 'equipment_id')
+    return recompute
+
+def record_log_changes(session, changes):
+    """Update equipment stats for logs already written without a flush
+
+    bulk_insert_mappings and bulk_update_mappings skip the flush events, so
+    code using them must call this itself with (old log, new log) pairs.
+    """
+    connection = session.connection()
+    recompute = apply_log_changes(connection, changes)
+    if recompute:
+        rebuild_equipment_stats(connection, recompute)
+
+def _log_values(obj, old=False):
+    """LOG_FIELDS of a maintenance log object, as flushed before or after its changes"""
+    values = {}
+    state = obj._sa_instance_state
+    names = {name for name, _, _, _ in lookup_fields(type(obj))}
+    for field in LOG_FIELDS:
+        if field in names:
+            values[field] = previous_name(obj, field) if old else getattr(obj, field)
+            continue
+        value = getattr(obj, field)
+        if old:
+            history = state.attrs[field].history
+            if history.deleted:
+                value = history.deleted[0]
+        values[field] = value
+    return values
+
+def setup_equipment_stats(stats_model, log_model, equipment_model):
+    """Keep equipment_stats current whenever logs change through the session"""
+    global _stats_table, _log_table, _log_model, _equipment_model
+    _stats_table = stats_model.__table__
+    _log_table = log_model.__table__
+    _log_model = log_model
+    _equipment_model = equipment_model
+
+    @event.listens_for(Session, "before_flush")
+    def update_stats_for_flush(session, flush_context, instances):
+        if session.info.get(REBUILD_FLAG):
+            # Rebuilt at commit anyway
+            return
+        changes = []
+        removed_pumps = []
+        respelled = {}
+        for obj in session.new:
+            if isinstance(obj, _log_model):
+                changes.append((None, _log_values(obj)))
+        for obj in session.deleted:
+            if isinstance(obj, _log_model):
+                changes.append((_log_values(obj, old=True), None))
+            elif isinstance(obj, _equipment_model):
+                removed_pumps.append(obj.equipment_id)
+        for obj in session.dirty:
+            if isinstance(obj, _log_model) and session.is_modified(obj, include_collections=False):
+                old, new = _log_values(obj, old=True), _log_values(obj)
+                changes.append((old, new))
+                if old['service'] != new['service'] and name_key(old['service']) == name_key(new['service']):
+                    # The lookup row is respelled for every log using it
+                    respelled[name_key(new['service'])] = new['service']
+
+        if not changes and not removed_pumps:
+            return
+        connection = session.connection()
+        try:
+            recompute = apply_log_changes(connection, [
+                (old, new) for old, new in changes
+                if (old or new)['equipment_id'] not in removed_pumps
+            ])
+            if recompute:
+                session.info.setdefault(RECOMPUTE_KEY, set()).update(recompute)
+            if removed_pumps:
+                connection.execute(_stats_table.delete().where(_stats_table.c.equipment_id.in_(removed_pumps)))
+            for key, spelling in respelled.items():
+                connection.execute(_stats_table.update().where(
+                    func.lower(_stats_table.c.last_service) == key
+                ).values(last_service=spelling))
+        except Exception as e:
+            logger.error(f"Error updating equipment stats: {e}")
+            raise
+
+    @event.listens_for(Session, "after_flush")
+    def recompute_flushed_pumps(session, flush_context):
+        recompute = session.info.pop(RECOMPUTE_KEY, None)
+        if recompute:
+            rebuild_equipment_stats(session.connection(), recompute)
+
+    @event.listens_for(Session, "do_orm_execute")
+    def flag_bulk_log_changes(orm_execute_state):
+        # Query.delete() and Query.update() do not say which logs changed
+        if orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = getattr(orm_execute_state.statement, 'table', None)
+            if table is not None and table.name == _log_table.name:
+                orm_execute_state.session.info[REBUILD_FLAG] = True
+
+    @event.listens_for(Session, "before_commit")
+    def rebuild_after_bulk_changes(session):
+        if session.info.get(REBUILD_FLAG):
+            session.flush()
+            session.info.pop(REBUILD_FLAG, None)
+            rebuild_equipment_stats(session.connection())
+
+    @event.listens_for(Session, "after_rollback")
+    def clear_rebuild_flag(session):
+        session.info.pop(REBUILD_FLAG, None)
+        session.info.pop(RECOMPUTE_KEY, None)
+
+    return _stats_table
+
+def backfill_equipment_stats(engine):
+    """Compute the stats of every pump when equipment_stats is still empty
+
+    Databases created before equipment_stats existed have logs but no stats.
+    Safe to run on every start and from several workers at once.
+    """
+    try:
+        with engine.begin() as connection:
+            has_stats = connection.execute(select(_stats_table.c.equipment_id).limit(1)).first()
+            has_logs = connection.execute(select(_log_table.c.log_id).limit(1)).first()
+            if has_stats or not has_logs:
+                return 0
+            count = rebuild_equipment_stats(connection)
+        logger.info(f"Computed equipment stats for {count} pumps")
+        return count
+    except Exception as e:
+        # Usually another worker filled the table first
+        logger.warning(f"Equipment stats backfill skipped: {e}")
+        return 0
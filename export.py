@@ -0,0 +1,456 @@
+"""
+CSV, NDJSON and XLSX exports of maintenance history
+
+GET /api/export/logs.csv and /api/export/logs.ndjson stream maintenance
+logs with their pump's name, model and owner, filtered like
+/maintenance/logs by work_week and equipment_id, and also by owner and by
+a from/to range of work weeks. Rows are read through a server-side cursor
+(a named cursor on PostgreSQL; SQLite steps its cursor as rows are
+fetched) EXPORT_BATCH_ROWS at a time and written out as they arrive, so an
+export holds one batch in memory however many rows it has. The CSV header
+is sent before the query runs, and rows come in log_id order, which the
+primary key serves without sorting, so the first byte arrives at once.
+
+XLSX needs the optional xlsxwriter package. A spreadsheet is only readable
+once it is complete, so GET /api/export/logs.xlsx builds exports of up to
+EXPORT_XLSX_INLINE_ROWS rows in the request, and hands larger ones to a
+background job that writes them in xlsxwriter's constant memory mode.
+The job answers 202 with its id; GET /api/export/jobs/<id> reports its
+progress and /api/export/jobs/<id>/download serves the finished file.
+Jobs keep their state and file in EXPORT_DIR, so any worker can answer
+for them, and are removed EXPORT_JOB_TTL_HOURS after they start.
+"""
+import io
+import os
+import csv
+import json
+import uuid
+import time
+import logging
+import threading
+from datetime import date, datetime
+from flask import request, jsonify, Response, send_file, url_for
+from flask_login import login_required, current_user
+from sqlalchemy import select, func
+
+# xlsxwriter is optional, XLSX exports are refused when it is not installed
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+from lookups import name_key, lookup_join
+from work_weeks import week_key
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Rows an XLSX worksheet holds, the header included
+XLSX_SHEET_ROWS = 1048576
+
+# Batches between progress updates of an XLSX job
+JOB_PROGRESS_BATCHES = 20
+
+_log_table = None
+_equipment_table = None
+_person_table = None
+# {field: (aliased lookup table, join condition)} of the exported names
+_lookup_joins = {}
+_export_dir = None
+_job_slots = None
+
+def export_columns():
+    """(name, column) of each exported field, in file order"""
+    log = _log_table
+    equipment = _equipment_table
+    return [
+        ('log_id', log.c.log_id),
+        ('work_week', log.c.work_week),
+        ('check_date', log.c.check_date),
+        ('equipment_id', log.c.equipment_id),
+        ('equipment_name', equipment.c.equipment_name),
+        ('pump_model', _lookup_joins['pump_model'][0].c.name),
+        ('pump_owner', _lookup_joins['pump_owner'][0].c.name),
+        ('user_name', _lookup_joins['user_name'][0].c.name),
+        ('oil_level_ok', log.c.oil_level_ok),
+        ('oil_condition_ok', log.c.oil_condition_ok),
+        ('oil_filter_ok', log.c.oil_filter_ok),
+        ('pump_temp', log.c.pump_temp),
+        ('service', _lookup_joins['service'][0].c.name),
+        ('service_notes', log.c.service_notes)
+    ]
+
+def export_filters(args):
+    """Filters of an export request, or raise ValueError
+
+    work_week, from and to are work weeks like 2025-WW07, equipment_id a
+    pump's id and owner a pump owner's name in any case.
+    """
+    filters = {}
+    for name in ('work_week', 'from', 'to'):
+        value = args.get(name, '')
+        if value:
+            if week_key(value) is None:
+                raise ValueError(f"{name} must be a work week like 2025-WW07")
+            filters[name] = value
+    equipment_id = args.get('equipment_id', '')
+    if equipment_id:
+        try:
+            filters['equipment_id'] = int(equipment_id)
+        except ValueError:
+            raise ValueError("equipment_id must be a whole number")
+    owner = name_key(args.get('owner'))
+    if owner:
+        filters['owner'] = owner
+    return filters
+
+def _conditions(filters):
+    log = _log_table
+    equipment = _equipment_table
+    conditions = []
+    if 'work_week' in filters:
+        conditions.append(log.c.week_key == week_key(filters['work_week']))
+    if 'from' in filters:
+        conditions.append(log.c.week_key >= week_key(filters['from']))
+    if 'to' in filters:
+        conditions.append(log.c.week_key <= week_key(filters['to']))
+    if 'equipment_id' in filters:
+        conditions.append(log.c.equipment_id == filters['equipment_id'])
+    if 'owner' in filters:
+        owner_id = select(_person_table.c.person_id).where(
+            _person_table.c.name_key == filters['owner']
+        ).scalar_subquery()
+        conditions.append(equipment.c.owner_id == owner_id)
+    return conditions
+
+def export_statement(filters):
+    """SELECT of the exported rows matching filters, in log_id order"""
+    log = _log_table
+    equipment = _equipment_table
+    joined = log.join(equipment, equipment.c.equipment_id == log.c.equipment_id)
+    for lookup, condition in _lookup_joins.values():
+        joined = joined.outerjoin(lookup, condition)
+    return (
+        select(*[column for _, column in export_columns()])
+        .select_from(joined)
+        .where(*_conditions(filters))
+        .order_by(log.c.log_id)
+    )
+
+def count_rows(connection, filters):
+    """Number of logs matching filters"""
+    log = _log_table
+    statement = select(func.count()).select_from(log)
+    if 'owner' in filters:
+        statement = statement.select_from(
+            log.join(_equipment_table, _equipment_table.c.equipment_id == log.c.equipment_id)
+        )
+    return connection.execute(statement.where(*_conditions(filters))).scalar()
+
+def iter_batches(engine, filters, batch_rows):
+    """Lists of up to batch_rows matching rows, read through a server-side cursor
+
+    The connection is held until the generator is exhausted or closed.
+    """
+    with engine.connect() as connection:
+        result = connection.execution_options(
+            stream_results=True, max_row_buffer=batch_rows
+        ).execute(export_statement(filters))
+        for rows in result.partitions(batch_rows):
+            yield rows
+
+# Leading characters that make spreadsheet programs read a cell as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def csv_cell(value):
+    """A value as written to CSV, text that could be read as a formula quoted with '
+
+    Matches the XLSX export, which writes every string as text.
+    """
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def csv_chunks(batches):
+    """CSV text of the header, then of each batch"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def drain():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    writer.writerow([name for name, _ in export_columns()])
+    yield drain()
+    for rows in batches:
+        writer.writerows([csv_cell(value) for value in row] for row in rows)
+        yield drain()
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+def ndjson_chunks(batches):
+    """One JSON object per row and line, a batch per chunk"""
+    names = [name for name, _ in export_columns()]
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(names, row)), default=_json_value) + '\n' for row in rows)
+
+def export_filename(extension):
+    return f"maintenance_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+def _attachment_headers(filename):
+    return {
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no'
+    }
+
+def write_xlsx(target, batches, constant_memory=True, on_batch=None):
+    """Write the header and batches to an XLSX workbook at target, a path or file
+
+    Rows past a worksheet's limit continue on a further sheet. on_batch is
+    called with the number of rows written so far after each batch.
+    Returns the number of rows written.
+    """
+    workbook = xlsxwriter.Workbook(target, {
+        'constant_memory': constant_memory,
+        'in_memory': not constant_memory,
+        'default_date_format': 'yyyy-mm-dd',
+        # Notes are text, whatever they start with
+        'strings_to_formulas': False,
+        'strings_to_urls': False
+    })
+    header = [name for name, _ in export_columns()]
+    sheet = None
+    sheet_count = 0
+    row_number = XLSX_SHEET_ROWS
+    written = 0
+    try:
+        for rows in batches:
+            for row in rows:
+                if row_number >= XLSX_SHEET_ROWS:
+                    sheet_count += 1
+                    sheet = workbook.add_worksheet('Logs' if sheet_count == 1 else f'Logs {sheet_count}')
+                    sheet.write_row(0, 0, header)
+                    sheet.freeze_panes(1, 0)
+                    row_number = 1
+                sheet.write_row(row_number, 0, row)
+                row_number += 1
+            written += len(rows)
+            if on_batch is not None:
+                on_batch(written)
+        if sheet is None:
+            workbook.add_worksheet('Logs').write_row(0, 0, header)
+    finally:
+        workbook.close()
+    return written
+
+def _job_path(job_id, extension):
+    return os.path.join(_export_dir, f"{job_id}.{extension}")
+
+def _save_job(job):
+    """Write a job's state where every worker can read it"""
+    path = _job_path(job['job_id'], 'json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(job, f)
+    os.replace(path + '.tmp', path)
+
+def load_job(job_id):
+    """State of an export job, or None when there is no such job"""
+    try:
+        uuid.UUID(hex=job_id)
+    except ValueError:
+        return None
+    try:
+        with open(_job_path(job_id, 'json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def remove_expired_jobs(ttl_hours):
+    """Delete the state and files of jobs started more than ttl_hours ago"""
+    cutoff = time.time() - ttl_hours * 3600
+    removed = 0
+    for filename in os.listdir(_export_dir):
+        path = os.path.join(_export_dir, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+def _run_xlsx_job(engine, job, batch_rows):
+    part_path = _job_path(job['job_id'], 'xlsx.part')
+    batches_seen = [0]
+
+    def progress(written):
+        batches_seen[0] += 1
+        if batches_seen[0] % JOB_PROGRESS_BATCHES == 0:
+            job['rows'] = written
+            _save_job(job)
+
+    try:
+        job['rows'] = write_xlsx(part_path, iter_batches(engine, job['filters'], batch_rows), on_batch=progress)
+        os.replace(part_path, _job_path(job['job_id'], 'xlsx'))
+        job['status'] = 'done'
+        logger.info(f"Export job {job['job_id']} wrote {job['rows']} rows")
+    except Exception as e:
+        logger.error(f"Error in export job {job['job_id']}: {e}")
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    finally:
+        job['finished_at'] = datetime.now().isoformat()
+        _save_job(job)
+        _job_slots.release()
+
+def _job_payload(job):
+    payload = dict(job)
+    payload['status_url'] = url_for('export_job_status', job_id=job['job_id'])
+    if job['status'] == 'done':
+        payload['download_url'] = url_for('download_export_job', job_id=job['job_id'])
+    return payload
+
+def setup_export(app, db, log_model, equipment_model, person_model):
+    """Register the maintenance log export routes"""
+    global _log_table, _equipment_table, _person_table, _export_dir, _job_slots
+    _log_table = log_model.__table__
+    _equipment_table = equipment_model.__table__
+    _person_table = person_model.__table__
+    _lookup_joins.update({
+        'pump_model': lookup_join(equipment_model, 'pump_model'),
+        'pump_owner': lookup_join(equipment_model, 'pump_owner'),
+        'user_name': lookup_join(log_model, 'user_name'),
+        'service': lookup_join(log_model, 'service')
+    })
+
+    app.config.setdefault('EXPORT_DIR', os.environ.get(
+        'EXPORT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exports')
+    ))
+    app.config.setdefault('EXPORT_BATCH_ROWS', int(os.environ.get('EXPORT_BATCH_ROWS', '1000')))
+    app.config.setdefault('EXPORT_XLSX_INLINE_ROWS', int(os.environ.get('EXPORT_XLSX_INLINE_ROWS', '20000')))
+    app.config.setdefault('EXPORT_MAX_JOBS', int(os.environ.get('EXPORT_MAX_JOBS', '2')))
+    app.config.setdefault('EXPORT_JOB_TTL_HOURS', float(os.environ.get('EXPORT_JOB_TTL_HOURS', '24')))
+    _export_dir = app.config['EXPORT_DIR']
+    _job_slots = threading.BoundedSemaphore(app.config['EXPORT_MAX_JOBS'])
+
+    def streamed_export(chunks_of, mimetype, extension):
+        try:
+            filters = export_filters(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        # Read here, the response body is produced after the request context is gone
+        engine = db.engine
+        batch_rows = app.config['EXPORT_BATCH_ROWS']
+        logger.info(f"Streaming {extension} export for {current_user.get_id()} with filters {filters}")
+        chunks = chunks_of(iter_batches(engine, filters, batch_rows))
+        return Response(chunks, mimetype=mimetype, headers=_attachment_headers(export_filename(extension)))
+
+    @app.route('/api/export/logs.csv')
+    @login_required
+    def export_logs_csv():
+        """Matching maintenance logs as CSV, streamed as they are read"""
+        return streamed_export(csv_chunks, 'text/csv', 'csv')
+
+    @app.route('/api/export/logs.ndjson')
+    @login_required
+    def export_logs_ndjson():
+        """Matching maintenance logs as one JSON object per line, streamed as they are read"""
+        return streamed_export(ndjson_chunks, 'application/x-ndjson', 'ndjson')
+
+    @app.route('/api/export/logs.xlsx')
+    @login_required
+    def export_logs_xlsx():
+        """Matching maintenance logs as a spreadsheet, or a background job for large exports"""
+        if xlsxwriter is None:
+            return jsonify({"error": "XLSX exports need the xlsxwriter package, use logs.csv instead"}), 501
+        try:
+            filters = export_filters(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        try:
+            with db.engine.connect() as connection:
+                row_count = count_rows(connection, filters)
+            batch_rows = app.config['EXPORT_BATCH_ROWS']
+
+            if row_count <= app.config['EXPORT_XLSX_INLINE_ROWS']:
+                output = io.BytesIO()
+                write_xlsx(output, iter_batches(db.engine, filters, batch_rows), constant_memory=False)
+                return Response(output.getvalue(), mimetype=XLSX_MIMETYPE,
+                                headers=_attachment_headers(export_filename('xlsx')))
+
+            if not _job_slots.acquire(blocking=False):
+                response = jsonify({"error": "Too many exports running, try again later"})
+                response.status_code = 503
+                response.headers['Retry-After'] = '60'
+                return response
+            try:
+                os.makedirs(_export_dir, exist_ok=True)
+                remove_expired_jobs(app.config['EXPORT_JOB_TTL_HOURS'])
+                job = {
+                    'job_id': uuid.uuid4().hex,
+                    'status': 'running',
+                    'filters': filters,
+                    'rows': 0,
+                    'total_rows': row_count,
+                    'filename': export_filename('xlsx'),
+                    'requested_by': current_user.get_id(),
+                    'created_at': datetime.now().isoformat(),
+                    'finished_at': None,
+                    'error': None
+                }
+                _save_job(job)
+                thread = threading.Thread(
+                    target=_run_xlsx_job, args=(db.engine, job, batch_rows),
+                    name=f"export-{job['job_id']}", daemon=True
+                )
+                thread.start()
+            except Exception:
+                _job_slots.release()
+                raise
+
+            logger.info(f"Started export job {job['job_id']} for {row_count} rows")
+            response = jsonify(dict(
+                _job_payload(job),
+                message=f"Exporting {row_count} rows in the background",
+                timestamp=datetime.now().isoformat()
+            ))
+            response.status_code = 202
+            response.headers['Location'] = url_for('export_job_status', job_id=job['job_id'])
+            return response
+        except Exception as e:
+            logger.error(f"Error exporting maintenance logs: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/export/jobs/<job_id>')
+    @login_required
+    def export_job_status(job_id):
+        """Progress of an XLSX export job"""
+        job = load_job(job_id)
+        if job is None:
+            return jsonify({"error": f"No export job {job_id}"}), 404
+        return jsonify(_job_payload(job))
+
+    @app.route('/api/export/jobs/<job_id>/download')
+    @login_required
+    def download_export_job(job_id):
+        """The spreadsheet of a finished XLSX export job"""
+        job = load_job(job_id)
+        if job is None:
+            return jsonify({"error": f"No export job {job_id}"}), 404
+        if job['status'] != 'done':
+            return jsonify({"error": f"Export job {job_id} is {job['status']}", "job": _job_payload(job)}), 409
+        return send_file(_job_path(job_id, 'xlsx'), mimetype=XLSX_MIMETYPE,
+                         as_attachment=True, download_name=job['filename'])
+
+    return _export_dir
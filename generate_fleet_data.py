@@ -0,0 +1,415 @@
+"""
+Synthetic fleet data generator built on seed_initial_data.py
+
+Scales the seed equipment list up to fleets of any size and simulates years
+of weekly maintenance logs for it: owner workloads, scroll and spare pumps,
+slowly drifting pump temperatures, oil top-ups and oil changes. Output is
+deterministic for a given seed so performance problems can be reproduced.
+
+Usage:
+    python generate_fleet_data.py --scale 50 --years 5
+    python generate_fleet_data.py --scale 50 --years 5 --database-url postgresql://...
+    python generate_fleet_data.py --scale 2 --years 1 --backup-json backups/db_backup_synthetic.json --no-load
+"""
+import io
+import csv
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import logging
+import datetime
+from sqlalchemy import create_engine, select, func, text
+
+from app import (app, db, Equipment, MaintenanceLog, ChangeSequence, ChangeTombstone, TableVersion, EquipmentStats,
+                 PumpAttention, WorkWeekSummary, CalendarWeek, EligibilityRule, PumpModel, OilType, Person,
+                 ServiceType, TemperatureReading, TemperatureReadingArchive, TemperatureHourly, TemperatureDaily,
+                 PumpAnomaly, get_work_week)
+from change_sync import backfill_change_seqs, write_resets
+from data_version import bump_table_versions
+from equipment_stats import backfill_equipment_stats
+from needs_attention import backfill_attention
+from work_week_summary import backfill_week_summaries
+from week_coverage import backfill_coverage_bits, BIT_COUNTER_NAME
+from work_weeks import iso_week_key, backfill_week_keys
+from lookups import backfill_lookups, intern_rows
+from search import ensure_search_index, rebuild_search_index
+from eligibility import DEFAULT_RULES, is_eligible as rules_allow, backfill_eligibility
+from seed_initial_data import equipment_data, log_data
+
+logger = logging.getLogger(__name__)
+
+# Extra people that take over new pumps as the fleet grows
+OWNER_TEAMS = ['Mfg', 'Chem', 'Process', 'R&D', 'QA', 'Facilities']
+OWNER_NAMES = [
+    'Jonathan', 'Fernando', 'Jeremy', 'Ben', 'Jack', 'Elena', 'Priya', 'Marco', 'Aisha', 'Tom',
+    'Wei', 'Sofia', 'Daniel', 'Grace', 'Omar', 'Hannah', 'Luis', 'Mei', 'Kofi', 'Nina'
+]
+
+# Typical running temperature by pump model
+MODEL_BASE_TEMPS = {
+    'Edwards RV3': 66.0,
+    'Edwards RV5': 68.0,
+    'Edwards RV8': 73.0,
+    'Edwards RV9': 74.0,
+    'Edwards RV12': 76.0
+}
+
+ADD_OIL_NOTES = [note for *_, service, note in log_data if service == 'Add Oil' and note]
+DRAIN_NOTES = [note for *_, service, note in log_data if service == 'Drain & Replace Oil' and note]
+
+# Columns of the maintenance_log table in insert order. Generated rows
+# carry names, which are interned into the lookup id columns as they load.
+LOG_COLUMNS = [
+    'log_id', 'equipment_id', 'work_week', 'week_key', 'check_date', 'user_id', 'oil_level_ok',
+    'oil_condition_ok', 'oil_filter_ok', 'pump_temp', 'service_id', 'service_notes'
+]
+# Generated pumps leave created_at empty, as their history predates the load
+EQUIPMENT_COLUMNS = ['equipment_id', 'equipment_name', 'pump_model_id', 'oil_type_id', 'owner_id', 'status', 'notes',
+                     'created_at']
+
+def is_eligible(equipment):
+    """Whether a pump is part of the weekly log under the default rules (not a scroll pump or a spare)"""
+    rules = [(rule['field'], rule['pattern']) for rule in DEFAULT_RULES]
+    return rules_allow(rules, equipment['equipment_name'], equipment['oil_type'])
+
+def build_owner_pool(equipment_count, rng):
+    """Seed owners plus enough extra owners to keep each one's workload realistic"""
+    seed_owners = []
+    for _, _, _, _, owner, _, _ in equipment_data:
+        if owner and owner != 'N/A' and owner not in seed_owners:
+            seed_owners.append(owner)
+
+    extra_needed = max(0, equipment_count // 12 - len(seed_owners))
+    extra_owners = []
+    while len(extra_owners) < extra_needed:
+        team = rng.choice(OWNER_TEAMS)
+        name = rng.choice(OWNER_NAMES)
+        suffix = f" {len(extra_owners) // len(OWNER_NAMES) + 1}" if len(extra_owners) >= len(OWNER_NAMES) else ''
+        owner = f"{team} ({name}{suffix})"
+        if owner not in seed_owners and owner not in extra_owners:
+            extra_owners.append(owner)
+
+    owners = seed_owners + extra_owners
+    # Zipf-like weights: a few people own many pumps, most own a handful
+    weights = [1.0 / math.sqrt(rank + 1) for rank in range(len(owners))]
+    return owners, weights
+
+def generate_equipment(scale=1, seed=42):
+    """Generate the equipment list by repeating the seed fleet `scale` times"""
+    rng = random.Random(seed)
+    owners, weights = build_owner_pool(len(equipment_data) * scale, rng)
+
+    equipment_rows = []
+    equipment_id = 0
+    for copy_index in range(scale):
+        for _, name, model, oil, owner, status, notes in equipment_data:
+            equipment_id += 1
+            if copy_index > 0:
+                name = f"{name} #{copy_index + 1}"
+                if owner not in ('N/A', 'Jack'):
+                    owner = rng.choices(owners, weights)[0]
+            equipment_rows.append({
+                'equipment_id': equipment_id,
+                'equipment_name': name,
+                'pump_model': model,
+                'oil_type': oil,
+                'pump_owner': owner,
+                'status': status,
+                'notes': notes
+            })
+    return equipment_rows
+
+def _initial_pump_state(equipment, rng):
+    base_temp = MODEL_BASE_TEMPS.get(equipment['pump_model'], 72.0) + rng.gauss(0, 3)
+    return {
+        'base_temp': base_temp,
+        'drift': 0.0,
+        # Most pumps drift a little; some wear out steadily between oil changes
+        'drift_rate': rng.choice([0.0, 0.02, 0.05, 0.05, 0.1, 0.25]),
+        'oil_level': rng.uniform(0.6, 1.0),
+        'oil_use_rate': rng.uniform(0.01, 0.08),
+        'weeks_since_change': rng.randint(0, 25),
+        'change_interval': rng.randint(20, 40),
+        'running': True
+    }
+
+def iter_maintenance_logs(equipment_rows, years=1.0, seed=42, end_date=None, first_log_id=1):
+    """Yield weekly maintenance log rows, oldest week first
+
+    Deterministic for a given seed, so the same rows can be streamed twice
+    (for example into the database and into a backup file).
+    """
+    rng = random.Random(seed + 1)
+    if end_date is None:
+        end_date = datetime.date.today()
+    weeks = max(1, int(round(years * 52)))
+    last_monday = end_date - datetime.timedelta(days=end_date.weekday())
+
+    # Every owner has their own habit of filling in the weekly sheet
+    owners = sorted({e['pump_owner'] for e in equipment_rows if e['pump_owner']})
+    diligence = {owner: rng.uniform(0.55, 0.98) for owner in owners}
+    pumps = [e for e in equipment_rows if is_eligible(e)]
+    state = {e['equipment_id']: _initial_pump_state(e, rng) for e in pumps}
+
+    log_id = first_log_id
+    for week_index in range(weeks):
+        monday = last_monday - datetime.timedelta(weeks=weeks - 1 - week_index)
+        # Seasonal variation in lab temperature
+        seasonal = 2.0 * math.sin(2 * math.pi * monday.timetuple().tm_yday / 365.0)
+
+        for equipment in pumps:
+            pump = state[equipment['equipment_id']]
+            pump['oil_level'] -= pump['oil_use_rate'] * rng.uniform(0.5, 1.5)
+            pump['weeks_since_change'] += 1
+            pump['drift'] += pump['drift_rate'] * rng.uniform(0.5, 1.5)
+
+            # Pumps occasionally go offline for a few weeks
+            if pump['running'] and rng.random() < 0.005:
+                pump['running'] = False
+            elif not pump['running'] and rng.random() < 0.3:
+                pump['running'] = True
+
+            owner = equipment['pump_owner']
+            if rng.random() > diligence.get(owner, 0.8):
+                continue
+
+            check_date = monday + datetime.timedelta(days=min(4, int(rng.expovariate(1.0))))
+            if check_date > end_date:
+                continue
+
+            user_name = owner
+            if rng.random() < 0.1:
+                user_name = rng.choice(owners)
+
+            oil_level_ok = pump['oil_level'] > 0.35
+            oil_condition_ok = pump['weeks_since_change'] < pump['change_interval']
+            oil_filter_ok = rng.random() > 0.03
+            pump_temp = None
+            if pump['running']:
+                pump_temp = round(pump['base_temp'] + pump['drift'] + seasonal + rng.gauss(0, 1.2), 1)
+
+            service = 'None Required'
+            service_notes = ''
+            if not pump['running']:
+                service_notes = 'Pump not operating'
+            elif not oil_condition_ok:
+                service = 'Drain & Replace Oil'
+                service_notes = rng.choice(DRAIN_NOTES) if DRAIN_NOTES else ''
+                pump['oil_level'] = 1.0
+                pump['weeks_since_change'] = 0
+                pump['drift'] *= 0.3
+            elif not oil_level_ok:
+                service = 'Add Oil'
+                service_notes = rng.choice(ADD_OIL_NOTES) if ADD_OIL_NOTES else ''
+                pump['oil_level'] = rng.uniform(0.8, 1.0)
+            elif not oil_filter_ok:
+                service = 'Drain Oil Filter'
+
+            yield {
+                'log_id': log_id,
+                'equipment_id': equipment['equipment_id'],
+                'work_week': get_work_week(check_date),
+                'week_key': iso_week_key(check_date),
+                'check_date': check_date,
+                'user_name': user_name,
+                'oil_level_ok': oil_level_ok,
+                'oil_condition_ok': oil_condition_ok,
+                'oil_filter_ok': oil_filter_ok,
+                'pump_temp': pump_temp,
+                'service': service,
+                'service_notes': service_notes
+            }
+            log_id += 1
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _interned(connection, model, columns, rows, chunk_size):
+    """Rows of a model with their names interned, cut down to columns (None where missing), a chunk at a time"""
+    for chunk in _chunks(rows, chunk_size):
+        intern_rows(connection, model, chunk)
+        yield from ({column: row.get(column) for column in columns} for row in chunk)
+
+def _copy_rows(raw_connection, table_name, columns, rows, chunk_size):
+    """Stream rows into PostgreSQL with COPY, one CSV buffer per chunk"""
+    cursor = raw_connection.cursor()
+    count = 0
+    try:
+        for chunk in _chunks(rows, chunk_size):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in chunk:
+                writer.writerow(['\\N' if row[col] is None else row[col] for col in columns])
+            buffer.seek(0)
+            cursor.copy_expert(
+                f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buffer
+            )
+            count += len(chunk)
+    finally:
+        cursor.close()
+    return count
+
+def bulk_load(engine, equipment_rows, log_rows, replace=False, chunk_size=10000):
+    """Load generated rows into the database behind `engine` as fast as it allows
+
+    Uses COPY on PostgreSQL and chunked executemany inserts in a single
+    transaction on SQLite. With replace, the old pumps' readings and anomaly
+    scores go with them, /api/changes consumers get a reset for equipment
+    and logs, and the search index is refilled once the new rows are in.
+    """
+    readings_tables = [TemperatureReading.__table__, TemperatureReadingArchive.__table__, TemperatureHourly.__table__,
+                       TemperatureDaily.__table__, PumpAnomaly.__table__]
+    db.metadata.create_all(engine, tables=[PumpModel.__table__, OilType.__table__, Person.__table__, ServiceType.__table__,
+                                           Equipment.__table__, MaintenanceLog.__table__, ChangeSequence.__table__,
+                                           ChangeTombstone.__table__, TableVersion.__table__,
+                                           EquipmentStats.__table__, PumpAttention.__table__, WorkWeekSummary.__table__,
+                                           CalendarWeek.__table__, EligibilityRule.__table__] + readings_tables)
+    equipment_table = Equipment.__table__
+    log_table = MaintenanceLog.__table__
+
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            # Before the first write, which starts the transaction
+            conn.execute(text("PRAGMA synchronous=OFF"))
+        existing = conn.execute(select([func.count()]).select_from(equipment_table)).scalar()
+        if existing:
+            if not replace:
+                raise ValueError(f"Database already contains {existing} equipment records. Use --replace to overwrite them.")
+            for table in readings_tables:
+                conn.execute(table.delete())
+            conn.execute(EquipmentStats.__table__.delete())
+            conn.execute(PumpAttention.__table__.delete())
+            conn.execute(WorkWeekSummary.__table__.delete())
+            conn.execute(log_table.delete())
+            conn.execute(equipment_table.delete())
+            # Number the new pumps' coverage bits from 0 again
+            conn.execute(ChangeSequence.__table__.delete().where(ChangeSequence.name == BIT_COUNTER_NAME))
+            # The loaded rows may reuse the old ids, and even the old row
+            # counts, so neither the change cursor nor the data version
+            # would otherwise show that everything changed
+            write_resets(conn, [equipment_table.name, log_table.name])
+            bump_table_versions(conn, [equipment_table.name, log_table.name])
+
+        equipment_rows = list(_interned(conn, Equipment, EQUIPMENT_COLUMNS, equipment_rows, chunk_size))
+        log_rows = _interned(conn, MaintenanceLog, LOG_COLUMNS, log_rows, chunk_size)
+        if engine.dialect.name == 'postgresql':
+            raw_connection = conn.connection
+            equipment_count = _copy_rows(raw_connection, equipment_table.name, EQUIPMENT_COLUMNS, equipment_rows, chunk_size)
+            logs_count = _copy_rows(raw_connection, log_table.name, LOG_COLUMNS, log_rows, chunk_size)
+            # Explicit ids were copied in, move the sequences past them
+            for table_name, pk in ((equipment_table.name, 'equipment_id'), (log_table.name, 'log_id')):
+                conn.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table_name}', '{pk}'), "
+                    f"COALESCE((SELECT MAX({pk}) FROM {table_name}), 1))"
+                ))
+        else:
+            conn.execute(equipment_table.insert(), equipment_rows)
+            equipment_count = len(equipment_rows)
+            logs_count = 0
+            for chunk in _chunks(log_rows, chunk_size):
+                conn.execute(log_table.insert(), chunk)
+                logs_count += len(chunk)
+
+    # Number the loaded rows so /api/changes consumers pick them up, and
+    # summarize each pump's history
+    backfill_week_keys(engine, log_table)
+    backfill_lookups(engine)
+    backfill_eligibility(engine)
+    backfill_coverage_bits(engine)
+    backfill_change_seqs(engine)
+    backfill_equipment_stats(engine)
+    backfill_attention(engine)
+    backfill_week_summaries(engine)
+    if not ensure_search_index(engine) and existing:
+        rebuild_search_index(engine)
+
+    return {
+        'equipment_count': equipment_count,
+        'logs_count': logs_count
+    }
+
+def write_backup(path, equipment_rows, log_rows, database_type='Synthetic'):
+    """Write rows in the JSON format read by db_backup.restore_database()
+
+    Log rows are streamed to the file so large fleets don't need to fit in memory.
+    """
+    logs_count = 0
+    with open(path, 'w') as f:
+        f.write('{\n  "metadata": ')
+        json.dump({
+            'timestamp': datetime.datetime.now().isoformat(),
+            'database_type': database_type
+        }, f)
+        f.write(',\n  "tables": {\n    "equipment": ')
+        json.dump(equipment_rows, f)
+        f.write(',\n    "maintenance_logs": [')
+        for row in log_rows:
+            row = dict(row, check_date=row['check_date'].isoformat())
+            f.write(',\n      ' if logs_count else '\n      ')
+            json.dump(row, f)
+            logs_count += 1
+        f.write('\n    ]\n  }\n}\n')
+    return {
+        'file': path,
+        'equipment_count': len(equipment_rows),
+        'logs_count': logs_count
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic vacuum pump fleet with maintenance history')
+    parser.add_argument('--scale', type=int, default=1, help=f"number of copies of the {len(equipment_data)} seed pumps (default 1)")
+    parser.add_argument('--years', type=float, default=1.0, help='years of weekly logs to generate (default 1)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default 42)')
+    parser.add_argument('--end-date', type=datetime.date.fromisoformat, default=None, help='last day of generated logs, YYYY-MM-DD (default today)')
+    parser.add_argument('--database-url', default=None, help="database to load into (default: the application's database)")
+    parser.add_argument('--replace', action='store_true', help='delete existing equipment and logs before loading')
+    parser.add_argument('--no-load', action='store_true', help='do not load the data into a database')
+    parser.add_argument('--backup-json', default=None, help='also write the data as a restore_database() backup file')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='rows per insert batch (default 10000)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    equipment_rows = generate_equipment(args.scale, args.seed)
+    eligible_count = sum(1 for e in equipment_rows if is_eligible(e))
+    print(f"Generated {len(equipment_rows)} equipment records ({eligible_count} on the weekly log)")
+
+    def logs():
+        return iter_maintenance_logs(equipment_rows, args.years, args.seed, args.end_date)
+
+    if not args.no_load:
+        start = time.perf_counter()
+        if args.database_url:
+            engine = create_engine(args.database_url)
+        else:
+            with app.app_context():
+                engine = db.engine
+        try:
+            result = bulk_load(engine, equipment_rows, logs(), replace=args.replace, chunk_size=args.chunk_size)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return 1
+        elapsed = time.perf_counter() - start
+        rate = result['logs_count'] / elapsed if elapsed > 0 else 0
+        print(f"Loaded {result['equipment_count']} equipment records and {result['logs_count']} maintenance logs "
+              f"into {engine.dialect.name} in {elapsed:.1f}s ({rate:,.0f} logs/s)")
+
+    if args.backup_json:
+        result = write_backup(args.backup_json, equipment_rows, logs())
+        print(f"Wrote backup with {result['equipment_count']} equipment records and {result['logs_count']} maintenance logs to {result['file']}")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Idempotency keys for retried write requests of the Vacuum Pump
+Maintenance application
+
+A client that may have to retry a write, such as the offline weekly log
+flushing a queued batch over poor Wi-Fi, sends the same Idempotency-Key
+header with every attempt. The first attempt stores its response in the
+same transaction as its writes; later attempts get that stored response
+back without running the request again. Keys are kept for
+IDEMPOTENCY_KEY_TTL_HOURS.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from flask import jsonify
+from sqlalchemy.exc import IntegrityError
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 100
+
+# Seconds between deletions of expired keys in each worker
+PRUNE_INTERVAL = 3600
+
+_db = None
+_key_model = None
+_ttl_hours = 168
+_last_prune = 0.0
+
+def _replay(stored, request_hash):
+    if stored.request_hash != request_hash:
+        return jsonify({"error": "This Idempotency-Key was already used for a different request"}), 422
+    response = jsonify(json.loads(stored.response))
+    response.status_code = stored.status_code
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _prune_expired():
+    global _last_prune
+    if time.time() - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = time.time()
+    cutoff = datetime.utcnow() - timedelta(hours=_ttl_hours)
+    try:
+        _key_model.query.filter(_key_model.created_at < cutoff).delete(synchronize_session=False)
+        _db.session.commit()
+    except Exception as e:
+        _db.session.rollback()
+        logger.error(f"Error pruning idempotency keys: {e}")
+
+def idempotent_response(key, body, handler):
+    """Run handler at most once per idempotency key and return its JSON response
+
+    handler makes its changes in the current session without committing and
+    returns (payload, status code). The payload is committed together with
+    those changes, so a retry either finds it or finds nothing applied.
+    Reusing a key for a different request body is rejected with a 422.
+    """
+    request_hash = hashlib.sha1(body or b'').hexdigest()
+    session = _db.session
+
+    stored = session.get(_key_model, key)
+    if stored is not None:
+        return _replay(stored, request_hash)
+
+    try:
+        payload, status_code = handler()
+        session.add(_key_model(
+            key=key,
+            request_hash=request_hash,
+            status_code=status_code,
+            response=json.dumps(payload),
+            created_at=datetime.utcnow()
+        ))
+        session.commit()
+    except IntegrityError as e:
+        # A concurrent attempt with the same key committed first, and all
+        # of this attempt's changes were rolled back with the key
+        session.rollback()
+        stored = session.get(_key_model, key)
+        if stored is None:
+            # Another constraint failed; answer in JSON so the client keeps
+            # the batch and retries instead of following the HTML error page
+            logger.error(f"Error handling idempotent request {key}: {e}")
+            return jsonify({"error": "The changes conflicted with another save, try again"}), 500
+        return _replay(stored, request_hash)
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error handling idempotent request {key}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    _prune_expired()
+    return jsonify(payload), status_code
+
+def setup_idempotency(app, db, key_model):
+    """Configure storage of idempotency keys"""
+    global _db, _key_model, _ttl_hours
+    app.config.setdefault('IDEMPOTENCY_KEY_TTL_HOURS', float(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '168')))
+    _db = db
+    _key_model = key_model
+    _ttl_hours = app.config['IDEMPOTENCY_KEY_TTL_HOURS']
+    return key_model
@@ -0,0 +1,398 @@
+"""
+Load test for the Vacuum Pump Maintenance application
+
+Replays the Monday-morning peak against a running server: technicians open
+/weekly-log and save rows one at a time through save_equipment_log while
+everyone else has the dashboard open, polling /api/chart-data. Users are
+logged in through /load-test/login, which the server only enables when
+LOAD_TEST_TOKEN is set, so Google OAuth is not involved.
+
+Reports throughput, latency percentiles and error rates per request type,
+plus the lock timeouts and connection pool waits counted by the server
+(read from /admin/db-stats, which needs an email listed in ADMIN_EMAILS).
+
+Usage:
+    LOAD_TEST_TOKEN=secret ADMIN_EMAILS=admin@example.com gunicorn -w 4 -b 127.0.0.1:8000 app:app
+    python load_test.py --token secret --technicians 25 --viewers 40 --ramp-up 30 --duration 120
+
+    # or let the script start gunicorn itself
+    python load_test.py --start-server --workers 4 --technicians 25 --viewers 40
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import secrets
+import argparse
+import threading
+import subprocess
+from datetime import datetime
+
+import requests
+
+SAVE_FORM_ACTION = re.compile(r'action="[^"]*/save_equipment_log/(\d+)/([^"/]+)"')
+SAVE_ERROR_TEXT = 'Error saving maintenance log'
+
+SERVICES = ['None Required', 'None Required', 'None Required', 'Add Oil', 'Change Oil', 'Change Filter']
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+class Recorder:
+    """Thread-safe collection of request timings and failures"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.error_samples = []
+
+    def record(self, name, elapsed_ms, error=None):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed_ms)
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+                if len(self.error_samples) < 20:
+                    self.error_samples.append(f"{name}: {error}")
+
+    def summary(self, elapsed_seconds):
+        with self.lock:
+            rows = {}
+            for name, values in sorted(self.latencies.items()):
+                errors = self.errors.get(name, 0)
+                rows[name] = {
+                    'requests': len(values),
+                    'throughput_rps': round(len(values) / elapsed_seconds, 2) if elapsed_seconds else 0.0,
+                    'p50_ms': round(percentile(values, 0.50), 1),
+                    'p95_ms': round(percentile(values, 0.95), 1),
+                    'p99_ms': round(percentile(values, 0.99), 1),
+                    'max_ms': round(max(values), 1),
+                    'errors': errors,
+                    'error_rate': round(errors / len(values), 4)
+                }
+            return rows
+
+class VirtualUser(threading.Thread):
+    """One simulated browser session"""
+    def __init__(self, index, config, recorder, start_delay, stop_event):
+        super().__init__(daemon=True)
+        self.index = index
+        self.config = config
+        self.recorder = recorder
+        self.start_delay = start_delay
+        self.stop_event = stop_event
+        self.random = random.Random(config.seed + index)
+        self.session = requests.Session()
+
+    def request(self, name, method, path, expected_status=200, **kwargs):
+        """Send one request, record it and return the response or None"""
+        url = self.config.base_url + path
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=self.config.request_timeout,
+                                            allow_redirects=False, **kwargs)
+        except requests.RequestException as e:
+            self.recorder.record(name, (time.perf_counter() - start) * 1000, type(e).__name__)
+            return None
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        error = None
+        if response.status_code != expected_status:
+            error = f"HTTP {response.status_code} for {method} {path}"
+        self.recorder.record(name, elapsed_ms, error)
+        return response if error is None else None
+
+    def login(self, name, email=None):
+        data = {'name': name}
+        if email:
+            data['email'] = email
+        response = self.request('login', 'POST', '/load-test/login', data=data,
+                                headers={'X-Load-Test-Token': self.config.token})
+        return response is not None
+
+    def think(self, mean_seconds):
+        """Wait a random time around the mean, returning False once the test is over"""
+        return not self.stop_event.wait(self.random.uniform(0.5, 1.5) * mean_seconds)
+
+    def run(self):
+        if self.stop_event.wait(self.start_delay):
+            return
+        try:
+            self.scenario()
+        finally:
+            self.session.close()
+
+    def scenario(self):
+        raise NotImplementedError
+
+class Technician(VirtualUser):
+    """Opens the weekly log and saves rows one after another"""
+    def open_weekly_log(self, path='/weekly-log'):
+        response = self.request('weekly_log', 'GET', path)
+        if response is None:
+            return []
+        if SAVE_ERROR_TEXT in response.text:
+            # The previous save failed and the error was flashed on this page
+            self.recorder.record('save_failed_flash', 0.0, 'save_equipment_log reported an error')
+        return SAVE_FORM_ACTION.findall(response.text)
+
+    def scenario(self):
+        user_name = f"Load Tech {self.index:03d}"
+        if not self.login(user_name):
+            return
+
+        rows = self.open_weekly_log()
+        while rows and self.think(self.config.think_time):
+            equipment_id, work_week = self.random.choice(rows)
+            form = {
+                'equipment_id': equipment_id,
+                'check_date': datetime.now().strftime('%Y-%m-%d'),
+                'user_name': user_name,
+                'oil_level_ok': 'on',
+                'oil_condition_ok': 'on',
+                'pump_temp': f"{self.random.uniform(60, 95):.1f}",
+                'service': self.random.choice(SERVICES),
+                'service_notes': ''
+            }
+            response = self.request('save_equipment_log', 'POST',
+                                    f"/save_equipment_log/{equipment_id}/{work_week}",
+                                    expected_status=302, data=form)
+            if response is None:
+                continue
+
+            # Browsers follow the redirect back to the weekly log
+            location = response.headers.get('Location', '/weekly-log')
+            if location.startswith(self.config.base_url):
+                location = location[len(self.config.base_url):]
+            rows = self.open_weekly_log(location) or rows
+
+class DashboardViewer(VirtualUser):
+    """Keeps the dashboard open, polling the chart data"""
+    def scenario(self):
+        if not self.login(f"Load Viewer {self.index:03d}"):
+            return
+
+        self.request('dashboard', 'GET', '/dashboard')
+        self.request('chart_data', 'GET', '/api/chart-data')
+        while self.think(self.config.poll_interval):
+            self.request('chart_data', 'GET', '/api/chart-data')
+
+class StatsClient:
+    """Reads the per-worker database counters through the admin endpoints"""
+    def __init__(self, config):
+        self.config = config
+        self.session = requests.Session()
+        self.available = False
+
+    def login(self):
+        if not self.config.admin_email:
+            return False
+        try:
+            response = self.session.post(self.config.base_url + '/load-test/login',
+                                         data={'name': 'Load Test Admin', 'email': self.config.admin_email},
+                                         headers={'X-Load-Test-Token': self.config.token},
+                                         timeout=self.config.request_timeout)
+            self.available = response.status_code == 200 and response.json().get('admin', False)
+        except (requests.RequestException, ValueError):
+            self.available = False
+        return self.available
+
+    def _samples(self):
+        # Each gunicorn worker keeps its own counters and requests land on an
+        # arbitrary worker, so sample several times to reach all of them
+        for _ in range(max(4, self.config.workers * 4)):
+            yield self.session
+
+    def reset(self):
+        if not self.available:
+            return
+        for session in self._samples():
+            try:
+                session.post(self.config.base_url + '/admin/db-stats/reset', allow_redirects=False,
+                             timeout=self.config.request_timeout)
+            except requests.RequestException:
+                pass
+
+    def collect(self):
+        """Sum the counters of every worker that answered"""
+        if not self.available:
+            return None
+        workers = {}
+        for session in self._samples():
+            try:
+                response = session.get(self.config.base_url + '/admin/db-stats', allow_redirects=False,
+                                       timeout=self.config.request_timeout)
+                stats = response.json()['stats']
+            except (requests.RequestException, ValueError, KeyError):
+                continue
+            workers[stats['worker_pid']] = stats
+
+        if not workers:
+            return None
+        total = {'workers_sampled': len(workers)}
+        for key in ('lock_timeouts', 'pool_checkouts', 'pool_waits', 'pool_timeouts'):
+            total[key] = sum(stats[key] for stats in workers.values())
+        total['pool_wait_total_ms'] = round(sum(stats['pool_wait_total_ms'] for stats in workers.values()), 1)
+        total['pool_wait_max_ms'] = max(stats['pool_wait_max_ms'] for stats in workers.values())
+        return total
+
+def start_server(config):
+    """Start gunicorn with the load-test login enabled and wait until it answers"""
+    host_port = config.base_url.split('://', 1)[-1].rstrip('/')
+    env = dict(os.environ, LOAD_TEST_TOKEN=config.token)
+    if config.admin_email:
+        admin_emails = [e for e in env.get('ADMIN_EMAILS', '').split(',') if e.strip()]
+        env['ADMIN_EMAILS'] = ','.join(admin_emails + [config.admin_email])
+
+    command = ['gunicorn', 'app:app', '--workers', str(config.workers), '--bind', host_port,
+               '--timeout', '120', '--log-level', 'warning']
+    print(f"Starting {' '.join(command)}", flush=True)
+    server = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+        try:
+            requests.get(config.base_url + '/health', timeout=2)
+            return server
+        except requests.RequestException:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 60 seconds")
+
+def run_load_test(config):
+    recorder = Recorder()
+    stop_event = threading.Event()
+    stats_client = StatsClient(config)
+    if stats_client.login():
+        stats_client.reset()
+    else:
+        print("Server statistics unavailable: pass --admin-email with an address listed in ADMIN_EMAILS", flush=True)
+
+    total_users = config.technicians + config.viewers
+    kinds = [Technician] * config.technicians + [DashboardViewer] * config.viewers
+    random.Random(config.seed).shuffle(kinds)
+
+    # Users start evenly spread over the ramp-up period
+    users = []
+    for index, kind in enumerate(kinds):
+        start_delay = config.ramp_up * index / total_users if total_users else 0
+        users.append(kind(index, config, recorder, start_delay, stop_event))
+
+    print(f"Running {config.technicians} technicians and {config.viewers} dashboard viewers against "
+          f"{config.base_url} for {config.duration}s (ramp-up {config.ramp_up}s)", flush=True)
+    start = time.perf_counter()
+    for user in users:
+        user.start()
+    try:
+        stop_event.wait(config.duration)
+    except KeyboardInterrupt:
+        print("Interrupted, stopping users", flush=True)
+    stop_event.set()
+    for user in users:
+        user.join(config.request_timeout + 5)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'metadata': {
+            'timestamp': datetime.now().isoformat(),
+            'base_url': config.base_url,
+            'technicians': config.technicians,
+            'viewers': config.viewers,
+            'duration_s': round(elapsed, 1),
+            'ramp_up_s': config.ramp_up,
+            'think_time_s': config.think_time,
+            'poll_interval_s': config.poll_interval
+        },
+        'requests': recorder.summary(elapsed),
+        'server': stats_client.collect(),
+        'error_samples': recorder.error_samples
+    }
+
+def print_report(report):
+    rows = {name: row for name, row in report['requests'].items() if name != 'save_failed_flash'}
+    total_requests = sum(row['requests'] for row in rows.values())
+    total_errors = sum(row['errors'] for row in rows.values())
+    duration = report['metadata']['duration_s']
+
+    header = f"{'request':<22}{'count':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'errors':>8}"
+    print()
+    print(header)
+    print('-' * len(header))
+    for name, row in rows.items():
+        print(f"{name:<22}{row['requests']:>8}{row['throughput_rps']:>9.2f}{row['p50_ms']:>9.1f}"
+              f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}{row['errors']:>8}")
+    print('-' * len(header))
+    throughput = total_requests / duration if duration else 0.0
+    error_rate = total_errors / total_requests if total_requests else 0.0
+    print(f"Total: {total_requests} requests in {duration}s ({throughput:.2f} req/s), error rate {error_rate:.2%}")
+
+    saves = report['requests'].get('save_equipment_log', {}).get('requests', 0)
+    failed_saves = report['requests'].get('save_failed_flash', {}).get('errors', 0)
+    if saves:
+        print(f"Saves reported as failed by the application: {failed_saves} of {saves} ({failed_saves / saves:.2%})")
+
+    server = report['server']
+    if server:
+        lock_rate = server['lock_timeouts'] / saves if saves else 0.0
+        print(f"Lock timeouts: {server['lock_timeouts']} ({lock_rate:.2%} of saves)")
+        print(f"Pool waits: {server['pool_waits']} of {server['pool_checkouts']} checkouts, "
+              f"{server['pool_wait_total_ms']} ms total, {server['pool_wait_max_ms']} ms max, "
+              f"{server['pool_timeouts']} timeouts ({server['workers_sampled']} workers sampled)")
+
+    if report['error_samples']:
+        print("\nSample errors:")
+        for sample in report['error_samples']:
+            print(f"  - {sample}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate the Monday-morning weekly log peak against a running server')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000', help='server to test (default http://127.0.0.1:8000)')
+    parser.add_argument('--token', default=os.environ.get('LOAD_TEST_TOKEN', ''),
+                        help='load-test login token, must match the server LOAD_TEST_TOKEN')
+    parser.add_argument('--admin-email', default=os.environ.get('LOAD_TEST_ADMIN_EMAIL', ''),
+                        help='admin email used to read /admin/db-stats')
+    parser.add_argument('--technicians', type=int, default=20, help='users saving weekly log rows (default 20)')
+    parser.add_argument('--viewers', type=int, default=30, help='users polling the dashboard (default 30)')
+    parser.add_argument('--ramp-up', type=float, default=30, help='seconds over which users start (default 30)')
+    parser.add_argument('--duration', type=float, default=120, help='seconds the test runs (default 120)')
+    parser.add_argument('--think-time', type=float, default=3.0, help='mean seconds between saves (default 3)')
+    parser.add_argument('--poll-interval', type=float, default=30.0, help='mean seconds between chart polls (default 30)')
+    parser.add_argument('--request-timeout', type=float, default=30.0, help='client timeout per request (default 30)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed for user behaviour (default 42)')
+    parser.add_argument('--start-server', action='store_true', help='start gunicorn for the duration of the test')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers with --start-server (default 4)')
+    parser.add_argument('--output', default=None, help='also write the report to a JSON file')
+    config = parser.parse_args(argv)
+    config.base_url = config.base_url.rstrip('/')
+
+    server = None
+    if config.start_server:
+        config.token = config.token or secrets.token_urlsafe(16)
+        config.admin_email = config.admin_email or 'load-test-admin@loadtest.local'
+        server = start_server(config)
+    elif not config.token:
+        parser.error('--token or LOAD_TEST_TOKEN is required unless --start-server is used')
+
+    try:
+        report = run_load_test(config)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(30)
+
+    print_report(report)
+    if config.output:
+        with open(config.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
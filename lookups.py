@@ -0,0 +1,431 @@
+"""
+Lookup tables for pump models, oil types, people and services
+
+Pump models, oil types and services are picked from short lists, and pump
+owners and the people who log checks are the same few dozen people, yet
+every equipment and maintenance_log row spelled them out. Each value now
+has one row in pump_model, oil_type, person or service_type, and the rows
+only keep an indexed integer id pointing at it: equipment.pump_model_id,
+oil_type_id and owner_id, and maintenance_log.service_id and user_id. The
+dropdown lists read the lookup tables, and owners and users are matched
+by id.
+
+The models keep the old attribute names (pump_model, oil_type, pump_owner,
+service and user_name) as hybrid properties made by lookup_name. Reading
+one goes through a relationship loaded with a join, or a correlated
+subquery in SQL, and assigning one holds the name on the object until the
+next flush resolves it to its id. Surrounding and repeated whitespace is
+dropped, and spellings that differ only in case share the lookup row,
+which keeps the spelling it was first saved with: a new row or a change
+to another value typed in another case than its row's reads back in the
+row's spelling after the flush. An edit that only changes the case of a
+row's value respells the lookup row instead, and every row using it gets
+a new change sequence number. Lookup rows are never deleted, so each
+worker caches the ids of the names it has seen committed and a flush of
+known names runs no lookup statements.
+
+Databases from before the ids existed are interned on start by
+backfill_lookups, which picks the most common spelling of each value.
+The text columns stay, holding the values from before the upgrade, until
+schema_migrations drops them when run by hand.
+"""
+import logging
+from sqlalchemy import event, select, func, exists, or_, case, inspect, bindparam, Table, MetaData
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import flag_dirty
+from sqlalchemy.dialects import postgresql, sqlite
+from change_sync import stamp_rows
+from data_version import bump_table_versions
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Instance dict entries holding assigned names until the object is expired,
+# and the names they replaced until the flush
+PENDING_NAMES = '_lookup_names'
+PREVIOUS_NAMES = '_lookup_previous'
+
+# Session.info {table name: {key: (id, name)}} resolved in the transaction
+RESOLVED_KEY = 'lookup_resolved'
+
+# (name, id column, lookup table, default for new rows) of each interned
+# field of each model, set by setup_lookups
+_models = {}
+
+# {lookup table name: {key: (id, name)}} of committed lookup rows
+_known = {}
+
+def clean_name(value):
+    """A value with surrounding and repeated whitespace removed, or None when blank"""
+    if not isinstance(value, str):
+        return None
+    value = ' '.join(value.split())
+    return value or None
+
+def name_key(value):
+    """The key spellings of one value share"""
+    value = clean_name(value)
+    return value.lower() if value else None
+
+def lookup_fields(model):
+    """(name, id column, lookup table, default) of each interned field of a model"""
+    return _models.get(model, [])
+
+def stored_attribute(model, name):
+    """The mapped column holding a field of model, the id column for lookup fields"""
+    for field, id_column, _, _ in lookup_fields(model):
+        if field == name:
+            return id_column
+    return name
+
+def _primary_key(table):
+    return list(table.primary_key)[0]
+
+def lookup_name(name, id_column, relationship, lookup_model):
+    """Hybrid property exposing the name of the lookup row an id column points at
+
+    relationship is the name of the model's relationship to lookup_model.
+    """
+    lookup_table = lookup_model.__table__
+
+    def get_name(obj):
+        pending = obj.__dict__.get(PENDING_NAMES)
+        if pending and name in pending:
+            return pending[name]
+        entry = getattr(obj, relationship)
+        return entry.name if entry is not None else None
+
+    def set_name(obj, value):
+        if clean_name(value) == get_name(obj):
+            return
+        previous = obj.__dict__.setdefault(PREVIOUS_NAMES, {})
+        if name not in previous:
+            previous[name] = get_name(obj)
+        obj.__dict__.setdefault(PENDING_NAMES, {})[name] = clean_name(value)
+        # Puts the object in session.dirty so the flush resolves the name
+        flag_dirty(obj)
+
+    expressions = {}
+
+    def name_expression(cls):
+        # Built once per class: model constructors look up every keyword
+        # argument on the class, which asks for this expression per row
+        if cls not in expressions:
+            expressions[cls] = select(lookup_table.c.name).where(
+                _primary_key(lookup_table) == getattr(cls, id_column)
+            ).scalar_subquery().label(name)
+        return expressions[cls]
+
+    return hybrid_property(get_name, set_name, expr=name_expression)
+
+def previous_name(obj, name):
+    """The value of a lookup field before the changes the session is flushing"""
+    previous = obj.__dict__.get(PREVIOUS_NAMES)
+    if previous and name in previous:
+        return previous[name]
+    return getattr(obj, name)
+
+def name_in(model, name, values):
+    """SQL condition matching rows whose lookup field is one of values, in any case"""
+    for field, id_column, table, _ in lookup_fields(model):
+        if field == name:
+            keys = sorted({name_key(value) for value in values} - {None})
+            return model.__table__.c[id_column].in_(
+                select(_primary_key(table)).where(table.c.name_key.in_(keys))
+            )
+    raise KeyError(f"{model.__name__} has no lookup field {name}")
+
+def lookup_join(model, name, alias_name=None):
+    """(aliased lookup table, join condition) to read a lookup field of model's table in SQL"""
+    for field, id_column, table, _ in lookup_fields(model):
+        if field == name:
+            alias = table.alias(alias_name or f"{name}_lookup")
+            return alias, _primary_key(alias) == model.__table__.c[id_column]
+    raise KeyError(f"{model.__name__} has no lookup field {name}")
+
+def _insert_missing(connection, table, rows):
+    """Insert lookup rows, skipping names another transaction added first"""
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table).on_conflict_do_nothing(index_elements=['name_key'])
+    elif dialect == 'sqlite':
+        statement = sqlite.insert(table).on_conflict_do_nothing(index_elements=['name_key'])
+    else:
+        statement = table.insert()
+    connection.execute(statement, rows)
+
+def resolve_names(connection, table, names, preferred=None):
+    """{key: (id, name)} for names, adding lookup rows for the new ones
+
+    preferred maps a key to the spelling a new row should get, by default
+    the first one given.
+    """
+    spellings = {}
+    for name in names:
+        key = name_key(name)
+        if key is not None:
+            spellings.setdefault(key, clean_name(name))
+    if preferred:
+        spellings.update({key: name for key, name in preferred.items() if key in spellings})
+    if not spellings:
+        return {}
+
+    pk = _primary_key(table)
+
+    def load(keys):
+        found = {}
+        for chunk_start in range(0, len(keys), 500):
+            chunk = keys[chunk_start:chunk_start + 500]
+            for lookup_id, name, key in connection.execute(
+                select(pk, table.c.name, table.c.name_key).where(table.c.name_key.in_(chunk))
+            ):
+                found[key] = (lookup_id, name)
+        return found
+
+    resolved = load(list(spellings))
+    missing = [key for key in spellings if key not in resolved]
+    if missing:
+        _insert_missing(connection, table, [{'name': spellings[key], 'name_key': key} for key in missing])
+        resolved.update(load(missing))
+    return resolved
+
+def _resolve_in_session(session, table, names):
+    """resolve_names through the worker's cache of committed lookup rows"""
+    known = _known.get(table.name, {})
+    staged = session.info.setdefault(RESOLVED_KEY, {}).setdefault(table.name, {})
+    resolved = {}
+    missing = []
+    for name in names:
+        key = name_key(name)
+        if key is None:
+            continue
+        entry = staged.get(key) or known.get(key)
+        if entry is None:
+            missing.append(name)
+        else:
+            resolved[key] = entry
+    if missing:
+        found = resolve_names(session.connection(), table, missing)
+        # Only cached once committed, a rollback may take new rows with it
+        staged.update(found)
+        resolved.update(found)
+    return resolved
+
+def intern_rows(connection, model, rows):
+    """Set the lookup ids and spellings of row dicts of a model in place
+
+    For code writing rows with bulk_insert_mappings, bulk_update_mappings
+    or Core inserts, which skip the flush events; only the fields present
+    in each row are touched. The names stay in the rows for the caller.
+    """
+    for name, id_column, table, _ in lookup_fields(model):
+        present = [row for row in rows if name in row]
+        if not present:
+            continue
+        resolved = resolve_names(connection, table, [row[name] for row in present])
+        for row in present:
+            lookup_id, spelling = resolved.get(name_key(row[name]), (None, None))
+            row[name] = spelling
+            row[id_column] = lookup_id
+
+def _respell(session, table, respelled):
+    """Give lookup rows new spellings, {key: (id, name)}, and restamp the rows using them"""
+    connection = session.connection()
+    pk = _primary_key(table)
+    connection.execute(
+        table.update().where(pk == bindparam('lookup_id')).values(name=bindparam('lookup_name')),
+        [{'lookup_id': lookup_id, 'lookup_name': spelling} for lookup_id, spelling in respelled.values()]
+    )
+    session.info.setdefault(RESOLVED_KEY, {}).setdefault(table.name, {}).update(respelled)
+    lookup_ids = [lookup_id for lookup_id, _ in respelled.values()]
+    for model, fields in _models.items():
+        for _, id_column, lookup_table, _ in fields:
+            if lookup_table is not table:
+                continue
+            model_table = model.__table__
+            keys = [key for key, in connection.execute(
+                select(_primary_key(model_table)).where(model_table.c[id_column].in_(lookup_ids))
+            )]
+            stamp_rows(connection, model_table, keys)
+            if keys:
+                bump_table_versions(connection, [model_table.name])
+    logger.info(f"Respelled {len(respelled)} {table.name} values")
+
+def _forget_names(obj, *args):
+    obj.__dict__.pop(PENDING_NAMES, None)
+    obj.__dict__.pop(PREVIOUS_NAMES, None)
+
+def _forget_ids(*args, **kwargs):
+    _known.clear()
+
+def setup_lookups(equipment_model, log_model, pump_model_model, oil_type_model, person_model, service_model):
+    """Resolve the lookup names of equipment and maintenance logs as they are flushed"""
+    _models[equipment_model] = [
+        ('pump_model', 'pump_model_id', pump_model_model.__table__, None),
+        ('oil_type', 'oil_type_id', oil_type_model.__table__, None),
+        ('pump_owner', 'owner_id', person_model.__table__, None)
+    ]
+    _models[log_model] = [
+        ('service', 'service_id', service_model.__table__, 'None Required'),
+        ('user_name', 'user_id', person_model.__table__, None)
+    ]
+
+    for model in _models:
+        # Names read after a commit or refresh come from the lookup rows
+        event.listen(model, 'expire', _forget_names)
+        event.listen(model, 'refresh', _forget_names)
+    for lookup_model in (pump_model_model, oil_type_model, person_model, service_model):
+        # A new or emptied table invalidates the cached ids, as tests and
+        # benchmarks do when they create their databases again
+        event.listen(lookup_model.__table__, 'after_create', _forget_ids)
+        event.listen(lookup_model.__table__, 'after_drop', _forget_ids)
+
+    @event.listens_for(Session, "before_flush")
+    def resolve_flushed_names(session, flush_context, instances):
+        # Gather the assigned names per lookup table, then resolve each
+        # table's names at once
+        pending = {}
+        # session.new builds a new set on every access
+        new = session.new
+        for obj in list(new) + list(session.dirty):
+            fields = _models.get(type(obj))
+            if not fields:
+                continue
+            is_new = obj in new
+            for name, id_column, table, default in fields:
+                names = obj.__dict__.get(PENDING_NAMES, {})
+                if name not in names:
+                    if not is_new or default is None or getattr(obj, id_column) is not None:
+                        continue
+                    setattr(obj, name, default)
+                pending.setdefault(table, []).append((obj, name, id_column))
+        if not pending:
+            return
+
+        with session.no_autoflush:
+            for table, targets in pending.items():
+                resolved = _resolve_in_session(
+                    session, table, [obj.__dict__[PENDING_NAMES][name] for obj, name, _ in targets]
+                )
+                respelled = {}
+                for obj, name, id_column in targets:
+                    names = obj.__dict__[PENDING_NAMES]
+                    key = name_key(names[name])
+                    lookup_id, spelling = resolved.get(key, (None, None))
+                    previous = obj.__dict__.get(PREVIOUS_NAMES, {}).get(name)
+                    if spelling != names[name] and previous is not None and name_key(previous) == key:
+                        # Only the case of the row's value changed
+                        respelled[key] = (lookup_id, names[name])
+                        spelling = names[name]
+                    names[name] = spelling
+                    if getattr(obj, id_column) != lookup_id:
+                        setattr(obj, id_column, lookup_id)
+                if respelled:
+                    _respell(session, table, respelled)
+
+    @event.listens_for(Session, "after_flush")
+    def forget_previous_names(session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            obj.__dict__.pop(PREVIOUS_NAMES, None)
+
+    @event.listens_for(Session, "after_commit")
+    def remember_resolved(session):
+        for table_name, entries in session.info.pop(RESOLVED_KEY, {}).items():
+            _known.setdefault(table_name, {}).update(entries)
+
+    @event.listens_for(Session, "after_rollback")
+    def discard_resolved(session):
+        session.info.pop(RESOLVED_KEY, None)
+
+def used_names(session, lookup_model, *references):
+    """Names of a lookup table that at least one of the (model, id column) references uses
+
+    Each reference is checked with an EXISTS on its indexed id column, so
+    the list costs an index probe per lookup row instead of a DISTINCT over
+    every row.
+    """
+    table = lookup_model.__table__
+    pk = _primary_key(table)
+    used = or_(*[
+        exists().where(getattr(model, id_column) == pk)
+        for model, id_column in references
+    ])
+    return [name for name, in session.execute(select(table.c.name).where(used).order_by(table.c.name))]
+
+def _spelling_counts(connection, table, text_column, id_column):
+    """{key: {spelling: rows}} of rows whose id is not set yet"""
+    text = table.c[text_column]
+    counts = {}
+    for spelling, count in connection.execute(
+        select(text, func.count()).where(table.c[id_column].is_(None), text.isnot(None)).group_by(text)
+    ):
+        key = name_key(spelling)
+        if key is not None:
+            counts.setdefault(key, {})[spelling] = count
+    return counts
+
+def backfill_lookups(engine):
+    """Intern the text columns of databases from before the lookup ids
+
+    Only does anything while a text column is still there, as it is until
+    drop_replaced_columns removes it. A value new to its lookup table gets
+    its most common spelling (the first alphabetically on a tie), and rows
+    spelled differently get new change sequence numbers, so /api/changes
+    clients receive the new spelling. Returns the number of rows interned.
+    Safe to run on every start.
+    """
+    try:
+        interned = 0
+        inspector = inspect(engine)
+        with engine.begin() as connection:
+            for model, fields in _models.items():
+                table_name = model.__table__.name
+                if not inspector.has_table(table_name):
+                    continue
+                columns = {column['name'] for column in inspector.get_columns(table_name)}
+                legacy = [field for field in fields if field[0] in columns]
+                if not legacy:
+                    continue
+                # The models no longer map the text columns, so read them
+                # through the live table
+                table = Table(table_name, MetaData(), autoload_with=connection)
+                for text_column, id_column, lookup_table, _ in legacy:
+                    counts = _spelling_counts(connection, table, text_column, id_column)
+                    if not counts:
+                        continue
+                    preferred = {
+                        key: sorted(spellings.items(), key=lambda item: (-item[1], item[0]))[0][0]
+                        for key, spellings in counts.items()
+                    }
+                    resolved = resolve_names(connection, lookup_table, list(preferred.values()), preferred)
+
+                    # One statement per field, so the table is scanned once
+                    ids, respelled = {}, []
+                    for key, spellings in counts.items():
+                        lookup_id, name = resolved[key]
+                        for spelling in spellings:
+                            ids[spelling] = lookup_id
+                            if spelling != name:
+                                respelled.append(spelling)
+                        interned += sum(spellings.values())
+
+                    text = table.c[text_column]
+                    pending = table.c[id_column].is_(None)
+                    respelled_keys = []
+                    if respelled and 'change_seq' in table.c:
+                        primary_key = _primary_key(table)
+                        respelled_keys = [key for key, in connection.execute(
+                            select(primary_key).where(pending, text.in_(respelled))
+                        )]
+                        logger.info(f"Respelling {len(respelled)} {table.name}.{text_column} values")
+                    connection.execute(
+                        table.update().where(pending, text.in_(list(ids))).values({id_column: case(ids, value=text)})
+                    )
+                    stamp_rows(connection, table, respelled_keys)
+        if interned:
+            logger.info(f"Interned {interned} lookup values")
+        return interned
+    except Exception as e:
+        logger.error(f"Error interning lookup values: {e}")
+        return 0
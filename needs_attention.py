@@ -0,0 +1,362 @@
+"""
+Needs-attention queue of pumps that are overdue or keep needing oil
+
+pump_attention holds one row per pump, computed from its maintenance logs
+by a single window-function statement:
+
+- ROW_NUMBER() over each pump's logs, newest first, picks its last check
+- LAG(check_date) gives the check before it, so the page can show the gap
+  between the last two checks
+- LAG() of a running MAX() over the pump's oil service dates gives the
+  previous oil service of each log; an oil service within REPEAT_OIL_DAYS
+  of the previous one counts as a repeat
+
+Whether a pump is overdue depends on today's date, so that is decided when
+the queue is read, by comparing last_check_date with an indexed range. The
+rows of the pumps a flush touches are recomputed in the same transaction,
+and Query.delete() or Query.update() on maintenance_log makes the commit
+recompute every pump.
+"""
+import logging
+from datetime import date, datetime, timedelta
+from flask import request, jsonify
+from sqlalchemy import event, func, select, case, and_, or_
+from sqlalchemy.orm import Session
+from data_version import conditional_json
+from eligibility import weekly_log_filter
+from upserts import upsert_rows, lock_keys
+from lookups import name_in
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+OIL_SERVICES = ('Add Oil', 'Drain & Replace Oil')
+
+# A pump not checked for longer than this is overdue
+OVERDUE_DAYS = 14
+# An oil service this soon after the previous one is a repeat
+REPEAT_OIL_DAYS = 31
+# Repeat oil services keep a pump in the queue for this long
+REPEAT_OIL_WINDOW_DAYS = 90
+DEFAULT_LIMIT = 100
+
+# Session.info flag set by bulk changes of maintenance logs
+REFRESH_ALL_FLAG = 'needs_attention_refresh_all'
+# Session.info set of pumps to recompute once the flush has written their logs
+PENDING_KEY = 'needs_attention_pending'
+
+# Sort keys accepted by /api/needs-attention
+SORT_KEYS = ('days_since_check', 'last_check_date', 'repeat_oil_count', 'last_repeat_oil_date',
+             'equipment_id', 'equipment_name')
+
+_attention_table = None
+_log_table = None
+_log_model = None
+_equipment_model = None
+
+def _days_between(later, earlier, dialect_name):
+    """Whole days from earlier to later as a SQL expression"""
+    if dialect_name == 'postgresql':
+        return later - earlier
+    return func.julianday(later) - func.julianday(earlier)
+
+def _as_date(value):
+    # SQLite hands back dates picked by CASE and MAX as strings
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value
+
+def attention_statement(dialect_name, equipment_ids=None):
+    """The one statement computing pump_attention rows from the logs"""
+    log = _log_table
+    is_oil = name_in(_log_model, 'service', OIL_SERVICES)
+    pump_filter = [] if equipment_ids is None else [log.c.equipment_id.in_(list(equipment_ids))]
+
+    window = {'partition_by': log.c.equipment_id, 'order_by': (log.c.check_date, log.c.log_id)}
+    numbered = select(
+        log.c.equipment_id,
+        log.c.log_id,
+        log.c.check_date,
+        is_oil.label('is_oil'),
+        func.lag(log.c.check_date).over(**window).label('previous_check_date'),
+        # Latest oil service up to and including each log
+        func.max(case((is_oil, log.c.check_date))).over(**window).label('oil_date_so_far'),
+        func.row_number().over(
+            partition_by=log.c.equipment_id,
+            order_by=(log.c.check_date.desc(), log.c.log_id.desc())
+        ).label('position')
+    ).where(*pump_filter).subquery()
+
+    ordered = select(
+        numbered,
+        func.lag(numbered.c.oil_date_so_far).over(
+            partition_by=numbered.c.equipment_id,
+            order_by=(numbered.c.check_date, numbered.c.log_id)
+        ).label('previous_oil_date')
+    ).subquery()
+
+    is_last = ordered.c.position == 1
+    is_repeat = and_(
+        ordered.c.is_oil,
+        ordered.c.previous_oil_date.isnot(None),
+        _days_between(ordered.c.check_date, ordered.c.previous_oil_date, dialect_name) <= REPEAT_OIL_DAYS
+    )
+    return select(
+        ordered.c.equipment_id,
+        func.count().label('log_count'),
+        func.max(case((is_last, ordered.c.check_date))).label('last_check_date'),
+        func.max(case((is_last, ordered.c.previous_check_date))).label('previous_check_date'),
+        func.max(case((ordered.c.is_oil, ordered.c.check_date))).label('last_oil_date'),
+        func.sum(case((is_repeat, 1), else_=0)).label('repeat_oil_count'),
+        func.max(case((is_repeat, ordered.c.check_date))).label('last_repeat_oil_date')
+    ).group_by(ordered.c.equipment_id)
+
+def refresh_attention(connection, equipment_ids=None):
+    """Recompute pump_attention for the given pumps, or for every pump
+
+    Rows are upserted, and only pumps left without logs lose theirs. On
+    PostgreSQL the given pumps' rows are locked first, see upserts.
+    """
+    now = datetime.utcnow()
+    table = _attention_table
+    if equipment_ids is not None:
+        equipment_ids = sorted(set(equipment_ids))
+        lock_keys(connection, table, 'equipment_id', equipment_ids, lambda equipment_id: {
+            'equipment_id': equipment_id, 'log_count': 0, 'repeat_oil_count': 0, 'updated_at': now
+        })
+    rows = [
+        {
+            'equipment_id': row.equipment_id,
+            'log_count': row.log_count,
+            'last_check_date': _as_date(row.last_check_date),
+            'previous_check_date': _as_date(row.previous_check_date),
+            'last_oil_date': _as_date(row.last_oil_date),
+            'repeat_oil_count': int(row.repeat_oil_count or 0),
+            'last_repeat_oil_date': _as_date(row.last_repeat_oil_date),
+            'updated_at': now
+        }
+        for row in connection.execute(attention_statement(connection.dialect.name, equipment_ids))
+    ]
+    upsert_rows(connection, table, rows, 'equipment_id')
+
+    refreshed = [row['equipment_id'] for row in rows]
+    if equipment_ids is None:
+        connection.execute(table.delete().where(table.c.equipment_id.notin_(refreshed)))
+    else:
+        emptied = sorted(set(equipment_ids) - set(refreshed))
+        if emptied:
+            connection.execute(table.delete().where(table.c.equipment_id.in_(emptied)))
+    return len(rows)
+
+def mark_pumps_changed(session, equipment_ids):
+    """Recompute these pumps' rows now, for logs written without a flush
+
+    bulk_insert_mappings and bulk_update_mappings skip the flush events, so
+    code using them must call this itself.
+    """
+    equipment_ids = set(equipment_ids)
+    if equipment_ids:
+        refresh_attention(session.connection(), equipment_ids)
+
+def attention_reasons(attention, today, overdue_days=OVERDUE_DAYS):
+    """Why a pump is in the queue, given its pump_attention row or None"""
+    if attention is None or attention.last_check_date is None:
+        return ['never_checked']
+    reasons = []
+    if (today - attention.last_check_date).days > overdue_days:
+        reasons.append('overdue')
+    if attention.last_repeat_oil_date and attention.last_repeat_oil_date >= today - timedelta(days=REPEAT_OIL_WINDOW_DAYS):
+        reasons.append('repeat_oil')
+    return reasons
+
+def attention_query(session, attention_model, equipment_model, today, overdue_days=OVERDUE_DAYS,
+                    include_all=False, sort='days_since_check', descending=None):
+    """Query of (equipment, pump_attention or None) pairs in queue order
+
+    Pumps without logs have no pump_attention row and always need attention.
+    Only pumps the weekly log lists are included.
+    """
+    query = session.query(equipment_model, attention_model).outerjoin(
+        attention_model, attention_model.equipment_id == equipment_model.equipment_id
+    ).filter(weekly_log_filter(equipment_model))
+    if not include_all:
+        query = query.filter(or_(
+            attention_model.equipment_id.is_(None),
+            attention_model.last_check_date < today - timedelta(days=overdue_days),
+            attention_model.last_repeat_oil_date >= today - timedelta(days=REPEAT_OIL_WINDOW_DAYS)
+        ))
+
+    columns = {
+        'days_since_check': attention_model.last_check_date,
+        'last_check_date': attention_model.last_check_date,
+        'repeat_oil_count': attention_model.repeat_oil_count,
+        'last_repeat_oil_date': attention_model.last_repeat_oil_date,
+        'equipment_id': equipment_model.equipment_id,
+        'equipment_name': equipment_model.equipment_name
+    }
+    column = columns[sort]
+    if descending is None:
+        # Longest since the last check and most repeats first
+        descending = sort in ('days_since_check', 'repeat_oil_count', 'last_repeat_oil_date')
+    if sort == 'days_since_check':
+        # More days since the last check is an earlier date, and a pump
+        # never checked (no row) has gone the longest
+        descending = not descending
+    order = column.desc().nullslast() if descending else column.asc().nullsfirst()
+    return query.order_by(order, equipment_model.equipment_id)
+
+def attention_item(equipment, attention, today, overdue_days=OVERDUE_DAYS):
+    """JSON-ready queue entry of a pump"""
+    days_since_check = None
+    if attention is not None and attention.last_check_date is not None:
+        days_since_check = (today - attention.last_check_date).days
+    return dict(
+        equipment.to_dict(),
+        attention=attention.to_dict() if attention is not None else None,
+        days_since_check=days_since_check,
+        reasons=attention_reasons(attention, today, overdue_days)
+    )
+
+def _positive_int(value, default, name):
+    if value is None or value == '':
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a whole number")
+    if number < 1:
+        raise ValueError(f"{name} must be at least 1")
+    return number
+
+def setup_needs_attention(app, db, attention_model, log_model, equipment_model):
+    """Keep pump_attention current and register /api/needs-attention"""
+    global _attention_table, _log_table, _log_model, _equipment_model
+    _attention_table = attention_model.__table__
+    _log_table = log_model.__table__
+    _log_model = log_model
+    _equipment_model = equipment_model
+
+    @event.listens_for(Session, "before_flush")
+    def collect_changed_pumps(session, flush_context, instances):
+        if session.info.get(REFRESH_ALL_FLAG):
+            # Recomputed at commit anyway
+            return
+        changed = set()
+        removed_pumps = []
+        for obj in session.new:
+            if isinstance(obj, _log_model):
+                changed.add(obj.equipment_id)
+        for obj in session.deleted:
+            if isinstance(obj, _log_model):
+                changed.add(obj.equipment_id)
+            elif isinstance(obj, _equipment_model):
+                removed_pumps.append(obj.equipment_id)
+        for obj in session.dirty:
+            if not isinstance(obj, _log_model):
+                continue
+            state = obj._sa_instance_state
+            history = [state.attrs[field].history for field in ('equipment_id', 'check_date', 'service_id')]
+            if any(h.has_changes() for h in history):
+                changed.add(obj.equipment_id)
+                changed.update(history[0].deleted)
+
+        changed.discard(None)
+        changed.difference_update(removed_pumps)
+        if changed:
+            session.info.setdefault(PENDING_KEY, set()).update(changed)
+        if removed_pumps:
+            session.connection().execute(
+                _attention_table.delete().where(_attention_table.c.equipment_id.in_(removed_pumps))
+            )
+
+    @event.listens_for(Session, "after_flush")
+    def refresh_flushed_pumps(session, flush_context):
+        pending = session.info.pop(PENDING_KEY, None)
+        if pending:
+            refresh_attention(session.connection(), pending)
+
+    @event.listens_for(Session, "do_orm_execute")
+    def flag_bulk_log_changes(orm_execute_state):
+        # Query.delete() and Query.update() do not say which logs changed
+        if orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = getattr(orm_execute_state.statement, 'table', None)
+            if table is not None and table.name == _log_table.name:
+                orm_execute_state.session.info[REFRESH_ALL_FLAG] = True
+
+    @event.listens_for(Session, "before_commit")
+    def refresh_after_bulk_changes(session):
+        if session.info.get(REFRESH_ALL_FLAG):
+            session.flush()
+            session.info.pop(REFRESH_ALL_FLAG, None)
+            refresh_attention(session.connection())
+
+    @event.listens_for(Session, "after_rollback")
+    def clear_pending(session):
+        session.info.pop(REFRESH_ALL_FLAG, None)
+        session.info.pop(PENDING_KEY, None)
+
+    @app.route('/api/needs-attention')
+    def needs_attention():
+        """Pumps that are overdue, never checked or keep needing oil
+
+        Query parameters: sort (one of SORT_KEYS, default days_since_check),
+        order (asc or desc), overdue_days, limit, and all=true to list every
+        pump with its figures.
+        """
+        sort = request.args.get('sort', 'days_since_check')
+        order = request.args.get('order', '').lower()
+        if sort not in SORT_KEYS:
+            return jsonify({"error": f"sort must be one of {', '.join(SORT_KEYS)}"}), 400
+        if order not in ('', 'asc', 'desc'):
+            return jsonify({"error": "order must be asc or desc"}), 400
+        try:
+            overdue_days = _positive_int(request.args.get('overdue_days'), OVERDUE_DAYS, 'overdue_days')
+            limit = _positive_int(request.args.get('limit'), DEFAULT_LIMIT, 'limit')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        include_all = request.args.get('all', '').lower() == 'true'
+        today = datetime.now().date()
+
+        def build_payload():
+            rows = attention_query(
+                db.session, attention_model, equipment_model, today, overdue_days, include_all,
+                sort, None if not order else order == 'desc'
+            ).limit(limit).all()
+            return {
+                'pumps': [attention_item(equipment, attention, today, overdue_days) for equipment, attention in rows],
+                'sort': sort,
+                'order': order or None,
+                'thresholds': {
+                    'overdue_days': overdue_days,
+                    'repeat_oil_days': REPEAT_OIL_DAYS,
+                    'repeat_oil_window_days': REPEAT_OIL_WINDOW_DAYS
+                }
+            }
+
+        try:
+            key = f"needs-attention|{sort}|{order}|{overdue_days}|{limit}|{include_all}|{today}"
+            return conditional_json(db.session, key, build_payload)
+        except Exception as e:
+            logger.error(f"Error loading needs-attention queue: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    return _attention_table
+
+def backfill_attention(engine):
+    """Compute pump_attention when it is still empty but logs exist
+
+    Safe to run on every start and from several workers at once.
+    """
+    try:
+        with engine.begin() as connection:
+            has_rows = connection.execute(select(_attention_table.c.equipment_id).limit(1)).first()
+            has_logs = connection.execute(select(_log_table.c.log_id).limit(1)).first()
+            if has_rows or not has_logs:
+                return 0
+            count = refresh_attention(connection)
+        logger.info(f"Computed needs-attention rows for {count} pumps")
+        return count
+    except Exception as e:
+        # Usually another worker filled the table first
+        logger.warning(f"Needs-attention backfill skipped: {e}")
+        return 0
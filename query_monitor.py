@@ -0,0 +1,432 @@
+"""
+Slow-query, lock-timeout and connection pool monitoring for the Vacuum Pump
+Maintenance application
+"""
+import os
+import re
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from flask import request, jsonify, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Patterns used to normalize SQL so that the same statement with different
+# literal values maps to a single fingerprint
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_NAMED_PARAM = re.compile(r"%\(\w+\)s|:\w+\b")
+_POSITIONAL_PARAM = re.compile(r"%s|\?")
+_PARAM_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+# Only read-only statements are explained, EXPLAIN ANALYZE executes its query
+_EXPLAINABLE = ('SELECT', 'WITH')
+
+# Upper bound on the number of distinct statements kept in memory
+MAX_TRACKED_STATEMENTS = 500
+
+# Driver error messages that mean a statement gave up waiting for a lock
+LOCK_TIMEOUT_PATTERNS = (
+    'database is locked',
+    'database table is locked',
+    'lock timeout',
+    'could not obtain lock',
+    'deadlock detected'
+)
+
+# Connection checkouts slower than this are counted as pool waits
+POOL_WAIT_THRESHOLD_MS = 10.0
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+_db_stats = {
+    'lock_timeouts': 0,
+    'last_lock_timeout': None,
+    'pool_checkouts': 0,
+    'pool_waits': 0,
+    'pool_wait_total_ms': 0.0,
+    'pool_wait_max_ms': 0.0,
+    'pool_timeouts': 0
+}
+_db_stats_lock = threading.Lock()
+_instrumented_pools = set()
+
+def normalize_sql(statement):
+    """Collapse literals, bind parameters and whitespace in a SQL statement"""
+    normalized = _STRING_LITERAL.sub('?', statement)
+    normalized = _NAMED_PARAM.sub('?', normalized)
+    normalized = _POSITIONAL_PARAM.sub('?', normalized)
+    normalized = _NUMBER_LITERAL.sub('?', normalized)
+    normalized = _PARAM_LIST.sub('(?+)', normalized)
+    return _WHITESPACE.sub(' ', normalized).strip()
+
+def fingerprint_sql(normalized):
+    """Get a short stable identifier for a normalized SQL statement"""
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+def _redact_value(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return '<bool>'
+    if isinstance(value, str):
+        return f'<str:{len(value)}>'
+    return f'<{type(value).__name__}>'
+
+def redact_parameters(parameters, executemany=False):
+    """Replace bound parameter values with their types so no data is logged"""
+    if parameters is None:
+        return None
+    if executemany:
+        return f'<{len(parameters)} parameter sets>'
+    if isinstance(parameters, dict):
+        return {key: _redact_value(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_redact_value(value) for value in parameters]
+    return _redact_value(parameters)
+
+def _current_route():
+    """Get a description of the request that issued the statement"""
+    if not has_request_context():
+        return 'background'
+    try:
+        return f"{request.method} {request.endpoint or request.path}"
+    except Exception:
+        return 'unknown'
+
+def _format_plan_rows(rows):
+    lines = []
+    for row in rows:
+        if len(row) == 1:
+            lines.append(str(row[0]))
+        else:
+            # SQLite EXPLAIN QUERY PLAN rows are (id, parent, notused, detail)
+            lines.append(' | '.join(str(col) for col in row))
+    return '\n'.join(lines)
+
+def capture_plan(conn, statement, parameters, analyze=False):
+    """Run EXPLAIN for a statement on the connection that executed it
+
+    Uses the raw DBAPI cursor so the EXPLAIN itself does not go through the
+    SQLAlchemy event hooks and trigger another slow-query capture.
+    """
+    dialect = conn.dialect.name
+    raw_connection = conn.connection
+    cursor = raw_connection.cursor()
+    try:
+        if dialect == 'sqlite':
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ())
+            return _format_plan_rows(cursor.fetchall())
+
+        if dialect == 'postgresql':
+            prefix = 'EXPLAIN (ANALYZE, BUFFERS)' if analyze else 'EXPLAIN'
+            # A failed EXPLAIN would abort the surrounding transaction
+            cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(f"{prefix} {statement}", parameters)
+                plan = _format_plan_rows(cursor.fetchall())
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+                return plan
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                raise
+
+        return None
+    finally:
+        cursor.close()
+
+def _evict_if_full():
+    """Drop the statement with the least total time when the table is full"""
+    if len(_stats) < MAX_TRACKED_STATEMENTS:
+        return
+    coolest = min(_stats, key=lambda key: _stats[key]['total_ms'])
+    del _stats[coolest]
+
+def record_slow_query(conn, statement, parameters, duration_ms, executemany, config):
+    """Record a statement that exceeded the slow-query threshold"""
+    normalized = normalize_sql(statement)
+    fingerprint = fingerprint_sql(normalized)
+    route = _current_route()
+    redacted = redact_parameters(parameters, executemany)
+    now = time.time()
+
+    with _stats_lock:
+        entry = _stats.get(fingerprint)
+        if entry is None:
+            _evict_if_full()
+            entry = {
+                'fingerprint': fingerprint,
+                'sql': normalized,
+                'count': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'last_ms': 0.0,
+                'last_seen': None,
+                'routes': {},
+                'last_parameters': None,
+                'plan': None,
+                'plan_captured_at': 0.0
+            }
+            _stats[fingerprint] = entry
+
+        entry['count'] += 1
+        entry['total_ms'] += duration_ms
+        entry['max_ms'] = max(entry['max_ms'], duration_ms)
+        entry['last_ms'] = duration_ms
+        entry['last_seen'] = datetime.now().isoformat()
+        entry['routes'][route] = entry['routes'].get(route, 0) + 1
+        entry['last_parameters'] = redacted
+
+        # Rate-limit plan capture per fingerprint
+        should_explain = (
+            config['explain']
+            and not executemany
+            and normalized.upper().startswith(_EXPLAINABLE)
+            and now - entry['plan_captured_at'] >= config['explain_interval']
+        )
+        if should_explain:
+            entry['plan_captured_at'] = now
+
+    logger.warning(f"Slow query ({duration_ms:.1f} ms) [{fingerprint}] from {route}: {normalized} params={redacted}")
+
+    if should_explain:
+        try:
+            plan = capture_plan(conn, statement, parameters, analyze=config['explain_analyze'])
+            if plan:
+                with _stats_lock:
+                    entry['plan'] = plan
+                logger.info(f"Query plan for [{fingerprint}]:\n{plan}")
+        except Exception as e:
+            logger.error(f"Error capturing query plan for [{fingerprint}]: {e}")
+
+def get_slow_queries(sort='total_ms', limit=20):
+    """Get the top slow statements ordered by the given metric"""
+    if sort not in ('total_ms', 'max_ms', 'count', 'avg_ms'):
+        sort = 'total_ms'
+
+    with _stats_lock:
+        entries = []
+        for entry in _stats.values():
+            item = dict(entry)
+            item['routes'] = dict(entry['routes'])
+            item['avg_ms'] = entry['total_ms'] / entry['count'] if entry['count'] else 0.0
+            item['total_ms'] = round(item['total_ms'], 2)
+            item['max_ms'] = round(item['max_ms'], 2)
+            item['last_ms'] = round(item['last_ms'], 2)
+            item['avg_ms'] = round(item['avg_ms'], 2)
+            item.pop('plan_captured_at', None)
+            entries.append(item)
+
+    entries.sort(key=lambda x: x[sort], reverse=True)
+    return entries[:limit]
+
+def reset_slow_queries():
+    """Clear all recorded slow statements"""
+    with _stats_lock:
+        _stats.clear()
+
+def record_lock_timeout(message):
+    """Count a statement that failed because it could not get a lock"""
+    with _db_stats_lock:
+        _db_stats['lock_timeouts'] += 1
+        _db_stats['last_lock_timeout'] = datetime.now().isoformat()
+    logger.warning(f"Lock timeout from {_current_route()}: {message}")
+
+def instrument_pool(pool):
+    """Time every connection checkout from a connection pool
+
+    Checkouts slower than POOL_WAIT_THRESHOLD_MS are counted as waits for a
+    free connection, and checkouts that give up are counted as timeouts.
+    """
+    if id(pool) in _instrumented_pools:
+        return
+    _instrumented_pools.add(id(pool))
+    original_connect = pool.connect
+
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return original_connect()
+        except Exception as e:
+            if type(e).__name__ == 'TimeoutError':
+                with _db_stats_lock:
+                    _db_stats['pool_timeouts'] += 1
+            raise
+        finally:
+            waited_ms = (time.perf_counter() - start) * 1000
+            with _db_stats_lock:
+                _db_stats['pool_checkouts'] += 1
+                if waited_ms >= POOL_WAIT_THRESHOLD_MS:
+                    _db_stats['pool_waits'] += 1
+                    _db_stats['pool_wait_total_ms'] += waited_ms
+                _db_stats['pool_wait_max_ms'] = max(_db_stats['pool_wait_max_ms'], waited_ms)
+
+    pool.connect = timed_connect
+
+def get_db_stats(engine=None):
+    """Get lock-timeout and connection pool counters for this worker"""
+    with _db_stats_lock:
+        stats = dict(_db_stats)
+    stats['pool_wait_total_ms'] = round(stats['pool_wait_total_ms'], 2)
+    stats['pool_wait_max_ms'] = round(stats['pool_wait_max_ms'], 2)
+    stats['worker_pid'] = os.getpid()
+    if engine is not None:
+        stats['pool_status'] = engine.pool.status()
+    return stats
+
+def reset_db_stats():
+    """Clear the lock-timeout and connection pool counters"""
+    with _db_stats_lock:
+        for key in _db_stats:
+            _db_stats[key] = None if key == 'last_lock_timeout' else 0
+
+class QueryCounter:
+    """Count the SQL statements the current thread executes while the counter is active
+
+    An executemany call counts as a single statement. Statements of
+    background threads, such as the anomaly refresher, are left out.
+    """
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+        self._thread_id = None
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() != self._thread_id:
+            return
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        event.listen(Engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(Engine, "before_cursor_execute", self._on_execute)
+        return False
+
+def setup_query_monitor(app):
+    """Setup slow-query logging and the admin endpoints for the application"""
+    app.config.setdefault('SLOW_QUERY_LOG', os.environ.get('SLOW_QUERY_LOG', 'true').lower() == 'true')
+    app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', '250')))
+    app.config.setdefault('SLOW_QUERY_EXPLAIN', os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() == 'true')
+    app.config.setdefault('SLOW_QUERY_EXPLAIN_ANALYZE', os.environ.get('SLOW_QUERY_EXPLAIN_ANALYZE', 'false').lower() == 'true')
+    app.config.setdefault('SLOW_QUERY_EXPLAIN_INTERVAL', float(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', '300')))
+
+    def monitor_config():
+        return {
+            'threshold_ms': app.config['SLOW_QUERY_THRESHOLD_MS'],
+            'explain': app.config['SLOW_QUERY_EXPLAIN'],
+            'explain_analyze': app.config['SLOW_QUERY_EXPLAIN_ANALYZE'],
+            'explain_interval': app.config['SLOW_QUERY_EXPLAIN_INTERVAL']
+        }
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def check_query_duration(conn, cursor, statement, parameters, context, executemany):
+        start_times = conn.info.get('query_start_time')
+        if not start_times:
+            return
+        duration_ms = (time.perf_counter() - start_times.pop()) * 1000
+
+        if not app.config['SLOW_QUERY_LOG']:
+            return
+
+        config = monitor_config()
+        if duration_ms < config['threshold_ms']:
+            return
+
+        try:
+            record_slow_query(conn, statement, parameters, duration_ms, executemany, config)
+        except Exception as e:
+            # Monitoring must never break the query that was being monitored
+            logger.error(f"Error recording slow query: {e}")
+
+    @event.listens_for(Engine, "handle_error")
+    def check_lock_timeout(context):
+        message = str(context.original_exception)
+        if any(pattern in message.lower() for pattern in LOCK_TIMEOUT_PATTERNS):
+            record_lock_timeout(message)
+
+    def current_engine():
+        state = app.extensions.get('sqlalchemy')
+        return state.db.engine if state else None
+
+    @app.before_request
+    def instrument_connection_pool():
+        engine = current_engine()
+        if engine is not None:
+            instrument_pool(engine.pool)
+
+    @app.route('/admin/slow-queries')
+    @app.admin_required
+    def slow_queries():
+        """List the slowest statements seen by this worker"""
+        try:
+            sort = request.args.get('sort', 'total_ms')
+            limit = request.args.get('limit', 20, type=int)
+            return jsonify({
+                "status": "success",
+                "config": monitor_config(),
+                "slow_queries": get_slow_queries(sort, limit),
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e),
+                "timestamp": datetime.now().isoformat()
+            }), 500
+
+    @app.route('/admin/slow-queries/reset', methods=['POST'])
+    @app.admin_required
+    def slow_queries_reset():
+        """Clear the slow-query statistics for this worker"""
+        reset_slow_queries()
+        return jsonify({
+            "status": "success",
+            "message": "Slow-query statistics cleared",
+            "timestamp": datetime.now().isoformat()
+        })
+
+    @app.route('/admin/db-stats')
+    @app.admin_required
+    def db_stats():
+        """Show lock-timeout and connection pool counters for this worker"""
+        try:
+            return jsonify({
+                "status": "success",
+                "stats": get_db_stats(current_engine()),
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e),
+                "timestamp": datetime.now().isoformat()
+            }), 500
+
+    @app.route('/admin/db-stats/reset', methods=['POST'])
+    @app.admin_required
+    def db_stats_reset():
+        """Clear the lock-timeout and connection pool counters for this worker"""
+        reset_db_stats()
+        return jsonify({
+            "status": "success",
+            "message": "Database statistics cleared",
+            "worker_pid": os.getpid(),
+            "timestamp": datetime.now().isoformat()
+        })
+
+    return app
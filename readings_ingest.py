@@ -0,0 +1,433 @@
+"""
+Temperature reading ingestion for the Vacuum Pump Maintenance application
+
+Temperature loggers post batches of readings to /api/readings, as a JSON
+array or as CSV. Valid readings are appended to an in-memory buffer and
+acknowledged with 202 Accepted. A background thread in each worker writes
+the buffer to temperature_reading whenever READINGS_FLUSH_ROWS readings are
+waiting or READINGS_FLUSH_SECONDS have passed, with COPY on PostgreSQL and
+one multi-row insert elsewhere, and updates the hourly and daily rollups
+of temperature_rollups in the same transaction. Once READINGS_BUFFER_ROWS
+readings are waiting, new batches are refused with 503 and Retry-After
+until the buffer drains, so a slow database pushes back on the loggers
+instead of growing the worker's memory.
+
+Readings still in the buffer are lost if a worker is killed before its
+next flush. Loggers that cannot afford that send ?flush=true to have their
+batch written before the response.
+"""
+import io
+import os
+import csv
+import math
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from flask import request, jsonify
+from flask_login import current_user
+from auth import bearer_token_matches
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Most readings accepted in one request
+MAX_READINGS_PER_REQUEST = 50000
+
+# Errors listed in a response; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+# Plausible range of a pump temperature
+MIN_READING_VALUE = -50.0
+MAX_READING_VALUE = 300.0
+
+# How far ahead of the server clock a logger's timestamp may be
+MAX_CLOCK_SKEW = timedelta(days=1)
+
+READING_COLUMNS = ('equipment_id', 'ts', 'value')
+
+# Stands in for the fields of an item that is not a reading at all
+_MALFORMED = object()
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 string or Unix epoch seconds into a naive UTC datetime"""
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid timestamp: {value}")
+    if isinstance(value, (int, float)):
+        return datetime.utcfromtimestamp(value)
+
+    text = str(value).strip()
+    try:
+        if text.endswith('Z'):
+            text = text[:-1] + '+00:00'
+        ts = datetime.fromisoformat(text)
+    except ValueError:
+        try:
+            return datetime.utcfromtimestamp(float(text))
+        except (ValueError, OverflowError, OSError):
+            raise ValueError(f"Invalid timestamp: {value}")
+
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+def parse_reading(equipment_id, ts, value, latest_ts):
+    """Validate one reading and return it as an (equipment_id, ts, value) tuple"""
+    if isinstance(equipment_id, str):
+        equipment_id = equipment_id.strip()
+    if isinstance(equipment_id, bool):
+        raise ValueError(f"Invalid equipment_id: {equipment_id}")
+    try:
+        equipment_id = int(equipment_id)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid equipment_id: {equipment_id}")
+
+    ts = parse_timestamp(ts)
+    if ts > latest_ts:
+        raise ValueError(f"Timestamp is in the future: {ts.isoformat()}")
+
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid value: {value}")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid value: {value}")
+    if not math.isfinite(value) or not MIN_READING_VALUE <= value <= MAX_READING_VALUE:
+        raise ValueError(f"Value out of range: {value}")
+
+    return equipment_id, ts, value
+
+def _collect(items, known_equipment):
+    """Validate (index, equipment_id, ts, value) items into readings and errors"""
+    latest_ts = datetime.utcnow() + MAX_CLOCK_SKEW
+    readings = []
+    errors = []
+    rejected = 0
+    for index, equipment_id, ts, value in items:
+        try:
+            if equipment_id is _MALFORMED:
+                raise ValueError('Expected equipment_id, ts and value')
+            reading = parse_reading(equipment_id, ts, value, latest_ts)
+            if not known_equipment.contains(reading[0]):
+                raise ValueError(f"Unknown equipment_id: {reading[0]}")
+        except ValueError as e:
+            rejected += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'index': index, 'message': str(e)})
+            continue
+        readings.append(reading)
+    return readings, errors, rejected
+
+def _json_items(data):
+    if isinstance(data, dict):
+        data = data.get('readings')
+    if not isinstance(data, list):
+        raise ValueError('Expected a JSON array of readings or {"readings": [...]}')
+    for index, item in enumerate(data):
+        if isinstance(item, dict):
+            yield index, item.get('equipment_id'), item.get('ts'), item.get('value')
+        elif isinstance(item, list) and len(item) == 3:
+            yield index, item[0], item[1], item[2]
+        else:
+            yield index, _MALFORMED, None, None
+
+def _csv_items(text):
+    reader = csv.reader(io.StringIO(text))
+    for index, row in enumerate(reader):
+        if not row:
+            continue
+        if index == 0 and row[0].strip().lower() == 'equipment_id':
+            # Header row
+            continue
+        if len(row) != 3:
+            yield index, _MALFORMED, None, None
+        else:
+            yield index, row[0], row[1], row[2]
+
+def parse_json_readings(data, known_equipment):
+    """Readings from [{"equipment_id", "ts", "value"}, ...] or [[equipment_id, ts, value], ...]
+
+    Returns (readings, errors, rejected count).
+    """
+    return _collect(_json_items(data), known_equipment)
+
+def parse_csv_readings(text, known_equipment):
+    """Readings from CSV lines of equipment_id,ts,value, with an optional header
+
+    Returns (readings, errors, rejected count).
+    """
+    return _collect(_csv_items(text), known_equipment)
+
+class KnownEquipment:
+    """Cached set of equipment ids, so readings are checked without a query each"""
+    def __init__(self, load_ids, refresh_seconds=60.0, miss_refresh_seconds=5.0):
+        self.load_ids = load_ids
+        self.refresh_seconds = refresh_seconds
+        self.miss_refresh_seconds = miss_refresh_seconds
+        self._ids = frozenset()
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self, max_age):
+        with self._lock:
+            if time.time() - self._loaded_at >= max_age:
+                self._ids = frozenset(self.load_ids())
+                self._loaded_at = time.time()
+
+    def contains(self, equipment_id):
+        if time.time() - self._loaded_at >= self.refresh_seconds:
+            self._refresh(self.refresh_seconds)
+        if equipment_id in self._ids:
+            return True
+        # A pump added moments ago should not wait for the next refresh
+        self._refresh(self.miss_refresh_seconds)
+        return equipment_id in self._ids
+
+def write_readings(connection, table, readings):
+    """Write (equipment_id, ts, value) tuples with COPY on PostgreSQL, executemany elsewhere"""
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        for equipment_id, ts, value in readings:
+            buffer.write(f"{equipment_id}\t{ts.isoformat()}\t{value!r}\n")
+        buffer.seek(0)
+        # COPY on the DBAPI connection, inside the caller's transaction
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(READING_COLUMNS)}) FROM STDIN", buffer)
+        finally:
+            cursor.close()
+        return
+
+    connection.execute(table.insert(), [
+        {'equipment_id': equipment_id, 'ts': ts, 'value': value}
+        for equipment_id, ts, value in readings
+    ])
+
+class ReadingBuffer:
+    """In-memory buffer of readings, written in bulk by a background thread
+
+    maintenance, when given, is called by the background thread after every
+    flush and decides for itself whether there is work to do.
+    """
+    def __init__(self, writer, capacity=200000, flush_rows=5000, flush_seconds=2.0, maintenance=None):
+        self.writer = writer
+        self.maintenance = maintenance
+        self.capacity = capacity
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.stats = {
+            'accepted': 0, 'rejected': 0, 'written': 0, 'dropped': 0,
+            'flushes': 0, 'write_errors': 0, 'refused_batches': 0,
+            'last_flush_rows': 0, 'last_flush_seconds': 0.0
+        }
+
+    @property
+    def size(self):
+        return len(self._rows)
+
+    def is_full(self):
+        return len(self._rows) >= self.capacity
+
+    def add(self, readings):
+        """Buffer readings, returning False without buffering any when they do not fit"""
+        with self._lock:
+            if len(self._rows) + len(readings) > self.capacity:
+                self.stats['refused_batches'] += 1
+                return False
+            self._rows.extend(readings)
+            self.stats['accepted'] += len(readings)
+            size = len(self._rows)
+
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+        if size >= self.flush_rows:
+            self._wake.set()
+        return True
+
+    def count_rejected(self, count):
+        with self._lock:
+            self.stats['rejected'] += count
+
+    def flush(self, readings=None):
+        """Write everything buffered so far, returning the number of readings written
+
+        readings, when given, are written along with the buffered ones
+        without being buffered. If the write fails the buffered readings are
+        kept for the next try; given readings are not, and the error is
+        raised so their sender can send them again.
+        """
+        readings = readings or []
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows and not readings:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                self.writer(rows + readings)
+            except Exception as e:
+                logger.error(f"Error writing {len(rows) + len(readings)} temperature readings: {e}")
+                with self._lock:
+                    self.stats['write_errors'] += 1
+                    # Keep as many as fit in front of newer readings for the next try
+                    keep = max(0, min(len(rows), self.capacity - len(self._rows)))
+                    self._rows[:0] = rows[:keep]
+                    if keep < len(rows):
+                        self.stats['dropped'] += len(rows) - keep
+                        logger.error(f"Dropped {len(rows) - keep} temperature readings, the buffer is full")
+                if readings:
+                    raise
+                return 0
+
+            elapsed = time.perf_counter() - start
+            rows += readings
+            with self._lock:
+                self.stats['accepted'] += len(readings)
+                self.stats['written'] += len(rows)
+                self.stats['flushes'] += 1
+                self.stats['last_flush_rows'] = len(rows)
+                self.stats['last_flush_seconds'] = round(elapsed, 4)
+            return len(rows)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='reading-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing temperature readings: {e}")
+            if self.maintenance is not None:
+                try:
+                    self.maintenance()
+                except Exception as e:
+                    logger.error(f"Error in temperature reading maintenance: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['buffered'] = len(self._rows)
+        if stats['last_flush_seconds']:
+            stats['last_flush_rows_per_second'] = round(stats['last_flush_rows'] / stats['last_flush_seconds'])
+        stats['capacity'] = self.capacity
+        return stats
+
+def setup_readings_ingest(app, db, reading_model, equipment_model, rollups=None):
+    """Register /api/readings and the per-worker buffer behind it
+
+    rollups, a temperature_rollups.TemperatureRollups, is updated in the
+    same transaction as every write and runs its retention policy from the
+    background thread.
+    """
+    app.config.setdefault('READINGS_API_TOKEN', os.environ.get('READINGS_API_TOKEN', ''))
+    app.config.setdefault('READINGS_BUFFER_ROWS', int(os.environ.get('READINGS_BUFFER_ROWS', '200000')))
+    app.config.setdefault('READINGS_FLUSH_ROWS', int(os.environ.get('READINGS_FLUSH_ROWS', '5000')))
+    app.config.setdefault('READINGS_FLUSH_SECONDS', float(os.environ.get('READINGS_FLUSH_SECONDS', '2')))
+
+    table = reading_model.__table__
+
+    def writer(readings):
+        with app.app_context():
+            with db.engine.begin() as connection:
+                write_readings(connection, table, readings)
+                if rollups is not None:
+                    rollups.apply(connection, readings)
+
+    def maintenance():
+        with app.app_context():
+            rollups.enforce_retention(db.engine)
+
+    def load_equipment_ids():
+        with app.app_context():
+            return [row[0] for row in db.session.query(equipment_model.equipment_id)]
+
+    buffer = ReadingBuffer(
+        writer,
+        capacity=app.config['READINGS_BUFFER_ROWS'],
+        flush_rows=app.config['READINGS_FLUSH_ROWS'],
+        flush_seconds=app.config['READINGS_FLUSH_SECONDS'],
+        maintenance=maintenance if rollups is not None else None
+    )
+    known_equipment = KnownEquipment(load_equipment_ids)
+
+    # Write what is left when the worker shuts down cleanly
+    atexit.register(buffer.flush)
+
+    @app.route('/api/readings', methods=['POST'])
+    def ingest_readings():
+        """Accept a batch of temperature readings as JSON or CSV
+
+        Loggers authenticate with READINGS_API_TOKEN as a bearer token.
+        Returns 202 with the numbers of accepted and rejected readings.
+        """
+        if not (bearer_token_matches(app.config['READINGS_API_TOKEN'])
+                or current_user.is_authenticated or app.config.get('LOGIN_DISABLED')):
+            return jsonify({"error": "Authentication required"}), 401
+
+        retry_after = str(max(1, math.ceil(buffer.flush_seconds)))
+        if buffer.is_full():
+            response = jsonify({"error": "Reading buffer is full, try again later"})
+            response.status_code = 503
+            response.headers['Retry-After'] = retry_after
+            return response
+
+        try:
+            if request.mimetype in ('text/csv', 'text/plain'):
+                readings, errors, rejected = parse_csv_readings(request.get_data(as_text=True), known_equipment)
+            else:
+                data = request.get_json(silent=True)
+                if data is None:
+                    return jsonify({"error": "Expected a JSON array of readings or text/csv"}), 400
+                readings, errors, rejected = parse_json_readings(data, known_equipment)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if len(readings) + rejected > MAX_READINGS_PER_REQUEST:
+            return jsonify({"error": f"At most {MAX_READINGS_PER_REQUEST} readings can be sent per request"}), 413
+
+        if request.args.get('flush', '').lower() == 'true':
+            # Written with the buffered readings before answering, and not
+            # kept when that fails, so a retry never writes them twice
+            try:
+                buffer.flush(readings)
+            except Exception as e:
+                response = jsonify({"error": f"Readings could not be written, send them again: {e}"})
+                response.status_code = 503
+                response.headers['Retry-After'] = retry_after
+                return response
+        elif readings and not buffer.add(readings):
+            response = jsonify({"error": "Reading buffer is full, try again later"})
+            response.status_code = 503
+            response.headers['Retry-After'] = retry_after
+            return response
+        buffer.count_rejected(rejected)
+
+        return jsonify({
+            "status": "accepted",
+            "accepted": len(readings),
+            "rejected": rejected,
+            "errors": errors,
+            "buffered": buffer.size,
+            "timestamp": datetime.now().isoformat()
+        }), 202
+
+    @app.route('/api/readings/stats')
+    @app.admin_required
+    def reading_ingest_stats():
+        """Buffer and write counters of this worker's reading ingestion"""
+        return jsonify(dict(buffer.get_stats(), worker_pid=os.getpid(), timestamp=datetime.now().isoformat()))
+
+    return buffer
@@ -0,0 +1,81 @@
+"""
+Response compression for the JSON API endpoints of the Vacuum Pump
+Maintenance application
+"""
+import os
+import gzip
+import logging
+from flask import request
+
+# Brotli is optional, gzip is used when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+
+def accepted_encodings():
+    """Get the content codings the client accepts, ignoring q=0 entries"""
+    encodings = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if not parts[0]:
+            continue
+        if any(part.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for part in parts[1:]):
+            continue
+        encodings.add(parts[0].lower())
+    return encodings
+
+def compress_body(data, encodings):
+    """Compress a response body with the best coding the client accepts
+
+    Returns (coding, compressed data), or (None, data) when the client
+    accepts neither brotli nor gzip.
+    """
+    if brotli is not None and 'br' in encodings:
+        return 'br', brotli.compress(data, quality=5)
+    if 'gzip' in encodings:
+        return 'gzip', gzip.compress(data, compresslevel=6)
+    return None, data
+
+def setup_compression(app):
+    """Compress JSON responses from the application when the client accepts it"""
+    app.config.setdefault('API_COMPRESSION', os.environ.get('API_COMPRESSION', 'true').lower() == 'true')
+
+    @app.after_request
+    def compress_json_response(response):
+        if not app.config['API_COMPRESSION']:
+            return response
+        if (response.status_code != 200
+                or response.direct_passthrough
+                or response.is_streamed
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+
+        try:
+            coding, compressed = compress_body(data, accepted_encodings())
+        except Exception as e:
+            logger.error(f"Error compressing response: {e}")
+            return response
+
+        if coding is None:
+            return response
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = coding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    return app
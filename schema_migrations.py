@@ -0,0 +1,196 @@
+"""
+Idempotent schema changes for existing Vacuum Pump Maintenance databases
+
+db.create_all() creates missing tables but never changes tables that
+already exist, so columns added to existing models are added here. Every
+step checks the live schema first, which makes it safe to run on every
+start and from several workers at once.
+
+Columns the current models no longer use are only dropped when this file
+is run by hand, once no deploy that still reads them can come back:
+
+    python schema_migrations.py --restore-replaced-columns   # just before rolling back
+    python schema_migrations.py --drop-replaced-columns
+"""
+import sys
+import argparse
+import logging
+from sqlalchemy import inspect
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# (table, column, SQL type, index name or None), applied in order. The SQL
+# type can be a dict of types by dialect name, with a 'default' entry.
+COLUMN_MIGRATIONS = [
+    ('equipment', 'change_seq', 'INTEGER', 'ix_equipment_change_seq'),
+    ('maintenance_log', 'change_seq', 'INTEGER', 'ix_maintenance_log_change_seq'),
+    ('work_week_summary', 'coverage', {'postgresql': 'BYTEA', 'default': 'BLOB'}, None),
+    ('maintenance_log', 'week_key', 'INTEGER', 'ix_maintenance_log_week_key'),
+    ('work_week_summary', 'week_key', 'INTEGER', 'ix_work_week_summary_week_key'),
+    ('equipment', 'is_eligible', 'BOOLEAN', 'ix_equipment_is_eligible'),
+    ('equipment', 'pump_model_id', 'INTEGER REFERENCES pump_model (pump_model_id)', 'ix_equipment_pump_model_id'),
+    ('equipment', 'oil_type_id', 'INTEGER REFERENCES oil_type (oil_type_id)', 'ix_equipment_oil_type_id'),
+    ('equipment', 'owner_id', 'INTEGER REFERENCES person (person_id)', 'ix_equipment_owner_id'),
+    ('maintenance_log', 'service_id', 'INTEGER REFERENCES service_type (service_id)', 'ix_maintenance_log_service_id'),
+    ('maintenance_log', 'user_id', 'INTEGER REFERENCES person (person_id)', 'ix_maintenance_log_user_id'),
+    ('equipment', 'coverage_bit', 'INTEGER', None),
+    ('equipment', 'created_at', {'postgresql': 'TIMESTAMP', 'default': 'DATETIME'}, None),
+]
+
+# (table, index name, columns) of multi-column indexes, applied in order
+INDEX_MIGRATIONS = [
+    ('maintenance_log', 'ix_maintenance_log_equipment_history', ('equipment_id', 'check_date', 'log_id')),
+]
+
+# (table, column, column replacing it, lookup table, lookup key) of the text
+# columns the lookup ids replaced, see lookups
+REPLACED_COLUMNS = [
+    ('equipment', 'pump_model', 'pump_model_id', 'pump_model', 'pump_model_id'),
+    ('equipment', 'oil_type', 'oil_type_id', 'oil_type', 'oil_type_id'),
+    ('equipment', 'pump_owner', 'owner_id', 'person', 'person_id'),
+    ('maintenance_log', 'service', 'service_id', 'service_type', 'service_id'),
+    ('maintenance_log', 'user_name', 'user_id', 'person', 'person_id'),
+]
+
+def _execute(engine, sql):
+    """Run one DDL statement in its own transaction, returning False when it fails"""
+    try:
+        with engine.begin() as connection:
+            connection.exec_driver_sql(sql)
+        return True
+    except Exception as e:
+        # Usually another worker applied the same change first
+        logger.warning(f"Schema change skipped ({sql}): {e}")
+        return False
+
+def add_missing_columns(engine, migrations=COLUMN_MIGRATIONS):
+    """Add the columns and indexes in migrations that the database lacks
+
+    Returns the list of 'table.column' names that were added.
+    """
+    inspector = inspect(engine)
+    added = []
+    for table_name, column_name, column_type, index_name in migrations:
+        if not inspector.has_table(table_name):
+            # create_all() builds new tables with every column already
+            continue
+
+        if isinstance(column_type, dict):
+            column_type = column_type.get(engine.dialect.name, column_type['default'])
+        columns = {column['name'] for column in inspector.get_columns(table_name)}
+        if column_name not in columns:
+            if _execute(engine, f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"):
+                logger.info(f"Added column {table_name}.{column_name}")
+                added.append(f"{table_name}.{column_name}")
+
+        if index_name:
+            indexes = {index['name'] for index in inspector.get_indexes(table_name)}
+            if index_name not in indexes:
+                _execute(engine, f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({column_name})")
+    return added
+
+def add_missing_indexes(engine, migrations=INDEX_MIGRATIONS):
+    """Create the indexes in migrations that the database lacks
+
+    Returns the list of index names that were created.
+    """
+    inspector = inspect(engine)
+    added = []
+    for table_name, index_name, columns in migrations:
+        if not inspector.has_table(table_name):
+            continue
+        indexes = {index['name'] for index in inspector.get_indexes(table_name)}
+        if index_name not in indexes:
+            if _execute(engine, f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(columns)})"):
+                logger.info(f"Created index {index_name}")
+                added.append(index_name)
+    return added
+
+def _replaced_columns(engine, migrations):
+    """The entries of migrations whose column the database still has"""
+    inspector = inspect(engine)
+    present = []
+    for migration in migrations:
+        table_name, column_name = migration[:2]
+        if inspector.has_table(table_name) and column_name in {
+            column['name'] for column in inspector.get_columns(table_name)
+        }:
+            present.append(migration)
+    return present
+
+def restore_replaced_columns(engine, migrations=REPLACED_COLUMNS):
+    """Hand the replaced text columns back to a version of the app that still uses them
+
+    Rows saved since the upgrade only have the ids, so every row gets the
+    name its id points at, and the ids are cleared. The older version then
+    reads and edits the text, and the next start of this version interns it
+    again (see backfill_lookups), keeping the edits made meanwhile. Run it
+    just before rolling back. Returns the number of values restored.
+    """
+    restored = 0
+    with engine.begin() as connection:
+        for table_name, column_name, replacement, lookup_table, lookup_key in _replaced_columns(engine, migrations):
+            result = connection.exec_driver_sql(
+                f"UPDATE {table_name} SET {column_name} = "
+                f"(SELECT name FROM {lookup_table} WHERE {lookup_table}.{lookup_key} = {table_name}.{replacement}), "
+                f"{replacement} = NULL WHERE {replacement} IS NOT NULL"
+            )
+            logger.info(f"Restored {result.rowcount} {table_name}.{column_name} values")
+            restored += result.rowcount
+    return restored
+
+def drop_replaced_columns(engine, migrations=REPLACED_COLUMNS):
+    """Drop the columns in migrations once every row has the column replacing them
+
+    A column some row still has a value in while its replacement is empty
+    is kept, so a failed backfill never loses data. Dropping cannot be
+    undone, so the app never does it on start: run it by hand once no
+    deploy reading the old columns can return. Returns the list of
+    'table.column' names that were dropped.
+    """
+    dropped = []
+    for table_name, column_name, replacement, _, _ in _replaced_columns(engine, migrations):
+        with engine.connect() as connection:
+            unconverted = connection.exec_driver_sql(
+                f"SELECT 1 FROM {table_name} WHERE {column_name} IS NOT NULL AND {replacement} IS NULL LIMIT 1"
+            ).first()
+        if unconverted:
+            logger.warning(f"Keeping {table_name}.{column_name}, some rows have no {replacement} yet")
+            continue
+        if _execute(engine, f"ALTER TABLE {table_name} DROP COLUMN {column_name}"):
+            logger.info(f"Dropped column {table_name}.{column_name}")
+            dropped.append(f"{table_name}.{column_name}")
+    return dropped
+
+def run_migrations(engine):
+    """Bring an existing database up to the current models"""
+    try:
+        return add_missing_columns(engine) + add_missing_indexes(engine)
+    except Exception as e:
+        logger.error(f"Error running schema migrations: {e}")
+        return []
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Change columns of the application's database that the app leaves alone")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--restore-replaced-columns', action='store_true',
+                       help='copy lookup names back into the old text columns, just before rolling back')
+    group.add_argument('--drop-replaced-columns', action='store_true',
+                       help='drop the old text columns the lookup ids replaced (cannot be undone)')
+    args = parser.parse_args(argv)
+
+    # Importing the app brings the schema up to date and interns the text
+    # columns first, which also replaces search triggers that used them
+    from app import app, db
+    with app.app_context():
+        engine = db.engine
+    if args.restore_replaced_columns:
+        print(f"Restored {restore_replaced_columns(engine)} values")
+    else:
+        dropped = drop_replaced_columns(engine)
+        print(f"Dropped {', '.join(dropped) if dropped else 'no columns'}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
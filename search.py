@@ -0,0 +1,392 @@
+"""
+Full-text search over maintenance log services and notes, and equipment
+
+GET /api/search finds maintenance logs by service and service notes, or
+equipment by name and notes, ranked by relevance and a page at a time.
+
+On SQLite the text is indexed by FTS5 tables. equipment_search reads its
+content from equipment. Logs only keep their service's id, so log_search
+stores its own copy of each log's service name and notes. Triggers on both
+tables keep them current, including for bulk inserts and for writes from
+outside the app. Words are stemmed with the porter tokenizer, so "leaking"
+finds "leak" and "leaks".
+
+On PostgreSQL equipment gets a GIN index on the English tsvector of its
+name and notes, and maintenance_log one on its notes. PostgreSQL keeps
+expression indexes current itself, and the search queries use the indexed
+expressions exactly so the planner picks the indexes. Service names live
+in service_type, so a log search first finds the few services whose name
+matches some of the words, then asks for logs whose notes match all the
+words, or whose service is one of those and whose notes match the rest.
+
+Queries are reduced to their words, all of which must match, and the last
+word also matches as a prefix, so results appear while someone is still
+typing. Matches are ranked from the index alone, and only the page asked
+for is read from the tables, with one extra row to tell whether another
+page follows; no total is counted. Snippets mark the matched words with
+[ and ].
+"""
+import re
+import logging
+from datetime import datetime
+from flask import request, jsonify
+from flask_login import login_required
+from sqlalchemy import text
+from data_version import conditional_json
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+MAX_QUERY_WORDS = 10
+SEARCH_SCOPES = ('logs', 'equipment')
+
+# Indexed columns of each searchable table. An FTS5 table with values
+# stores its own copy of them, each value being SQL over a row of the table
+# called {row}; the others read their content from the table. On
+# PostgreSQL, pg_columns are the indexed ones.
+SEARCH_SOURCES = {
+    'logs': {'table': 'maintenance_log', 'key': 'log_id', 'columns': ('service', 'service_notes'),
+             'values': ('(SELECT name FROM service_type WHERE service_id = {row}.service_id)', '{row}.service_notes'),
+             'watched': ('service_id', 'service_notes'), 'pg_columns': ('service_notes',),
+             'fts': 'log_search', 'index': 'ix_maintenance_log_notes_search'},
+    'equipment': {'table': 'equipment', 'key': 'equipment_id', 'columns': ('equipment_name', 'notes'),
+                  'fts': 'equipment_search', 'index': 'ix_equipment_search'}
+}
+
+# Indexes of earlier versions, dropped when found
+LEGACY_POSTGRES_INDEXES = ('ix_maintenance_log_search',)
+
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+def query_words(query):
+    """The words of a search query, at most MAX_QUERY_WORDS"""
+    return WORD_PATTERN.findall(query or '')[:MAX_QUERY_WORDS]
+
+def fts5_query(words):
+    """FTS5 MATCH expression requiring every word, the last one as a prefix"""
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+def tsquery_terms(words):
+    """to_tsquery terms of words, the last one as a prefix"""
+    return words[:-1] + [words[-1] + ':*']
+
+def tsquery(words):
+    """to_tsquery text requiring every word, the last one as a prefix"""
+    return ' & '.join(tsquery_terms(words))
+
+def tsvector_sql(source, prefix=''):
+    """The indexed tsvector expression of a source, its columns qualified with prefix"""
+    columns = source.get('pg_columns', source['columns'])
+    parts = " || ' ' || ".join(f"coalesce({prefix}{column}, '')" for column in columns)
+    return f"to_tsvector('english', {parts})"
+
+def _row_values(source, row):
+    """SQL of a source's indexed values for the table row called row"""
+    if 'values' in source:
+        return ', '.join(value.format(row=row) for value in source['values'])
+    return ', '.join(f"{row}.{column}" for column in source['columns'])
+
+def _sqlite_statements(source):
+    """DDL of a source's FTS5 table and the triggers that keep it current"""
+    fts, table, key = source['fts'], source['table'], source['key']
+    columns = ', '.join(source['columns'])
+    new_values = _row_values(source, 'new')
+    if 'values' in source:
+        # The FTS5 table holds its own copy, deleted by rowid
+        watched = ', '.join(source['watched'])
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({columns}, tokenize='porter unicode61')",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.{key}, {new_values}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+            f"DELETE FROM {fts} WHERE rowid = old.{key}; END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {watched} ON {table} BEGIN "
+            f"DELETE FROM {fts} WHERE rowid = old.{key}; "
+            f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.{key}, {new_values}); END"
+        ]
+    old_values = _row_values(source, 'old')
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"{columns}, content='{table}', content_rowid='{key}', tokenize='porter unicode61')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.{key}, {new_values}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.{key}, {old_values}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {columns} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.{key}, {old_values}); "
+        f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.{key}, {new_values}); END"
+    ]
+
+def _sqlite_refill(connection, source):
+    """Fill a source's FTS5 table again from its table"""
+    fts = source['fts']
+    if 'values' not in source:
+        connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        return
+    connection.exec_driver_sql(f"DELETE FROM {fts}")
+    connection.exec_driver_sql(
+        f"INSERT INTO {fts}(rowid, {', '.join(source['columns'])}) "
+        f"SELECT row.{source['key']}, {_row_values(source, 'row')} FROM {source['table']} AS row"
+    )
+
+def _drop_outdated_fts(connection, source):
+    """Drop a source's FTS5 table and triggers when they were made for the other kind of content
+
+    Returns whether they were dropped.
+    """
+    fts = source['fts']
+    found = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)
+    ).first()
+    if found is None or ('content=' in found[0]) == ('values' not in source):
+        return False
+    for trigger in ('insert', 'delete', 'update'):
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {fts}_{trigger}")
+    connection.exec_driver_sql(f"DROP TABLE {fts}")
+    return True
+
+def ensure_search_index(engine):
+    """Create the search tables, triggers or indexes the database lacks
+
+    An FTS5 table is refilled from its content table whenever its triggers
+    were missing: when it is new, and when the content table was dropped
+    and created again, which drops the triggers but leaves entries for rows
+    that are gone. An FTS5 table of an earlier version, such as a log_search
+    reading the service text maintenance_log no longer has, is replaced.
+    Safe to run on every start; returns the names of the tables and indexes
+    created or refilled.
+    """
+    created = []
+    try:
+        with engine.begin() as connection:
+            dialect = connection.dialect.name
+            for source in SEARCH_SOURCES.values():
+                if dialect == 'sqlite':
+                    current = connection.exec_driver_sql(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?", (f"{source['fts']}_insert",)
+                    ).first()
+                    if _drop_outdated_fts(connection, source):
+                        current = None
+                    for statement in _sqlite_statements(source):
+                        connection.exec_driver_sql(statement)
+                    if not current:
+                        _sqlite_refill(connection, source)
+                        created.append(source['fts'])
+                elif dialect == 'postgresql':
+                    exists = connection.exec_driver_sql(
+                        "SELECT 1 FROM pg_indexes WHERE indexname = %s", (source['index'],)
+                    ).first()
+                    if not exists:
+                        connection.exec_driver_sql(
+                            f"CREATE INDEX IF NOT EXISTS {source['index']} ON {source['table']} "
+                            f"USING GIN ({tsvector_sql(source)})"
+                        )
+                        created.append(source['index'])
+            if dialect == 'postgresql':
+                for index in LEGACY_POSTGRES_INDEXES:
+                    connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index}")
+        if created:
+            logger.info(f"Created search indexes: {', '.join(created)}")
+    except Exception as e:
+        logger.error(f"Error creating search indexes: {e}")
+    return created
+
+def rebuild_search_index(engine):
+    """Refill the FTS5 tables from their content tables (PostgreSQL needs nothing)"""
+    with engine.begin() as connection:
+        if connection.dialect.name != 'sqlite':
+            return 0
+        for source in SEARCH_SOURCES.values():
+            _sqlite_refill(connection, source)
+    return len(SEARCH_SOURCES)
+
+# The page of hits is picked from the FTS5 table alone, where ORDER BY rank
+# with a LIMIT is optimized, and only then joined to the rows
+SQLITE_LOG_SEARCH = """
+    SELECT m.log_id, m.equipment_id, e.equipment_name, m.work_week, m.check_date, s.name AS service,
+           m.service_notes, hits.snippet
+    FROM (
+        SELECT rowid AS log_id, rank, snippet(log_search, -1, '[', ']', '...', 12) AS snippet
+        FROM log_search
+        WHERE log_search MATCH :query
+        ORDER BY rank
+        LIMIT :limit OFFSET :offset
+    ) AS hits
+    JOIN maintenance_log m ON m.log_id = hits.log_id
+    JOIN equipment e ON e.equipment_id = m.equipment_id
+    LEFT JOIN service_type s ON s.service_id = m.service_id
+    ORDER BY hits.rank, m.log_id DESC
+"""
+
+SQLITE_EQUIPMENT_SEARCH = """
+    SELECT e.equipment_id, e.equipment_name, p.name AS pump_owner, e.status, e.notes, hits.snippet
+    FROM (
+        SELECT rowid AS equipment_id, rank, snippet(equipment_search, -1, '[', ']', '...', 12) AS snippet
+        FROM equipment_search
+        WHERE equipment_search MATCH :query
+        ORDER BY rank
+        LIMIT :limit OFFSET :offset
+    ) AS hits
+    JOIN equipment e ON e.equipment_id = hits.equipment_id
+    LEFT JOIN person p ON p.person_id = e.owner_id
+    ORDER BY hits.rank, e.equipment_id
+"""
+
+# Services whose name matches any of the words, and which words it matches
+POSTGRES_MATCHING_SERVICES = """
+    SELECT service_id, {matches}
+    FROM service_type
+    WHERE to_tsvector('english', name) @@ to_tsquery('english', :any_word)
+"""
+
+# Headlines are only worked out for the page of hits, not every match.
+# {services} holds an OR clause per service matching some of the words.
+POSTGRES_LOG_SEARCH = """
+    SELECT m.log_id, m.equipment_id, e.equipment_name, m.work_week, m.check_date, s.name AS service,
+           m.service_notes,
+           ts_headline('english', coalesce(s.name, '') || ' ' || coalesce(m.service_notes, ''), hits.query,
+                       'StartSel=[, StopSel=], MaxWords=24, MinWords=8') AS snippet,
+           hits.rank
+    FROM (
+        SELECT m.log_id, query,
+               ts_rank(to_tsvector('english', coalesce(s.name, '')) || {log_vector}, query) AS rank
+        FROM maintenance_log m
+        LEFT JOIN service_type s ON s.service_id = m.service_id,
+        to_tsquery('english', :query) AS query
+        WHERE {log_vector} @@ query{services}
+        ORDER BY rank DESC, m.check_date DESC
+        LIMIT :limit OFFSET :offset
+    ) AS hits
+    JOIN maintenance_log m ON m.log_id = hits.log_id
+    JOIN equipment e ON e.equipment_id = m.equipment_id
+    LEFT JOIN service_type s ON s.service_id = m.service_id
+    ORDER BY hits.rank DESC, m.check_date DESC
+"""
+
+POSTGRES_EQUIPMENT_SEARCH = f"""
+    SELECT e.equipment_id, e.equipment_name, p.name AS pump_owner, e.status, e.notes,
+           ts_headline('english', coalesce(e.equipment_name, '') || ' ' || coalesce(e.notes, ''), hits.query,
+                       'StartSel=[, StopSel=], MaxWords=24, MinWords=8') AS snippet,
+           hits.rank
+    FROM (
+        SELECT equipment_id, query, ts_rank({tsvector_sql(SEARCH_SOURCES['equipment'])}, query) AS rank
+        FROM equipment, to_tsquery('english', :query) AS query
+        WHERE {tsvector_sql(SEARCH_SOURCES['equipment'])} @@ query
+        ORDER BY rank DESC, equipment_id
+        LIMIT :limit OFFSET :offset
+    ) AS hits
+    JOIN equipment e ON e.equipment_id = hits.equipment_id
+    LEFT JOIN person p ON p.person_id = e.owner_id
+    ORDER BY hits.rank DESC, e.equipment_id
+"""
+
+def postgres_log_search(connection, words, params):
+    """SQL of a PostgreSQL log search for words, adding its parameters to params
+
+    Logs match when their notes hold every word, or when their service's
+    name holds some of the words and their notes the others.
+    """
+    terms = tsquery_terms(words)
+    matches = ', '.join(
+        f"to_tsvector('english', name) @@ to_tsquery('english', :term_{index}) AS match_{index}"
+        for index in range(len(terms))
+    )
+    term_params = {f'term_{index}': term for index, term in enumerate(terms)}
+    log_vector = tsvector_sql(SEARCH_SOURCES['logs'], 'm.')
+
+    clauses = []
+    for row in connection.execute(
+        text(POSTGRES_MATCHING_SERVICES.format(matches=matches)), dict(term_params, any_word=' | '.join(terms))
+    ):
+        service_id = row[0]
+        rest = [term for term, matched in zip(terms, row[1:]) if not matched]
+        params[f'service_{service_id}'] = service_id
+        clause = f"m.service_id = :service_{service_id}"
+        if rest:
+            params[f'rest_{service_id}'] = ' & '.join(rest)
+            clause += f" AND {log_vector} @@ to_tsquery('english', :rest_{service_id})"
+        clauses.append(f"\n           OR ({clause})")
+    return POSTGRES_LOG_SEARCH.format(log_vector=log_vector, services=''.join(clauses))
+
+def search(session, scope, words, page=1, per_page=DEFAULT_PER_PAGE):
+    """(result rows as dicts, whether more follow) for one page of a search"""
+    connection = session.connection()
+    dialect = connection.dialect.name
+    params = {'limit': per_page + 1, 'offset': (page - 1) * per_page}
+    if dialect == 'postgresql':
+        params['query'] = tsquery(words)
+        sql = postgres_log_search(connection, words, params) if scope == 'logs' else POSTGRES_EQUIPMENT_SEARCH
+    else:
+        params['query'] = fts5_query(words)
+        sql = SQLITE_LOG_SEARCH if scope == 'logs' else SQLITE_EQUIPMENT_SEARCH
+
+    rows = connection.execute(text(sql), params).mappings().all()
+
+    results = []
+    for row in rows[:per_page]:
+        result = dict(row)
+        result.pop('rank', None)
+        if result.get('check_date') is not None and not isinstance(result['check_date'], str):
+            result['check_date'] = result['check_date'].isoformat()
+        results.append(result)
+    return results, len(rows) > per_page
+
+def setup_search(app, db):
+    """Register /api/search and the search index rebuild route"""
+
+    @app.route('/api/search')
+    @login_required
+    def search_api():
+        """Maintenance logs or equipment matching q, best matches first
+
+        Query parameters: q, scope (logs, the default, or equipment), page
+        (from 1) and per_page (default DEFAULT_PER_PAGE, at most MAX_PER_PAGE).
+        """
+        words = query_words(request.args.get('q'))
+        if not words:
+            return jsonify({"error": "q must contain at least one word"}), 400
+        scope = request.args.get('scope', 'logs')
+        if scope not in SEARCH_SCOPES:
+            return jsonify({"error": f"scope must be one of {', '.join(SEARCH_SCOPES)}"}), 400
+        try:
+            page = int(request.args.get('page', 1))
+            per_page = int(request.args.get('per_page', DEFAULT_PER_PAGE))
+        except ValueError:
+            return jsonify({"error": "page and per_page must be whole numbers"}), 400
+        if page < 1 or not 1 <= per_page <= MAX_PER_PAGE:
+            return jsonify({"error": f"page must be at least 1 and per_page between 1 and {MAX_PER_PAGE}"}), 400
+
+        def build_payload():
+            results, has_more = search(db.session, scope, words, page, per_page)
+            return {
+                'query': ' '.join(words),
+                'scope': scope,
+                'page': page,
+                'per_page': per_page,
+                'has_more': has_more,
+                'results': results
+            }
+
+        try:
+            key = f"search|{scope}|{' '.join(words)}|{page}|{per_page}"
+            return conditional_json(db.session, key, build_payload)
+        except Exception as e:
+            logger.error(f"Error searching {scope}: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/admin/search/rebuild', methods=['POST'])
+    @app.admin_required
+    def rebuild_search():
+        """Refill the SQLite search tables from the logs and equipment"""
+        try:
+            count = rebuild_search_index(db.engine)
+            return jsonify({
+                "status": "success",
+                "message": f"Rebuilt {count} search tables",
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception as e:
+            logger.error(f"Error rebuilding search index: {e}")
+            return jsonify({"error": str(e)}), 500
@@ -1,47 +1,9 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, date
+from datetime import date
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///vacuum_pump_maintenance.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
-
-class Equipment(db.Model):
-    equipment_id = db.Column(db.Integer, primary_key=True)
-    equipment_name = db.Column(db.String(100), nullable=False)
-    status = db.Column(db.String(50), default='active')
-    pump_model = db.Column(db.String(100))
-    oil_type = db.Column(db.String(100))
-    pump_owner = db.Column(db.String(100))
-    notes = db.Column(db.Text)
-    
-    maintenance_logs = db.relationship('MaintenanceLog', backref='equipment', lazy=True, cascade="all, delete-orphan")
-
-    def __repr__(self):
-        return f"Equipment({self.equipment_id}: {self.equipment_name})"
-
-class MaintenanceLog(db.Model):
-    log_id = db.Column(db.Integer, primary_key=True)
-    equipment_id = db.Column(db.Integer, db.ForeignKey('equipment.equipment_id', ondelete='CASCADE'), nullable=False)
-    work_week = db.Column(db.String(10))
-    check_date = db.Column(db.Date, nullable=False)
-    user_name = db.Column(db.String(100))
-    oil_level_ok = db.Column(db.Boolean, default=False)
-    oil_condition_ok = db.Column(db.Boolean, default=False)
-    oil_filter_ok = db.Column(db.Boolean, default=False)
-    pump_temp = db.Column(db.Float)
-    service = db.Column(db.String(50), default='None Required')
-    service_notes = db.Column(db.Text)
-
-    def __repr__(self):
-        return f"MaintenanceLog({self.log_id}: {self.check_date} for Equipment {self.equipment_id})"
-
 equipment_data = [
     (1, 'JR intake GB','Edwards RV12', 'Oil', 'Mfg (Jonathan)','Active', ''),
     (2, 'Spot/Sonic Weld GB', 'Edwards RV12', 'Oil', 'Mfg (Jonathan)','Active', ''),
@@ -90,6 +52,10 @@ log_data = [
 ]
 
 def initialize_database():
+    # Imported here so other scripts can import the data above without
+    # starting the app. Saving through the app's models interns the lookup
+    # names and numbers the rows like any other save.
+    from app import app, db, Equipment, MaintenanceLog
     try:
         with app.app_context():
             db.create_all()
@@ -0,0 +1,239 @@
+"""
+Request coalescing for expensive read endpoints of the Vacuum Pump
+Maintenance application
+
+Concurrent identical calls within a worker wait for one in-flight
+computation and share its result. Across gunicorn workers the computation
+is guarded by a file lock, and the result is written to a small file cache
+so the workers that waited for the lock read it instead of recomputing.
+Results are kept for a short TTL; once that expires, callers that arrive
+while a refresh is already running get the previous result instead of
+queueing up behind it.
+
+Callers put the data version in the key, so a change to the data produces
+a new key rather than serving a stale result.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+# File locks are only available on Unix, elsewhere coalescing stays per worker
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+MAX_CACHE_ENTRIES = 256
+
+# How often (in file cache writes) old cache files are swept
+SWEEP_INTERVAL = 100
+
+_MISSING = object()
+
+class _Call:
+    """One in-flight computation that other callers can wait on"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+    """Run at most one computation per key at a time within this process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, fn):
+        """Call fn, or wait for the identical call already running and share its result"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+            return call.value
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+class Coalescer:
+    """Single-flight computation with a TTL cache shared by all workers"""
+    def __init__(self, ttl=30.0, stale_ttl=30.0, cache_dir=None, cross_worker=True, namespace=''):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), 'vpm_single_flight')
+        self.cross_worker = cross_worker and fcntl is not None
+        # Keeps workers of different databases from sharing cache files
+        self.namespace = namespace
+        self.config = {}
+        self._flight = SingleFlight()
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        self._writes = 0
+        self.stats = {'hits': 0, 'stale_hits': 0, 'shared_file_hits': 0, 'computed': 0, 'coalesced': 0}
+
+    def _file_path(self, key, suffix):
+        digest = hashlib.sha1(f"{self.namespace}|{key}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.{suffix}")
+
+    def _count(self, name):
+        with self._cache_lock:
+            self.stats[name] += 1
+
+    def _get_local(self, key):
+        with self._cache_lock:
+            return self._cache.get(key)
+
+    def _set_local(self, key, value):
+        now = time.time()
+        with self._cache_lock:
+            if len(self._cache) >= MAX_CACHE_ENTRIES:
+                # Drop expired entries first, then the oldest ones
+                limit = now - self.stale_ttl
+                for old_key in [k for k, (expires_at, _) in self._cache.items() if expires_at < limit]:
+                    del self._cache[old_key]
+                while len(self._cache) >= MAX_CACHE_ENTRIES:
+                    del self._cache[next(iter(self._cache))]
+            self._cache[key] = (now + self.ttl, value)
+
+    def _read_file(self, key):
+        path = self._file_path(key, 'json')
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return _MISSING
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return _MISSING
+
+    def _write_file(self, key, value):
+        path = self._file_path(key, 'json')
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(value, f)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not write shared cache file: {e}")
+            return
+
+        self._writes += 1
+        if self._writes % SWEEP_INTERVAL == 0:
+            self._sweep_files()
+
+    def _sweep_files(self):
+        """Remove cache and lock files that have not been used for a while"""
+        limit = time.time() - max(self.ttl + self.stale_ttl, 600)
+        try:
+            for filename in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, filename)
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+        except OSError as e:
+            logger.warning(f"Could not sweep shared cache directory: {e}")
+
+    def _compute(self, key, fn):
+        """Compute a value, letting only one worker at a time do so for a key"""
+        if not self.cross_worker:
+            self._count('computed')
+            return fn()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._file_path(key, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another worker may have computed it while this one waited
+                value = self._read_file(key)
+                if value is not _MISSING:
+                    self._count('shared_file_hits')
+                    return value
+
+                self._count('computed')
+                value = fn()
+                self._write_file(key, value)
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def call(self, key, fn):
+        """Get the result of fn for key, computing it at most once at a time
+
+        fn must return JSON-serializable data when cross-worker sharing is on.
+        """
+        if not self.config.get('COALESCE_ENABLED', True):
+            return fn()
+
+        entry = self._get_local(key)
+        now = time.time()
+        if entry is not None:
+            expires_at, value = entry
+            if now < expires_at:
+                self._count('hits')
+                return value
+            # Expired: if a refresh is already running, serve the previous
+            # value rather than piling onto the refresh
+            if now < expires_at + self.stale_ttl and self._flight.in_flight(key):
+                self._count('stale_hits')
+                return value
+
+        if self._flight.in_flight(key):
+            self._count('coalesced')
+
+        def compute_and_store():
+            value = self._compute(key, fn)
+            self._set_local(key, value)
+            return value
+
+        return self._flight.do(key, compute_and_store)
+
+    def clear(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+coalescer = Coalescer()
+
+def coalesced(key, fn):
+    """Run fn through the application's coalescer"""
+    return coalescer.call(key, fn)
+
+def setup_coalescing(app):
+    """Configure request coalescing from the application config"""
+    app.config.setdefault('COALESCE_ENABLED', os.environ.get('COALESCE_ENABLED', 'true').lower() == 'true')
+    app.config.setdefault('COALESCE_TTL', float(os.environ.get('COALESCE_TTL', '30')))
+    app.config.setdefault('COALESCE_STALE_TTL', float(os.environ.get('COALESCE_STALE_TTL', '30')))
+    app.config.setdefault('COALESCE_CROSS_WORKER', os.environ.get('COALESCE_CROSS_WORKER', 'true').lower() == 'true')
+    app.config.setdefault('COALESCE_DIR', os.environ.get('COALESCE_DIR', ''))
+
+    coalescer.config = app.config
+    coalescer.namespace = app.config.get('SQLALCHEMY_DATABASE_URI', '')
+    coalescer.ttl = app.config['COALESCE_TTL']
+    coalescer.stale_ttl = app.config['COALESCE_STALE_TTL']
+    coalescer.cross_worker = app.config['COALESCE_CROSS_WORKER'] and fcntl is not None
+    if app.config['COALESCE_DIR']:
+        coalescer.cache_dir = app.config['COALESCE_DIR']
+
+    return coalescer
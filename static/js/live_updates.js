@@ -0,0 +1,75 @@
+// Live updates from the /api/events Server-Sent Events stream
+
+// Random delays before retrying a refused stream, in milliseconds: the first
+// between 2 and 8 seconds, doubling with every refusal in a row up to a
+// minute, so refused clients spread out instead of returning together
+const REFUSED_RETRY_MIN = 2000;
+const REFUSED_RETRY_MAX = 60000;
+
+// Call onChange with every change event. The browser reconnects by itself
+// when a stream ends; if the server refused the stream (too many open
+// streams) try again after a random, growing delay, resuming after the
+// last event seen.
+function subscribeToChanges(onChange) {
+    if (!window.EventSource) return null;
+
+    let lastEventId = null;
+    let refusals = 0;
+
+    function retryDelay() {
+        const base = Math.min(REFUSED_RETRY_MIN * Math.pow(2, refusals), REFUSED_RETRY_MAX);
+        refusals += 1;
+        return base + Math.random() * base * 3;
+    }
+
+    function connect() {
+        const url = lastEventId ? `/api/events?last_event_id=${encodeURIComponent(lastEventId)}` : '/api/events';
+        const source = new EventSource(url);
+
+        source.onopen = () => {
+            refusals = 0;
+        };
+
+        source.addEventListener('change', event => {
+            lastEventId = event.lastEventId || lastEventId;
+            try {
+                onChange(JSON.parse(event.data));
+            } catch (error) {
+                console.error('Error applying live update:', error);
+            }
+        });
+
+        source.onerror = () => {
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(connect, Math.min(retryDelay(), REFUSED_RETRY_MAX));
+            }
+        };
+    }
+
+    connect();
+}
+
+// Values a weekly log row shows when it has no log
+const EMPTY_LOG_FIELDS = {
+    user_name: '',
+    oil_level_ok: false,
+    oil_condition_ok: false,
+    oil_filter_ok: false,
+    pump_temp: null,
+    service: 'None Required',
+    service_notes: ''
+};
+
+// Patch one weekly log row with a change event for the week on screen.
+// Rows the user is editing are left alone so their input is not lost.
+// Needs weekly_log.js.
+function applyWeeklyLogChange(change, workWeek) {
+    if (change.work_week !== workWeek) return;
+
+    const row = document.querySelector(`tr[data-equipment-id="${change.equipment_id}"]`);
+    if (!row || row.contains(document.activeElement) || row.dataset.dirty === 'true' || row.dataset.pending === 'true') return;
+
+    fillWeeklyLogRow(row, change.type === 'log_deleted' ? EMPTY_LOG_FIELDS : change.fields);
+    row.dataset.changeSeq = change.change_seq === null || change.change_seq === undefined ? '' : change.change_seq;
+    highlightWeeklyLogRow(row);
+}
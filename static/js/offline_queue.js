@@ -0,0 +1,188 @@
+// Offline queue for weekly log edits, flushed in batches to /api/weekly-log/sync
+//
+// Edits are kept in localStorage, one entry per pump and week (a later edit
+// replaces an earlier one), so they survive reloads and lost connections.
+// The batch being sent is stored together with its idempotency key: after
+// a failed or unanswered request the same batch goes out again with the
+// same key, so the server never applies it twice.
+
+const QUEUE_STORAGE_KEY = 'vpm-weekly-log-queue';
+const BATCH_STORAGE_KEY = 'vpm-weekly-log-batch';
+const SYNC_BATCH_SIZE = 50;
+const SYNC_RETRY_MS = 30000;
+
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}-${Math.random().toString(36).slice(2)}`;
+}
+
+class WeeklyLogQueue {
+    // handlers: onSaved(row), onConflict(conflict), onErrors(errors), onStatus(status)
+    constructor(handlers) {
+        this.handlers = handlers;
+        this.flushing = false;
+        this.lastError = null;
+
+        window.addEventListener('online', () => this.flush());
+        setInterval(() => {
+            if (this.count()) this.flush();
+        }, SYNC_RETRY_MS);
+    }
+
+    static rowKey(row) {
+        return `${row.work_week}:${row.equipment_id}`;
+    }
+
+    read(storageKey, fallback) {
+        try {
+            return JSON.parse(localStorage.getItem(storageKey)) || fallback;
+        } catch (error) {
+            return fallback;
+        }
+    }
+
+    write(storageKey, value) {
+        if (value === null) {
+            localStorage.removeItem(storageKey);
+        } else {
+            localStorage.setItem(storageKey, JSON.stringify(value));
+        }
+    }
+
+    // Queued edits that are not part of the batch being sent, by row key
+    pending() {
+        return this.read(QUEUE_STORAGE_KEY, {});
+    }
+
+    // Every unsynced edit, including the batch being sent
+    unsyncedRows() {
+        const batch = this.read(BATCH_STORAGE_KEY, null);
+        const rows = batch ? batch.rows.slice() : [];
+        return rows.concat(Object.values(this.pending()));
+    }
+
+    count() {
+        return this.unsyncedRows().length;
+    }
+
+    enqueue(row) {
+        const pending = this.pending();
+        pending[WeeklyLogQueue.rowKey(row)] = row;
+        this.write(QUEUE_STORAGE_KEY, pending);
+        this.reportStatus();
+    }
+
+    reportStatus() {
+        if (this.handlers.onStatus) {
+            this.handlers.onStatus({
+                pending: this.count(),
+                online: navigator.onLine,
+                error: this.lastError
+            });
+        }
+    }
+
+    // The stored batch, or a new one taken from the front of the queue
+    nextBatch() {
+        const stored = this.read(BATCH_STORAGE_KEY, null);
+        if (stored) return stored;
+
+        const pending = this.pending();
+        const keys = Object.keys(pending).slice(0, SYNC_BATCH_SIZE);
+        if (!keys.length) return null;
+
+        const batch = { key: newIdempotencyKey(), rows: keys.map(key => pending[key]) };
+        keys.forEach(key => { delete pending[key]; });
+        // Store the batch before the queue shrinks so no edit is ever lost
+        this.write(BATCH_STORAGE_KEY, batch);
+        this.write(QUEUE_STORAGE_KEY, pending);
+        return batch;
+    }
+
+    // Put a batch's rows back in the queue behind any newer edit of the same row
+    requeue(batch) {
+        const pending = this.pending();
+        batch.rows.forEach(row => {
+            const key = WeeklyLogQueue.rowKey(row);
+            if (!pending[key]) pending[key] = row;
+        });
+        this.write(QUEUE_STORAGE_KEY, pending);
+        this.write(BATCH_STORAGE_KEY, null);
+    }
+
+    sendBatch(batch) {
+        return fetch('/api/weekly-log/sync', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': batch.key
+            },
+            body: JSON.stringify({ rows: batch.rows })
+        });
+    }
+
+    completeBatch(data) {
+        // Edits queued while the batch was in flight were made on top of it
+        const pending = this.pending();
+        data.rows.forEach(saved => {
+            const queued = pending[WeeklyLogQueue.rowKey(saved)];
+            if (queued) queued.base_change_seq = saved.change_seq;
+        });
+        this.write(QUEUE_STORAGE_KEY, pending);
+        this.write(BATCH_STORAGE_KEY, null);
+
+        data.rows.forEach(saved => this.handlers.onSaved(saved));
+        data.conflicts.forEach(conflict => this.handlers.onConflict(conflict));
+        if (data.errors.length) this.handlers.onErrors(data.errors);
+    }
+
+    // Send queued edits batch by batch until the queue is empty or the
+    // server cannot be reached
+    async flush() {
+        if (this.flushing) return;
+        this.flushing = true;
+        this.lastError = null;
+
+        try {
+            let batch;
+            while ((batch = this.nextBatch())) {
+                let response;
+                try {
+                    response = await this.sendBatch(batch);
+                } catch (error) {
+                    // Offline: keep the batch and its key for the next attempt
+                    this.lastError = 'offline';
+                    break;
+                }
+
+                const isJson = (response.headers.get('Content-Type') || '').includes('application/json');
+                if (response.redirected || !isJson) {
+                    // Sent to the login page, the session has expired
+                    this.lastError = 'signed-out';
+                    break;
+                }
+                if (response.status >= 500) {
+                    this.lastError = 'server';
+                    break;
+                }
+
+                const data = await response.json();
+                if (response.status === 422) {
+                    // The key belongs to another request, send the rows again under a new one
+                    this.requeue(batch);
+                } else if (data.rows) {
+                    this.completeBatch(data);
+                } else {
+                    // The batch as a whole was rejected and retrying will not help
+                    this.write(BATCH_STORAGE_KEY, null);
+                    this.handlers.onErrors([{ field: null, message: data.error || 'Sync failed' }]);
+                }
+            }
+        } finally {
+            this.flushing = false;
+            this.reportStatus();
+        }
+    }
+}
@@ -0,0 +1,107 @@
+// Service worker keeping the weekly log usable without a connection
+//
+// The weekly log pages and the dropdown options are fetched from the
+// network first and cached, so the last version seen opens offline. Static
+// assets and CDN files are served from the cache and refreshed in the
+// background. Edits made offline are queued by offline_queue.js, not here.
+
+const CACHE_NAME = 'vpm-offline-v1';
+
+const PRECACHE_URLS = [
+    '/weekly-log',
+    '/static/css/styles.css',
+    '/static/js/theme_colors.js',
+    '/static/js/app.js',
+    '/static/js/error_logger.js',
+    '/static/js/weekly_log.js',
+    '/static/js/live_updates.js',
+    '/static/js/offline_queue.js'
+];
+
+const CDN_URLS = [
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css',
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/js/bootstrap.bundle.min.js',
+    'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.1/font/bootstrap-icons.css',
+    'https://cdn.jsdelivr.net/npm/chart.js@3.7.1/dist/chart.min.js'
+];
+
+const CDN_HOSTS = ['cdn.jsdelivr.net', 'fonts.googleapis.com', 'fonts.gstatic.com'];
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_NAME).then(cache => Promise.all([
+            // A page that fails to cache (e.g. signed out) is cached on its next visit
+            ...PRECACHE_URLS.map(url => cache.add(url).catch(() => null)),
+            ...CDN_URLS.map(url => cache.add(new Request(url, { mode: 'no-cors' })).catch(() => null))
+        ]))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key !== CACHE_NAME).map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+function isOfflinePage(url) {
+    return url.origin === self.location.origin &&
+        (url.pathname === '/weekly-log' || url.pathname.startsWith('/api/dropdown-options/'));
+}
+
+function isStaticAsset(url) {
+    return (url.origin === self.location.origin && url.pathname.startsWith('/static/')) ||
+        CDN_HOSTS.includes(url.hostname);
+}
+
+// Network first, falling back to the last cached copy
+function networkFirst(request) {
+    return fetch(request)
+        .then(response => {
+            // Redirects lead to the login page and are not worth keeping
+            if (response.ok && !response.redirected) {
+                const copy = response.clone();
+                caches.open(CACHE_NAME).then(cache => cache.put(request, copy));
+            }
+            return response;
+        })
+        .catch(() => caches.match(request).then(cached => cached || new Response(
+            'This page has not been opened on this device yet, so it is not available offline.',
+            { status: 503, headers: { 'Content-Type': 'text/plain' } }
+        )));
+}
+
+// Cached copy right away, refreshed from the network for next time
+function staleWhileRevalidate(request) {
+    return caches.open(CACHE_NAME).then(cache => cache.match(request).then(cached => {
+        const refresh = fetch(request)
+            .then(response => {
+                if (response.ok || response.type === 'opaque') {
+                    cache.put(request, response.clone());
+                }
+                return response;
+            })
+            .catch(() => cached);
+        return cached || refresh;
+    }));
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+
+    const url = new URL(request.url);
+    if (url.origin === self.location.origin && url.pathname === '/logout') {
+        // Signed-in pages must not outlive the session on a shared tablet
+        event.waitUntil(caches.delete(CACHE_NAME));
+        return;
+    }
+
+    if (isOfflinePage(url)) {
+        event.respondWith(networkFirst(request));
+    } else if (isStaticAsset(url)) {
+        event.respondWith(staleWhileRevalidate(request));
+    }
+});
@@ -29,6 +29,44 @@ function generateUniqueNeonColors(count) {
     return neonColors.slice(0, count);
 }
 
+// Expand the compact columnar chart payload (format=compact) into the
+// Chart.js structure the chart setup functions expect. Payloads without a
+// format flag are already in that structure and are returned unchanged.
+// Works on the combined /api/chart-data response as well as on the
+// temperature and maintenance-counts endpoints, which carry one chart each.
+function expandCompactChartData(data) {
+    if (!data || data.format !== 'compact') return data;
+
+    const expanded = Object.assign({}, data);
+
+    const compact = data.temperature_chart;
+    if (compact) {
+        const datasets = compact.names.map((name, series) => {
+            const indexes = compact.i[series];
+            const deltas = compact.v[series];
+            const values = new Array(compact.t.length).fill(null);
+            let index = 0;
+            let value = 0;
+            for (let i = 0; i < indexes.length; i++) {
+                index += indexes[i];
+                value += deltas[i];
+                values[index] = value / compact.scale;
+            }
+            return { label: name, data: values };
+        });
+        expanded.temperature_chart = { labels: compact.t, datasets: datasets };
+    }
+
+    if (data.maintenance_chart) {
+        expanded.maintenance_chart = {
+            labels: data.maintenance_chart.labels,
+            datasets: [{ data: data.maintenance_chart.values }]
+        };
+    }
+
+    return expanded;
+}
+
 function setupTemperatureChart(data) {
     const tempCtx = document.getElementById('temperatureChart').getContext('2d');
     const legendContainer = document.getElementById('tempChartLegend');
@@ -247,6 +285,29 @@ function setupTemperatureChart(data) {
     return temperatureChart;
 }
 
+// Update an existing temperature chart in place with freshly loaded data.
+// When the set of pumps changed the chart, legend and filters are rebuilt.
+function updateTemperatureChart(chart, data) {
+    const datasets = data.temperature_chart.datasets;
+    const sameSeries = chart && chart.data.datasets.length === datasets.length &&
+        chart.data.datasets.every((dataset, index) => dataset.label === datasets[index].label);
+
+    if (sameSeries) {
+        chart.data.labels = data.temperature_chart.labels;
+        datasets.forEach((dataset, index) => {
+            chart.data.datasets[index].data = dataset.data;
+        });
+        chart.update('none');
+        return chart;
+    }
+
+    if (chart) chart.destroy();
+    // Drop the old legend click handler before the legend is rebuilt
+    const legendContainer = document.getElementById('tempChartLegend');
+    if (legendContainer) legendContainer.replaceWith(legendContainer.cloneNode(false));
+    return setupTemperatureChart(data);
+}
+
 // Enhanced service chart with glow effects and rounded corners
 function setupServiceChart(data) {
     const serviceCtx = document.getElementById('serviceChart')?.getContext('2d');
@@ -0,0 +1,182 @@
+// Weekly log rows: reading, filling and saving them through the offline queue
+
+const LOG_CHECKBOX_FIELDS = ['oil_level_ok', 'oil_condition_ok', 'oil_filter_ok'];
+
+// Read the log fields of a weekly log row as sent to the sync API, with the
+// version of the log the edit was made against
+function collectWeeklyLogRow(row, workWeek) {
+    const field = name => row.querySelector(`[name="${name}"]`);
+    const data = {
+        equipment_id: Number(row.dataset.equipmentId),
+        work_week: workWeek,
+        base_change_seq: row.dataset.changeSeq ? Number(row.dataset.changeSeq) : null,
+        check_date: field('check_date').value || field('check_date_hidden').value,
+        user_name: field('user_name').value,
+        pump_temp: field('pump_temp').value,
+        service: field('service').value,
+        service_notes: field('service_notes').value
+    };
+    LOG_CHECKBOX_FIELDS.forEach(name => {
+        data[name] = field(name).checked;
+    });
+    return data;
+}
+
+// Set the inputs of a weekly log row from log fields
+function fillWeeklyLogRow(row, fields) {
+    Object.entries(fields).forEach(([name, value]) => {
+        row.querySelectorAll(`[name="${name}"]`).forEach(input => {
+            if (input.type === 'checkbox') {
+                input.checked = Boolean(value);
+            } else if (input.tagName === 'SELECT') {
+                const optionValue = value || 'None Required';
+                if (!Array.from(input.options).some(option => option.value === optionValue)) {
+                    const option = document.createElement('option');
+                    option.value = optionValue;
+                    option.textContent = optionValue;
+                    input.insertBefore(option, input.querySelector('option[value="custom"]'));
+                }
+                input.value = optionValue;
+            } else {
+                input.value = value === null || value === undefined ? '' : value;
+            }
+        });
+        if (name === 'check_date') {
+            row.querySelectorAll('[name="check_date_hidden"]').forEach(input => { input.value = value; });
+        }
+    });
+}
+
+function highlightWeeklyLogRow(row) {
+    row.classList.add('live-updated');
+    setTimeout(() => row.classList.remove('live-updated'), 2000);
+}
+
+// Show a dismissible message above the weekly log, like a flashed message
+function showWeeklyLogMessage(message, category) {
+    const alert = document.createElement('div');
+    alert.className = `alert alert-${category} alert-dismissible fade show mt-3`;
+    alert.setAttribute('role', 'alert');
+    alert.textContent = message;
+
+    const closeButton = document.createElement('button');
+    closeButton.type = 'button';
+    closeButton.className = 'btn-close';
+    closeButton.setAttribute('data-bs-dismiss', 'alert');
+    closeButton.setAttribute('aria-label', 'Close');
+    alert.appendChild(closeButton);
+
+    document.querySelector('main').prepend(alert);
+    if (category !== 'danger') {
+        setTimeout(() => closeButton.click(), 5000);
+    }
+}
+
+// Add the delete button to a row whose log was just created
+function addDeleteButton(row, logId) {
+    const actions = row.querySelector('.actions-col .d-grid');
+    if (!actions || actions.querySelector('.btn-danger')) return;
+
+    const link = document.createElement('a');
+    link.href = `/maintenance/log/${logId}/delete`;
+    link.className = 'btn btn-danger';
+    link.innerHTML = '<i class="bi bi-trash"></i>';
+    link.addEventListener('click', event => confirmDelete(event, 'Are you sure you want to delete this maintenance log?'));
+    actions.appendChild(link);
+}
+
+function findWeeklyLogRow(equipmentId, workWeek) {
+    const table = document.querySelector('.maintenance-table');
+    if (!table || table.dataset.workWeek !== workWeek) return null;
+    return table.querySelector(`tr[data-equipment-id="${equipmentId}"]`);
+}
+
+function weeklyLogRowName(row, equipmentId) {
+    return row ? row.querySelector('td').textContent.trim() : `Equipment ${equipmentId}`;
+}
+
+// Queue handlers updating the page as batches are synced
+const weeklyLogSyncHandlers = {
+    onSaved(saved) {
+        const row = findWeeklyLogRow(saved.equipment_id, saved.work_week);
+        if (!row) return;
+        row.dataset.changeSeq = saved.change_seq;
+        delete row.dataset.pending;
+        row.classList.remove('log-pending', 'log-conflict');
+        // Leave rows edited again since the save alone, they are queued already
+        if (row.dataset.dirty !== 'true') fillWeeklyLogRow(row, saved);
+        addDeleteButton(row, saved.log_id);
+        highlightWeeklyLogRow(row);
+    },
+
+    onConflict(conflict) {
+        const row = findWeeklyLogRow(conflict.equipment_id, conflict.work_week);
+        const current = conflict.current;
+        const by = current && current.user_name ? ` by ${current.user_name}` : '';
+        const change = current ? `changed${by}` : 'deleted';
+        if (row) {
+            // Keep the technician's values on screen, the next save overrides
+            row.dataset.changeSeq = current ? current.change_seq : '';
+            row.dataset.dirty = 'true';
+            delete row.dataset.pending;
+            row.classList.remove('log-pending');
+            row.classList.add('log-conflict');
+        }
+        showWeeklyLogMessage(
+            `${weeklyLogRowName(row, conflict.equipment_id)} (${conflict.work_week}) was ${change} before your edit reached the server. ` +
+            'Your values are still shown; check them and save again to keep them.',
+            'warning'
+        );
+    },
+
+    onErrors(errors) {
+        errors.forEach(error => {
+            const row = error.equipment_id ? findWeeklyLogRow(error.equipment_id, error.work_week) : null;
+            if (row) row.classList.remove('log-pending');
+        });
+        const details = errors.map(error => error.field ? `${error.field}: ${error.message}` : error.message);
+        showWeeklyLogMessage(`Error saving maintenance log: ${details.join('; ')}`, 'danger');
+    },
+
+    onStatus(status) {
+        const badge = document.getElementById('syncStatus');
+        if (!badge) return;
+        if (!status.pending) {
+            badge.className = 'badge bg-success';
+            badge.textContent = 'All changes saved';
+        } else if (!status.online || status.error === 'offline') {
+            badge.className = 'badge bg-warning text-dark';
+            badge.textContent = `Offline: ${status.pending} change${status.pending === 1 ? '' : 's'} waiting to sync`;
+        } else if (status.error === 'signed-out') {
+            badge.className = 'badge bg-danger';
+            badge.textContent = `Sign in again to sync ${status.pending} change${status.pending === 1 ? '' : 's'}`;
+        } else {
+            badge.className = 'badge bg-info text-dark';
+            badge.textContent = `Syncing ${status.pending} change${status.pending === 1 ? '' : 's'}...`;
+        }
+    }
+};
+
+// Queue the rows' current values and start syncing them
+function saveWeeklyLogRows(queue, workWeek, rows) {
+    rows.forEach(row => {
+        queue.enqueue(collectWeeklyLogRow(row, workWeek));
+        row.dataset.pending = 'true';
+        row.dataset.dirty = 'false';
+        row.classList.add('log-pending');
+    });
+    return queue.flush();
+}
+
+// Show edits still waiting in the queue, e.g. after reopening the page offline
+function restoreQueuedRows(queue, workWeek) {
+    queue.unsyncedRows()
+        .filter(queued => queued.work_week === workWeek)
+        .forEach(queued => {
+            const row = findWeeklyLogRow(queued.equipment_id, workWeek);
+            if (!row) return;
+            fillWeeklyLogRow(row, queued);
+            row.dataset.pending = 'true';
+            row.classList.add('log-pending');
+        });
+}
@@ -0,0 +1,362 @@
+"""
+Hourly and daily rollups of logger temperature readings
+
+Every batch of readings written by readings_ingest is aggregated into
+temperature_hourly and temperature_daily (minimum, maximum, sum and count
+per pump and bucket) in the same transaction as the raw rows, by merging
+it into the existing buckets. Charts over long windows then read one row
+per pump and hour or day instead of scanning every reading.
+
+Raw readings older than TEMPERATURE_RAW_RETENTION_DAYS are moved to
+temperature_reading_archive, or deleted when TEMPERATURE_RETENTION_ACTION
+is 'delete', and hourly rollups older than TEMPERATURE_HOURLY_RETENTION_DAYS
+are deleted. Daily rollups are kept. Cutoffs fall on UTC midnight, so the
+raw readings left always start with a whole day and rebuild() can
+recompute the rollups from them without touching older buckets.
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import jsonify
+from sqlalchemy import func, select, text
+from chart_series import bucket_expression, aggregate_expression
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Seconds between retention runs in each worker
+RETENTION_INTERVAL = 3600
+
+# Raw readings archived or deleted per transaction
+RETENTION_BATCH_ROWS = 20000
+
+# Raw readings aggregated at a time when rebuilding rollups
+REBUILD_CHUNK_ROWS = 20000
+
+RETENTION_ACTIONS = ('archive', 'delete')
+
+# Shortest span each chart bucket stands for, in seconds
+BUCKET_SECONDS = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+    'week': 7 * 86400,
+    'month': 28 * 86400
+}
+
+def truncate_hour(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def truncate_day(ts):
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def aggregate_readings(readings, truncate):
+    """Rollup rows for (equipment_id, ts, value) readings, one per pump and bucket
+
+    Rows come sorted by pump and bucket so concurrent writers lock buckets
+    in the same order.
+    """
+    buckets = {}
+    for equipment_id, ts, value in readings:
+        key = (equipment_id, truncate(ts))
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [value, value, value, 1]
+        else:
+            if value < bucket[0]:
+                bucket[0] = value
+            if value > bucket[1]:
+                bucket[1] = value
+            bucket[2] += value
+            bucket[3] += 1
+
+    return [{
+        'equipment_id': equipment_id,
+        'bucket_start': bucket_start,
+        'min_value': bucket[0],
+        'max_value': bucket[1],
+        'sum_value': bucket[2],
+        'reading_count': bucket[3]
+    } for (equipment_id, bucket_start), bucket in sorted(buckets.items())]
+
+def upsert_statement(table, dialect_name):
+    """INSERT ... ON CONFLICT merging rollup rows into the buckets already stored"""
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        least, greatest = func.least, func.greatest
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+        # SQLite's min() and max() are scalar functions when given two arguments
+        least, greatest = func.min, func.max
+
+    statement = insert(table)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.equipment_id, table.c.bucket_start],
+        set_={
+            'min_value': least(table.c.min_value, excluded.min_value),
+            'max_value': greatest(table.c.max_value, excluded.max_value),
+            'sum_value': table.c.sum_value + excluded.sum_value,
+            'reading_count': table.c.reading_count + excluded.reading_count
+        }
+    )
+
+class TemperatureRollups:
+    """Incremental rollups, retention and chart queries for logger readings"""
+    # (source, seconds per row), coarsest first
+    SOURCES = (('daily', 86400), ('hourly', 3600), ('raw', 0))
+
+    def __init__(self, reading_table, archive_table, hourly_table, daily_table, equipment_table,
+                 raw_retention_days=30, hourly_retention_days=400, retention_action='archive'):
+        self.reading = reading_table
+        self.archive = archive_table
+        self.hourly = hourly_table
+        self.daily = daily_table
+        self.equipment = equipment_table
+        self.raw_retention_days = raw_retention_days
+        self.hourly_retention_days = hourly_retention_days
+        self.retention_action = retention_action
+        self._last_retention = 0.0
+        self._retention_lock = threading.Lock()
+
+    def apply(self, connection, readings):
+        """Merge (equipment_id, ts, value) readings into the rollups on connection's transaction"""
+        dialect_name = connection.dialect.name
+        for table, truncate in ((self.hourly, truncate_hour), (self.daily, truncate_day)):
+            rows = aggregate_readings(readings, truncate)
+            if rows:
+                connection.execute(upsert_statement(table, dialect_name), rows)
+
+    @staticmethod
+    def retention_cutoff(days):
+        """UTC midnight days ago; rows before it have expired"""
+        return truncate_day(datetime.utcnow()) - timedelta(days=days)
+
+    def rebuild(self, engine):
+        """Recompute the rollups of every day still held in raw readings
+
+        Returns the number of readings aggregated. Buckets before the first
+        raw reading, whose readings were archived or deleted, are kept.
+        """
+        reading = self.reading
+        with engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                # Hold off flushes until the rollups match the raw readings again
+                connection.exec_driver_sql(f"LOCK TABLE {reading.name} IN SHARE MODE")
+
+            first_ts = connection.execute(select(func.min(reading.c.ts))).scalar()
+            if first_ts is None:
+                return 0
+            if isinstance(first_ts, str):
+                first_ts = datetime.fromisoformat(first_ts)
+            start = truncate_day(first_ts)
+            if self.raw_retention_days:
+                # Days the retention policy is about to remove are left alone
+                start = max(start, self.retention_cutoff(self.raw_retention_days))
+
+            for table in (self.hourly, self.daily):
+                connection.execute(table.delete().where(table.c.bucket_start >= start))
+
+            result = connection.execution_options(stream_results=True).execute(
+                select(reading.c.equipment_id, reading.c.ts, reading.c.value).where(reading.c.ts >= start)
+            )
+            count = 0
+            while True:
+                chunk = result.fetchmany(REBUILD_CHUNK_ROWS)
+                if not chunk:
+                    break
+                self.apply(connection, [tuple(row) for row in chunk])
+                count += len(chunk)
+
+        logger.info(f"Rebuilt temperature rollups from {count} readings since {start:%Y-%m-%d}")
+        return count
+
+    def _expire_raw_batch(self, connection, cutoff):
+        """Archive or delete up to RETENTION_BATCH_ROWS expired readings
+
+        Returns (readings selected, rows archived or deleted).
+        """
+        reading = self.reading
+        ids = connection.execute(
+            select(reading.c.reading_id)
+            .where(reading.c.ts < cutoff)
+            .order_by(reading.c.reading_id)
+            .limit(RETENTION_BATCH_ROWS)
+        ).scalars().all()
+        if not ids:
+            return 0, 0
+
+        in_batch = reading.c.reading_id.between(ids[0], ids[-1]) & (reading.c.ts < cutoff)
+        if self.retention_action == 'delete':
+            return len(ids), connection.execute(reading.delete().where(in_batch)).rowcount
+
+        if connection.dialect.name == 'postgresql':
+            # Move the rows in one statement so a reading committed meanwhile is never lost
+            result = connection.execute(text(
+                f"WITH moved AS (DELETE FROM {reading.name} "
+                f"WHERE reading_id BETWEEN :low AND :high AND ts < :cutoff "
+                f"RETURNING reading_id, equipment_id, ts, value) "
+                f"INSERT INTO {self.archive.name} (reading_id, equipment_id, ts, value) "
+                f"SELECT reading_id, equipment_id, ts, value FROM moved"
+            ), {'low': ids[0], 'high': ids[-1], 'cutoff': cutoff})
+            return len(ids), result.rowcount
+
+        # SQLite holds the write lock from the INSERT on, so both statements see the same rows
+        columns = ['reading_id', 'equipment_id', 'ts', 'value']
+        moved = connection.execute(self.archive.insert().from_select(
+            columns, select(*[reading.c[name] for name in columns]).where(in_batch)
+        )).rowcount
+        connection.execute(reading.delete().where(in_batch))
+        return len(ids), moved
+
+    def enforce_retention(self, engine, force=False):
+        """Archive or delete expired raw readings and delete expired hourly rollups
+
+        Runs at most once per RETENTION_INTERVAL unless force is set, and
+        returns the row counts, or None when it did not run.
+        """
+        if not force and time.time() - self._last_retention < RETENTION_INTERVAL:
+            return None
+        if not self._retention_lock.acquire(blocking=False):
+            return None
+
+        try:
+            self._last_retention = time.time()
+            counts = {'raw_archived': 0, 'raw_deleted': 0, 'hourly_deleted': 0}
+
+            if self.raw_retention_days:
+                cutoff = self.retention_cutoff(self.raw_retention_days)
+                key = 'raw_deleted' if self.retention_action == 'delete' else 'raw_archived'
+                while True:
+                    with engine.begin() as connection:
+                        selected, affected = self._expire_raw_batch(connection, cutoff)
+                    counts[key] += affected
+                    if selected < RETENTION_BATCH_ROWS:
+                        break
+
+            if self.hourly_retention_days:
+                cutoff = self.retention_cutoff(self.hourly_retention_days)
+                with engine.begin() as connection:
+                    counts['hourly_deleted'] = connection.execute(
+                        self.hourly.delete().where(self.hourly.c.bucket_start < cutoff)
+                    ).rowcount
+
+            if any(counts.values()):
+                logger.info(f"Temperature retention: {counts}")
+            return counts
+        finally:
+            self._retention_lock.release()
+
+    def _covers(self, source, window_days):
+        retention_days = {
+            'daily': 0,
+            'hourly': self.hourly_retention_days,
+            'raw': self.raw_retention_days
+        }[source]
+        return not retention_days or window_days <= retention_days
+
+    def choose_source(self, params):
+        """Pick the coarsest of daily, hourly and raw that serves the chart params
+
+        The resolution needed is the bucket size, or the window divided by
+        max_points when that is coarser, since LTTB would drop the extra
+        points anyway. Only sources still holding the whole window qualify;
+        when none of those is fine enough, the finest of them is used.
+        """
+        needed = max(BUCKET_SECONDS[params['bucket']], params['window'] * 86400 / params['max_points'])
+        covering = [(source, seconds) for source, seconds in self.SOURCES if self._covers(source, params['window'])]
+        for source, seconds in covering:
+            if seconds <= needed:
+                return source
+        return covering[-1][0]
+
+    def chart_rows(self, session, params, dialect_name):
+        """(equipment name, bucket label, value) rows for a reading chart, plus the source used"""
+        source = self.choose_source(params)
+        start = datetime.utcnow() - timedelta(days=params['window'])
+
+        if source == 'raw':
+            table = self.reading
+            time_column = table.c.ts
+            value = aggregate_expression(table.c.value, params['agg'])
+        else:
+            table = self.hourly if source == 'hourly' else self.daily
+            time_column = table.c.bucket_start
+            start = truncate_hour(start) if source == 'hourly' else truncate_day(start)
+            value = {
+                'avg': func.sum(table.c.sum_value) / func.sum(table.c.reading_count),
+                'min': func.min(table.c.min_value),
+                'max': func.max(table.c.max_value)
+            }[params['agg']]
+
+        bucket = bucket_expression(time_column, params['bucket'], dialect_name)
+        equipment = self.equipment
+        rows = session.execute(
+            select(equipment.c.equipment_name, bucket.label('bucket'), value)
+            .select_from(table.join(equipment, equipment.c.equipment_id == table.c.equipment_id))
+            .where(time_column >= start)
+            .group_by(equipment.c.equipment_name, bucket)
+            .order_by(bucket)
+        ).all()
+        return rows, source
+
+def setup_temperature_rollups(app, db, reading_model, archive_model, hourly_model, daily_model, equipment_model):
+    """Configure reading rollups and retention, and register their admin routes"""
+    app.config.setdefault('TEMPERATURE_RAW_RETENTION_DAYS', int(os.environ.get('TEMPERATURE_RAW_RETENTION_DAYS', '30')))
+    app.config.setdefault('TEMPERATURE_HOURLY_RETENTION_DAYS', int(os.environ.get('TEMPERATURE_HOURLY_RETENTION_DAYS', '400')))
+    app.config.setdefault('TEMPERATURE_RETENTION_ACTION', os.environ.get('TEMPERATURE_RETENTION_ACTION', 'archive').lower())
+
+    retention_action = app.config['TEMPERATURE_RETENTION_ACTION']
+    if retention_action not in RETENTION_ACTIONS:
+        logger.warning(f"Unknown TEMPERATURE_RETENTION_ACTION '{retention_action}', archiving instead")
+        retention_action = 'archive'
+
+    rollups = TemperatureRollups(
+        reading_model.__table__,
+        archive_model.__table__,
+        hourly_model.__table__,
+        daily_model.__table__,
+        equipment_model.__table__,
+        raw_retention_days=app.config['TEMPERATURE_RAW_RETENTION_DAYS'],
+        hourly_retention_days=app.config['TEMPERATURE_HOURLY_RETENTION_DAYS'],
+        retention_action=retention_action
+    )
+
+    @app.route('/admin/temperature-rollups/rebuild', methods=['POST'])
+    @app.admin_required
+    def rebuild_temperature_rollups():
+        """Recompute the hourly and daily rollups from the raw readings"""
+        try:
+            count = rollups.rebuild(db.engine)
+            return jsonify({
+                "status": "success",
+                "message": f"Rebuilt rollups from {count} readings",
+                "readings": count,
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception as e:
+            logger.error(f"Error rebuilding temperature rollups: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/admin/temperature-retention', methods=['POST'])
+    @app.admin_required
+    def run_temperature_retention():
+        """Apply the raw reading and hourly rollup retention policy now"""
+        try:
+            counts = rollups.enforce_retention(db.engine, force=True)
+            if counts is None:
+                return jsonify({"error": "Retention is already running in this worker"}), 409
+            return jsonify({
+                "status": "success",
+                "message": "Retention policy applied",
+                "retention_action": rollups.retention_action,
+                "counts": counts,
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception as e:
+            logger.error(f"Error applying temperature retention: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    return rollups
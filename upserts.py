@@ -0,0 +1,62 @@
+"""
+Upserts and row locks for the tables derived from maintenance logs
+
+work_week_summary, pump_attention and equipment_stats are recomputed inside
+the transaction that saved the logs. Deleting a row and inserting it again
+fails on PostgreSQL when two saves touch the same row: the second DELETE
+waits for the first transaction, finds nothing once it commits, and the
+INSERT then hits the primary key. Rows are therefore written with
+INSERT ... ON CONFLICT DO UPDATE.
+
+An upsert alone still lets the second save write figures computed before
+the first one committed. lock_keys makes writers of the same rows queue up
+before they read the logs: on PostgreSQL it inserts missing rows as
+placeholders, which waits for a concurrent insert of the same key, and
+then locks the rows with SELECT ... FOR UPDATE. Under READ COMMITTED every
+statement after that sees the other save's logs. SQLite lets one writer in
+at a time, and the flush that wrote the logs already holds the lock.
+"""
+from sqlalchemy import select
+
+def _insert(dialect_name):
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert
+
+def upsert_rows(connection, table, rows, key_column):
+    """Insert rows, overwriting the other columns of the rows whose key exists"""
+    if not rows:
+        return
+    insert = _insert(connection.dialect.name)
+    key = table.c[key_column]
+    if insert is None:
+        connection.execute(table.delete().where(key.in_([row[key_column] for row in rows])))
+        connection.execute(table.insert(), rows)
+        return
+
+    statement = insert(table)
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[key],
+        set_={name: statement.excluded[name] for name in rows[0] if name != key_column}
+    ), rows)
+
+def lock_keys(connection, table, key_column, keys, placeholder=None):
+    """Lock the rows of keys until the transaction ends, on PostgreSQL
+
+    placeholder(key) gives the row to insert for a key without one, so
+    writers of a new key queue up as well; without it only existing rows
+    are locked. Does nothing on other databases.
+    """
+    if connection.dialect.name != 'postgresql' or not keys:
+        return
+    keys = sorted(keys)
+    key = table.c[key_column]
+    if placeholder is not None:
+        # In key order, so two writers never wait on each other's keys
+        statement = _insert('postgresql')(table).on_conflict_do_nothing(index_elements=[key])
+        connection.execute(statement, [placeholder(value) for value in keys])
+    connection.execute(select(key).where(key.in_(keys)).order_by(key).with_for_update())
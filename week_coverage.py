@@ -0,0 +1,320 @@
+"""
+Per-week coverage bitmaps of which pumps were checked
+
+work_week_summary.coverage holds, for each work week, a bitmap with bit n
+set when the pump whose coverage_bit is n has a log that week, stored as
+little-endian bytes: an eighth of a byte per pump, so 20,000 pumps over ten
+years of weeks take about 1.3 MB. The bitmaps are rebuilt together with the
+rest of the week's summary whenever its logs change.
+
+Pumps get their coverage_bit from a counter when they are inserted, so the
+bits stay dense whatever the equipment_ids are: imported or restored ids
+that are huge or negative do not widen the bitmaps. A deleted pump's bit is
+not reused.
+
+CoverageIndex keeps the bitmaps in memory as Python integers, along with
+the bitmap of the pumps on the weekly log and of each owner's pumps, keyed
+by owner_id, and reloads them when the data version changes. Coverage,
+owner scores and missed-week streaks are then AND, OR and bit counts over
+those integers instead of queries over the logs. A pump checked in the
+current week has no streak, and the streak of a pump never checked since
+it was added only counts the weeks since then.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import request, jsonify
+from sqlalchemy import select, event, bindparam
+from sqlalchemy.orm import Session
+from data_version import get_data_version, conditional_json
+from eligibility import weekly_log_filter
+from change_sync import next_counter_values
+from work_weeks import week_label, week_key
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_COVERAGE_WEEKS = 12
+DEFAULT_MISSED_WEEKS = 2
+# How far back missed-week streaks are counted
+STREAK_LOOKBACK_WEEKS = 52
+
+# Name of the counter handing out coverage bits
+BIT_COUNTER_NAME = 'coverage_bits'
+
+_equipment_table = None
+_summary_table = None
+
+def to_bitmap(positions):
+    """Bitmap with the bit at every position set"""
+    bits = 0
+    for position in positions:
+        bits |= 1 << position
+    return bits
+
+def bitmap_bytes(bits):
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+def bitmap_from_bytes(data):
+    return int.from_bytes(data, 'little') if data else 0
+
+if hasattr(int, 'bit_count'):
+    def popcount(bits):
+        """Number of set bits"""
+        return bits.bit_count()
+else:
+    def popcount(bits):
+        """Number of set bits (int.bit_count needs Python 3.10)"""
+        return bin(bits).count('1')
+
+def bitmap_positions(bits):
+    """Positions of the set bits, in ascending order"""
+    positions = []
+    while bits:
+        lowest = bits & -bits
+        positions.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return positions
+
+def backfill_coverage_bits(engine):
+    """Give pumps written outside the ORM, such as bulk loads, a coverage bit
+
+    Bits go out in equipment_id order. When existing pumps get one, the
+    stored week bitmaps are cleared so backfill_week_summaries rebuilds them
+    with the new bits. Safe to run on every start and from several workers
+    at once.
+    """
+    equipment = _equipment_table
+    try:
+        with engine.begin() as connection:
+            missing = [
+                equipment_id for (equipment_id,) in connection.execute(
+                    select(equipment.c.equipment_id).where(equipment.c.coverage_bit.is_(None))
+                    .order_by(equipment.c.equipment_id)
+                )
+            ]
+            if not missing:
+                return 0
+            first = next_counter_values(connection, BIT_COUNTER_NAME, len(missing))
+            connection.execute(
+                equipment.update()
+                .where(equipment.c.equipment_id == bindparam('_equipment_id'))
+                .where(equipment.c.coverage_bit.is_(None))
+                .values(coverage_bit=bindparam('_coverage_bit')),
+                [{'_equipment_id': equipment_id, '_coverage_bit': first + offset}
+                 for offset, equipment_id in enumerate(missing)]
+            )
+            connection.execute(_summary_table.update().values(coverage=None))
+        logger.info(f"Assigned coverage bits to {len(missing)} pumps")
+        return len(missing)
+    except Exception as e:
+        # Usually another worker assigned them first
+        logger.warning(f"Coverage bit backfill skipped: {e}")
+        return 0
+
+class CoverageIndex:
+    """In-memory week bitmaps, reloaded whenever the data version changes"""
+    def __init__(self, summary_table, equipment_model, person_table, log_table, work_week_of):
+        self.summary = summary_table
+        self.equipment_model = equipment_model
+        self.person = person_table
+        self.log = log_table
+        self.work_week_of = work_week_of
+        self._lock = threading.Lock()
+        self._token = None
+        self._people_token = None
+        self.weeks = {}
+        self.eligible = 0
+        self.owners = {}
+        self.owner_names = {}
+        self.names = {}
+        self.equipment_ids = {}
+        self.added_weeks = {}
+        self.people_weeks = {}
+
+    def load(self, session, token=None):
+        """Make sure the bitmaps match the database, reloading them if not
+
+        token is the current data version, when the caller has it already.
+        """
+        if token is None:
+            token, _ = get_data_version(session)
+        if token == self._token:
+            return self
+        with self._lock:
+            if token == self._token:
+                return self
+            equipment = self.equipment_model.__table__
+            weeks = {
+                work_week: bitmap_from_bytes(coverage)
+                for work_week, coverage in session.execute(select(self.summary.c.work_week, self.summary.c.coverage))
+            }
+            eligible = 0
+            owners = {}
+            owner_names = {}
+            names = {}
+            equipment_ids = {}
+            added_weeks = {}
+            person_id = list(self.person.primary_key.columns)[0]
+            for equipment_id, coverage_bit, equipment_name, owner_id, owner_name, created_at in session.execute(
+                select(equipment.c.equipment_id, equipment.c.coverage_bit, equipment.c.equipment_name,
+                       equipment.c.owner_id, self.person.c.name, equipment.c.created_at)
+                .select_from(equipment.outerjoin(self.person, person_id == equipment.c.owner_id))
+                .where(weekly_log_filter(self.equipment_model), equipment.c.coverage_bit.isnot(None))
+            ):
+                eligible |= 1 << coverage_bit
+                names[equipment_id] = equipment_name
+                equipment_ids[coverage_bit] = equipment_id
+                if created_at is not None:
+                    added_weeks[coverage_bit] = week_key(self.work_week_of(created_at))
+                if owner_id is not None:
+                    owners[owner_id] = owners.get(owner_id, 0) | 1 << coverage_bit
+                    owner_names[owner_id] = owner_name
+            self.weeks, self.eligible, self.owners, self.owner_names = weeks, eligible, owners, owner_names
+            self.names, self.equipment_ids, self.added_weeks = names, equipment_ids, added_weeks
+            self._token = token
+        return self
+
+    def load_people_weeks(self, session):
+        """Load which of the weekly log's pumps each pump owner checked themselves, by week
+
+        Fills people_weeks with {user_id: {work_week: bitmap}}, reloading it
+        when the data version changes. Call load() first.
+        """
+        token = self._token
+        if token == self._people_token:
+            return self.people_weeks
+        equipment = self.equipment_model.__table__
+        log_table = self.log
+        owner_ids = list(self.owners)
+        people_weeks = {}
+        if owner_ids:
+            for user_id, key, coverage_bit in session.execute(
+                select(log_table.c.user_id, log_table.c.week_key, equipment.c.coverage_bit).distinct()
+                .select_from(log_table.join(equipment, equipment.c.equipment_id == log_table.c.equipment_id))
+                .where(log_table.c.user_id.in_(owner_ids), log_table.c.week_key.isnot(None),
+                       weekly_log_filter(self.equipment_model), equipment.c.coverage_bit.isnot(None))
+            ):
+                weeks = people_weeks.setdefault(user_id, {})
+                work_week = week_label(key)
+                weeks[work_week] = weeks.get(work_week, 0) | 1 << coverage_bit
+        with self._lock:
+            self.people_weeks = people_weeks
+            self._people_token = token
+        return people_weeks
+
+    def week(self, work_week):
+        """Bitmap of the pumps checked in a work week"""
+        return self.weeks.get(work_week, 0)
+
+    def coverage(self, work_week, pumps=None):
+        """(pumps checked, pumps) for a work week, of the weekly log's pumps by default"""
+        pumps = self.eligible if pumps is None else pumps
+        return popcount(self.week(work_week) & pumps), popcount(pumps)
+
+    def missed_streaks(self, work_weeks, pumps=None):
+        """Consecutive weeks without a check of each pump, counted back from the first week given
+
+        work_weeks runs newest first. Pumps not checked in any of them get
+        the number of those weeks since the week they were added, or
+        len(work_weeks) when that is not known.
+        """
+        remaining = self.eligible if pumps is None else pumps
+        streaks = {}
+        for missed, work_week in enumerate(work_weeks):
+            checked = remaining & self.week(work_week)
+            for position in bitmap_positions(checked):
+                streaks[self.equipment_ids[position]] = missed
+            remaining &= ~checked
+            if not remaining:
+                break
+        keys = [week_key(work_week) for work_week in work_weeks]
+        for position in bitmap_positions(remaining):
+            added = self.added_weeks.get(position)
+            streaks[self.equipment_ids[position]] = (
+                len(work_weeks) if added is None else sum(1 for key in keys if key >= added)
+            )
+        return streaks
+
+def recent_work_weeks(work_week_of, count, today=None, include_current=True):
+    """Work week keys of the last count weeks, newest first"""
+    today = today or datetime.now().date()
+    start = 0 if include_current else 1
+    return [work_week_of(today - timedelta(weeks=offset)) for offset in range(start, start + count)]
+
+def setup_week_coverage(app, db, summary_model, equipment_model, person_model, log_model, work_week_of):
+    """Create the coverage index, register /api/week-coverage and hand out coverage bits
+
+    work_week_of maps a date to its work_week key.
+    """
+    global _equipment_table, _summary_table
+    _equipment_table = equipment_model.__table__
+    _summary_table = summary_model.__table__
+    index = CoverageIndex(summary_model.__table__, equipment_model, person_model.__table__, log_model.__table__,
+                          work_week_of)
+
+    @event.listens_for(Session, "before_flush")
+    def assign_new_bits(session, flush_context, instances):
+        """Give pumps inserted by this flush the next coverage bits"""
+        new_equipment = [
+            obj for obj in session.new
+            if isinstance(obj, equipment_model) and obj.coverage_bit is None
+        ]
+        if not new_equipment:
+            return
+        first = next_counter_values(session.connection(), BIT_COUNTER_NAME, len(new_equipment))
+        for offset, equipment in enumerate(new_equipment):
+            equipment.coverage_bit = first + offset
+
+    @app.route('/api/week-coverage')
+    def week_coverage():
+        """Share of the weekly log's pumps checked in each recent week, and the pumps missing checks
+
+        Query parameters: weeks (default DEFAULT_COVERAGE_WEEKS) and missed,
+        the number of consecutive completed weeks without a check that lists
+        a pump (default DEFAULT_MISSED_WEEKS).
+        """
+        try:
+            weeks = int(request.args.get('weeks', DEFAULT_COVERAGE_WEEKS))
+            missed = int(request.args.get('missed', DEFAULT_MISSED_WEEKS))
+        except ValueError:
+            return jsonify({"error": "weeks and missed must be whole numbers"}), 400
+        if not 1 <= weeks <= 520 or not 1 <= missed <= 520:
+            return jsonify({"error": "weeks and missed must be between 1 and 520"}), 400
+        today = datetime.now().date()
+
+        def build_payload():
+            index.load(db.session)
+            coverage = []
+            for work_week in recent_work_weeks(work_week_of, weeks, today):
+                checked, pumps = index.coverage(work_week)
+                coverage.append({
+                    'work_week': work_week,
+                    'checked': checked,
+                    'pumps': pumps,
+                    'rate': round(checked / pumps * 100, 1) if pumps else None
+                })
+
+            # The current week is still in progress, so streaks count completed
+            # weeks, and pumps already checked in it have none
+            streaks = index.missed_streaks(recent_work_weeks(
+                work_week_of, max(missed, STREAK_LOOKBACK_WEEKS), today, include_current=False
+            ), index.eligible & ~index.week(work_week_of(today)))
+            missing = sorted(equipment_id for equipment_id, streak in streaks.items() if streak >= missed)
+            return {
+                'weeks': coverage,
+                'missed': [
+                    {'equipment_id': equipment_id, 'equipment_name': index.names.get(equipment_id), 'missed_weeks': streaks[equipment_id]}
+                    for equipment_id in missing
+                ],
+                'missed_threshold': missed
+            }
+
+        try:
+            key = f"week-coverage|{weeks}|{missed}|{today}"
+            return conditional_json(db.session, key, build_payload)
+        except Exception as e:
+            logger.error(f"Error loading week coverage: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    return index
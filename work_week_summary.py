@@ -0,0 +1,439 @@
+"""
+Per-work-week maintenance summaries for compliance trends
+
+work_week_summary holds one row per work week with how many pumps the
+weekly log listed, how many of those pumps were checked, the oil services,
+the high-temperature checks, the temperature sum and count, and the bitmap
+of the pumps checked (see week_coverage). Each flushed log adds itself to
+its week's row, and takes back what it added before when it is edited or
+deleted, in the same transaction, so /api/compliance-trend reads years of
+history from a few hundred rows instead of every log and saving a log
+costs the same however many pumps there are. Weeks are recomputed from
+their logs when their row is missing, when pumps are added, removed or
+change eligibility, and for bulk changes, restores and the backfill.
+
+Pumps come and go, and the logs do not say which pumps the weekly log
+listed at the time, so eligible_pumps is counted when a week is first
+summarized and kept afterwards. The current week's count follows equipment
+changes until the week is over.
+"""
+import logging
+from datetime import datetime
+from flask import request, jsonify
+from sqlalchemy import event, func, select, case, true
+from sqlalchemy.orm import Session
+from data_version import conditional_json
+from eligibility import weekly_log_filter
+from anomaly_engine import HIGH_TEMP_LIMIT
+from week_coverage import to_bitmap, bitmap_bytes, bitmap_from_bytes
+from work_weeks import week_key, week_label
+from upserts import upsert_rows, lock_keys
+from lookups import name_in, name_key, previous_name
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+ADD_OIL = 'Add Oil'
+DRAIN_REPLACE = 'Drain & Replace Oil'
+DEFAULT_TREND_WEEKS = 104
+
+# Session.info flag set by bulk changes of maintenance logs
+REBUILD_FLAG = 'work_week_summary_rebuild'
+# Session.info set of work weeks to recompute once the flush has written their logs
+PENDING_KEY = 'work_week_summary_pending'
+# Session.info list of what flushed logs add to (+1) or take from (-1) their weeks
+DELTA_KEY = 'work_week_summary_deltas'
+# Session.info coverage bit and eligibility of the pumps the flush deletes
+DELETED_PUMPS_KEY = 'work_week_summary_deleted_pumps'
+
+_summary_table = None
+_log_table = None
+_equipment_table = None
+_log_model = None
+_equipment_model = None
+_current_work_week = None
+
+def _placeholder_row(work_week, eligible_pumps, now):
+    """Summary row of a week before its logs are counted"""
+    return {
+        'work_week': work_week,
+        'week_key': week_key(work_week),
+        'eligible_pumps': eligible_pumps,
+        'pumps_checked': 0,
+        'log_count': 0,
+        'oil_add_count': 0,
+        'drain_replace_count': 0,
+        'high_temp_count': 0,
+        'temp_count': 0,
+        'temp_sum': None,
+        'coverage': None,
+        'updated_at': now
+    }
+
+def rebuild_week_summaries(connection, work_weeks=None):
+    """Recompute the summaries of the given work weeks, or of every week
+
+    Takes five statements whatever the number of weeks: the current
+    eligible count, the log aggregate, the pumps checked each week, the
+    stored eligible counts, and the upsert. Weeks left without logs are
+    deleted with one more. On PostgreSQL the given weeks' rows are locked
+    first, see upserts.
+    """
+    log = _log_table
+    summary = _summary_table
+    now = datetime.utcnow()
+    eligible_now = connection.execute(
+        select(func.count()).select_from(_equipment_table).where(weekly_log_filter(_equipment_model))
+    ).scalar()
+
+    if work_weeks is None:
+        week_filter = []
+        stored_filter = []
+    else:
+        # Logs and summaries are read through their indexed week_key
+        keys = sorted({week_key(work_week) for work_week in work_weeks} - {None})
+        week_filter = [log.c.week_key.in_(keys)]
+        stored_filter = [summary.c.week_key.in_(keys)]
+        lock_keys(connection, summary, 'work_week', [week_label(key) for key in keys],
+                  lambda work_week: _placeholder_row(work_week, eligible_now, now))
+
+    # Only pumps the weekly log lists count as checked, so a week's rate
+    # never counts pumps the eligibility rules leave out
+    equipment = _equipment_table
+    counted = case((equipment.c.is_eligible == true(), log.c.equipment_id))
+    totals = connection.execute(
+        select(
+            log.c.week_key,
+            func.count(func.distinct(counted)),
+            func.count(log.c.log_id),
+            func.sum(case((name_in(_log_model, 'service', [ADD_OIL]), 1), else_=0)),
+            func.sum(case((name_in(_log_model, 'service', [DRAIN_REPLACE]), 1), else_=0)),
+            func.sum(case((log.c.pump_temp >= HIGH_TEMP_LIMIT, 1), else_=0)),
+            func.count(log.c.pump_temp),
+            func.sum(log.c.pump_temp)
+        ).select_from(log.join(equipment, equipment.c.equipment_id == log.c.equipment_id))
+        .where(log.c.week_key.isnot(None), *week_filter).group_by(log.c.week_key)
+    ).all()
+
+    checked = {}
+    for key, coverage_bit in connection.execute(
+        select(log.c.week_key, equipment.c.coverage_bit).distinct()
+        .select_from(log.join(equipment, equipment.c.equipment_id == log.c.equipment_id))
+        .where(log.c.week_key.isnot(None), equipment.c.coverage_bit.isnot(None), *week_filter)
+    ):
+        checked.setdefault(key, []).append(coverage_bit)
+
+    stored_eligible = dict(connection.execute(
+        select(summary.c.week_key, summary.c.eligible_pumps).where(*stored_filter)
+    ).all())
+    current_key = week_key(_current_work_week())
+
+    rows = []
+    for key, pumps_checked, log_count, oil_adds, drains, high_temps, temp_count, temp_sum in totals:
+        eligible = stored_eligible.get(key)
+        if eligible is None or key == current_key:
+            eligible = eligible_now
+        rows.append({
+            'work_week': week_label(key),
+            'week_key': key,
+            'eligible_pumps': eligible,
+            'pumps_checked': pumps_checked,
+            'log_count': log_count,
+            'oil_add_count': int(oil_adds or 0),
+            'drain_replace_count': int(drains or 0),
+            'high_temp_count': int(high_temps or 0),
+            'temp_count': temp_count,
+            'temp_sum': float(temp_sum) if temp_sum is not None else None,
+            'coverage': bitmap_bytes(to_bitmap(checked.get(key, ()))),
+            'updated_at': now
+        })
+    upsert_rows(connection, summary, rows, 'work_week')
+
+    # Only weeks without logs left lose their row
+    summarized = [row['work_week'] for row in rows]
+    if work_weeks is None:
+        connection.execute(summary.delete().where(summary.c.work_week.notin_(summarized)))
+    else:
+        emptied = sorted({week_label(key) for key in keys} - set(summarized))
+        if emptied:
+            connection.execute(summary.delete().where(summary.c.work_week.in_(emptied)))
+    return len(rows)
+
+def _log_entry(work_week, equipment_id, service, pump_temp):
+    """What one log counts for in its week: (week key, pump, oil add, drain, temperature)"""
+    key = week_key(work_week)
+    if key is None:
+        return None
+    service_key = name_key(service)
+    return (key, equipment_id, service_key == name_key(ADD_OIL),
+            service_key == name_key(DRAIN_REPLACE), pump_temp)
+
+def _previous_value(obj, field):
+    history = obj._sa_instance_state.attrs[field].history
+    return history.deleted[0] if history.deleted else getattr(obj, field)
+
+def apply_log_deltas(connection, deltas, deleted_pumps=None):
+    """Add flushed logs to their weeks' summaries and take back their old values
+
+    deltas holds (sign, entry) pairs from _log_entry. A pump's coverage bit
+    is set by its first log of a week and cleared once the pump has no log
+    left there. Takes three statements whatever the number of logs, plus
+    one when a pump may have left a week and one to delete weeks left
+    without logs. Weeks without a row yet cannot be updated and are
+    returned for recomputing.
+    """
+    summary = _summary_table
+    log = _log_table
+    keys = sorted({entry[0] for _, entry in deltas})
+    lock_keys(connection, summary, 'work_week', [week_label(key) for key in keys])
+    stored = {row['week_key']: dict(row) for row in connection.execute(
+        select(summary).where(summary.c.week_key.in_(keys))
+    ).mappings()}
+
+    pump_ids = sorted({entry[1] for _, entry in deltas})
+    pumps = dict(deleted_pumps or {})
+    for equipment_id, coverage_bit, is_eligible in connection.execute(
+        select(_equipment_table.c.equipment_id, _equipment_table.c.coverage_bit, _equipment_table.c.is_eligible)
+        .where(_equipment_table.c.equipment_id.in_(pump_ids))
+    ):
+        pumps[equipment_id] = (coverage_bit, is_eligible)
+
+    # A pump taken out of a week is only unchecked when none of its logs remain
+    added = {(entry[0], entry[1]) for sign, entry in deltas if sign > 0}
+    removed = {(entry[0], entry[1]) for sign, entry in deltas if sign < 0} - added
+    remaining = set()
+    if removed:
+        remaining = set(connection.execute(
+            select(log.c.week_key, log.c.equipment_id).distinct().where(
+                log.c.week_key.in_({key for key, _ in removed}),
+                log.c.equipment_id.in_({equipment_id for _, equipment_id in removed})
+            )
+        ).all())
+
+    now = datetime.utcnow()
+    changed = set()
+    unsummarized = set()
+    for sign, (key, equipment_id, oil_add, drain, pump_temp) in deltas:
+        row = stored.get(key)
+        coverage_bit, is_eligible = pumps.get(equipment_id, (None, False))
+        if row is None or row['coverage'] is None or coverage_bit is None:
+            unsummarized.add(key)
+            continue
+        row['log_count'] += sign
+        row['oil_add_count'] += sign if oil_add else 0
+        row['drain_replace_count'] += sign if drain else 0
+        if pump_temp is not None:
+            row['high_temp_count'] += sign if pump_temp >= HIGH_TEMP_LIMIT else 0
+            row['temp_count'] += sign
+            row['temp_sum'] = (row['temp_sum'] or 0) + sign * pump_temp if row['temp_count'] else None
+        coverage = bitmap_from_bytes(row['coverage'])
+        bit = 1 << coverage_bit
+        if (key, equipment_id) in added and not coverage & bit:
+            coverage |= bit
+            row['pumps_checked'] += 1 if is_eligible else 0
+        elif (key, equipment_id) in removed and (key, equipment_id) not in remaining and coverage & bit:
+            coverage &= ~bit
+            row['pumps_checked'] -= 1 if is_eligible else 0
+        row['coverage'] = bitmap_bytes(coverage)
+        row['updated_at'] = now
+        changed.add(key)
+
+    changed = [stored[key] for key in sorted(changed - unsummarized)]
+    upsert_rows(connection, summary, [row for row in changed if row['log_count'] > 0], 'work_week')
+    emptied = [row['work_week'] for row in changed if row['log_count'] <= 0]
+    if emptied:
+        connection.execute(summary.delete().where(summary.c.work_week.in_(emptied)))
+    return {week_label(key) for key in unsummarized}
+
+def mark_weeks_changed(session, work_weeks):
+    """Recompute these weeks' summaries now, for logs written without a flush
+
+    bulk_insert_mappings and bulk_update_mappings skip the flush events, so
+    code using them must call this itself.
+    """
+    work_weeks = {work_week for work_week in work_weeks if work_week}
+    if work_weeks:
+        rebuild_week_summaries(session.connection(), work_weeks)
+
+def _is_eligibility_change(obj):
+    state = obj._sa_instance_state
+    return any(state.attrs[field].history.has_changes() for field in ('oil_type_id', 'equipment_name', 'is_eligible'))
+
+def setup_work_week_summary(app, db, summary_model, log_model, equipment_model, calendar_model, current_work_week):
+    """Keep work_week_summary current and register the compliance trend routes
+
+    current_work_week is a callable returning this week's work_week label.
+    """
+    global _summary_table, _log_table, _equipment_table, _log_model, _equipment_model, _current_work_week
+    _summary_table = summary_model.__table__
+    _log_table = log_model.__table__
+    _equipment_table = equipment_model.__table__
+    _log_model = log_model
+    _equipment_model = equipment_model
+    _current_work_week = current_work_week
+
+    @event.listens_for(Session, "before_flush")
+    def collect_changed_weeks(session, flush_context, instances):
+        if session.info.get(REBUILD_FLAG):
+            # Rebuilt at commit anyway
+            return
+        weeks = set()
+        deltas = []
+        deleted_pumps = {}
+        for obj in session.new:
+            if isinstance(obj, _log_model):
+                deltas.append((1, _log_entry(obj.work_week, obj.equipment_id, obj.service, obj.pump_temp)))
+            elif isinstance(obj, _equipment_model):
+                weeks.add(_current_work_week())
+        for obj in session.deleted:
+            if isinstance(obj, _log_model):
+                deltas.append((-1, _log_entry(
+                    _previous_value(obj, 'work_week'), _previous_value(obj, 'equipment_id'),
+                    previous_name(obj, 'service'), _previous_value(obj, 'pump_temp')
+                )))
+            elif isinstance(obj, _equipment_model):
+                # Its logs are deleted along with it and listed above
+                deleted_pumps[obj.equipment_id] = (obj.coverage_bit, obj.is_eligible)
+                weeks.add(_current_work_week())
+        for obj in session.dirty:
+            if isinstance(obj, _log_model) and session.is_modified(obj, include_collections=False):
+                old = _log_entry(
+                    _previous_value(obj, 'work_week'), _previous_value(obj, 'equipment_id'),
+                    previous_name(obj, 'service'), _previous_value(obj, 'pump_temp')
+                )
+                new = _log_entry(obj.work_week, obj.equipment_id, obj.service, obj.pump_temp)
+                if old != new:
+                    deltas.extend([(-1, old), (1, new)])
+            elif isinstance(obj, _equipment_model) and _is_eligibility_change(obj):
+                weeks.add(_current_work_week())
+        weeks.discard(None)
+        deltas = [(sign, entry) for sign, entry in deltas if entry is not None]
+        if weeks:
+            session.info.setdefault(PENDING_KEY, set()).update(weeks)
+        if deltas:
+            session.info.setdefault(DELTA_KEY, []).extend(deltas)
+            session.info.setdefault(DELETED_PUMPS_KEY, {}).update(deleted_pumps)
+
+    @event.listens_for(Session, "after_flush")
+    def update_flushed_weeks(session, flush_context):
+        pending = session.info.pop(PENDING_KEY, None) or set()
+        deltas = session.info.pop(DELTA_KEY, None)
+        deleted_pumps = session.info.pop(DELETED_PUMPS_KEY, None)
+        if deltas:
+            # Weeks recomputed anyway already count these logs
+            pending_keys = {week_key(work_week) for work_week in pending}
+            deltas = [(sign, entry) for sign, entry in deltas if entry[0] not in pending_keys]
+        if deltas:
+            pending |= apply_log_deltas(session.connection(), deltas, deleted_pumps)
+        if pending:
+            rebuild_week_summaries(session.connection(), pending)
+
+    @event.listens_for(Session, "do_orm_execute")
+    def flag_bulk_log_changes(orm_execute_state):
+        # Query.delete() and Query.update() do not say which logs changed
+        if orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = getattr(orm_execute_state.statement, 'table', None)
+            if table is not None and table.name in (_log_table.name, _equipment_table.name):
+                orm_execute_state.session.info[REBUILD_FLAG] = True
+
+    @event.listens_for(Session, "before_commit")
+    def rebuild_after_bulk_changes(session):
+        if session.info.get(REBUILD_FLAG):
+            session.flush()
+            session.info.pop(REBUILD_FLAG, None)
+            rebuild_week_summaries(session.connection())
+
+    @event.listens_for(Session, "after_rollback")
+    def clear_pending(session):
+        session.info.pop(REBUILD_FLAG, None)
+        session.info.pop(PENDING_KEY, None)
+        session.info.pop(DELTA_KEY, None)
+        session.info.pop(DELETED_PUMPS_KEY, None)
+
+    @app.route('/api/compliance-trend')
+    def compliance_trend():
+        """Weekly compliance, oil services and temperatures, oldest week first
+
+        Query parameters: weeks (the most recent N summarized weeks, default
+        DEFAULT_TREND_WEEKS), or from and to as work weeks like 2025-WW07.
+        """
+        start = request.args.get('from')
+        end = request.args.get('to')
+        for name, value in (('from', start), ('to', end)):
+            if value is not None and week_key(value) is None:
+                return jsonify({"error": f"{name} must look like 2025-WW07"}), 400
+        try:
+            weeks = int(request.args.get('weeks', DEFAULT_TREND_WEEKS))
+        except ValueError:
+            return jsonify({"error": "weeks must be a whole number"}), 400
+        if weeks < 1:
+            return jsonify({"error": "weeks must be at least 1"}), 400
+
+        def build_payload():
+            query = db.session.query(summary_model, calendar_model).outerjoin(
+                calendar_model, calendar_model.week_key == summary_model.week_key
+            )
+            if start:
+                query = query.filter(summary_model.week_key >= week_key(start))
+            if end:
+                query = query.filter(summary_model.week_key <= week_key(end))
+            rows = query.order_by(summary_model.week_key.desc()).limit(weeks).all()
+            rows.reverse()
+            return {'weeks': [
+                dict(
+                    summary.to_dict(),
+                    week_start=calendar.week_start.isoformat() if calendar else None,
+                    fiscal_year=calendar.fiscal_year if calendar else None,
+                    fiscal_period=calendar.fiscal_period if calendar else None
+                )
+                for summary, calendar in rows
+            ]}
+
+        try:
+            key = f"compliance-trend|{start}|{end}|{weeks}"
+            return conditional_json(db.session, key, build_payload)
+        except Exception as e:
+            logger.error(f"Error loading compliance trend: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/admin/work-week-summary/rebuild', methods=['POST'])
+    @app.admin_required
+    def rebuild_work_week_summary():
+        """Recompute every work week's summary from the logs"""
+        try:
+            with db.engine.begin() as connection:
+                count = rebuild_week_summaries(connection)
+            return jsonify({
+                "status": "success",
+                "message": f"Summarized {count} work weeks",
+                "timestamp": datetime.now().isoformat()
+            })
+        except Exception as e:
+            logger.error(f"Error rebuilding work week summaries: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    return _summary_table
+
+def backfill_week_summaries(engine):
+    """Summarize every work week when work_week_summary is still empty but logs exist
+
+    Also runs when rows are missing their coverage bitmap, as rows written
+    before the coverage column existed are. Safe to run on every start and
+    from several workers at once.
+    """
+    try:
+        with engine.begin() as connection:
+            has_rows = connection.execute(select(_summary_table.c.work_week).limit(1)).first()
+            missing_coverage = connection.execute(
+                select(_summary_table.c.work_week).where(_summary_table.c.coverage.is_(None)).limit(1)
+            ).first()
+            has_logs = connection.execute(select(_log_table.c.log_id).limit(1)).first()
+            if (has_rows and not missing_coverage) or not has_logs:
+                return 0
+            count = rebuild_week_summaries(connection)
+        logger.info(f"Summarized {count} work weeks")
+        return count
+    except Exception as e:
+        # Usually another worker filled the table first
+        logger.warning(f"Work week summary backfill skipped: {e}")
+        return 0
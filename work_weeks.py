@@ -0,0 +1,206 @@
+"""
+Integer ISO week keys and the calendar_week dimension
+
+Work weeks are labelled like "2025-WW07" for people, and keyed as the
+integer iso_year * 100 + week (202507) for queries: keys sort and compare
+as numbers, so week ranges are plain indexed range scans on
+maintenance_log.week_key. The label and key always use the ISO year, so the
+days around New Year belong to the same week whichever year they fall in.
+
+calendar_week holds one row per week with its label, first and last day
+and fiscal year, quarter and period. A week belongs to the fiscal period of
+the month its Thursday falls in, the same rule ISO uses for years.
+FISCAL_YEAR_START_MONTH sets the first month of the fiscal year; fiscal
+years are named after the calendar year they end in.
+
+Logs written before week keys existed, and by early versions that took the
+year of a late-December or early-January check from the calendar instead
+of the ISO year, are fixed by backfill_week_keys on start.
+"""
+import os
+import re
+import logging
+from datetime import date, datetime, timedelta
+from flask import request, jsonify
+from sqlalchemy import select, func, cast, bindparam, Integer
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+WORK_WEEK_PATTERN = re.compile(r'^\d{4}-WW\d{2}$')
+
+# Weeks past today kept in calendar_week, so upcoming weeks can be planned
+CALENDAR_WEEKS_AHEAD = 53
+
+_calendar_table = None
+_fiscal_start_month = 1
+
+def iso_week_key(date_obj):
+    """Week key of the ISO week a date falls in"""
+    iso_year, week, _ = date_obj.isocalendar()
+    return iso_year * 100 + week
+
+def week_key(label):
+    """Week key of a label like 2025-WW07, or None when it is not a real ISO week"""
+    if not isinstance(label, str) or not WORK_WEEK_PATTERN.match(label):
+        return None
+    iso_year, week = int(label[:4]), int(label[7:])
+    try:
+        date.fromisocalendar(iso_year, week, 1)
+    except ValueError:
+        return None
+    return iso_year * 100 + week
+
+def week_label(key):
+    return f"{key // 100}-WW{key % 100:02d}"
+
+def week_start(key):
+    """Monday of a week"""
+    return date.fromisocalendar(key // 100, key % 100, 1)
+
+def shift_week(key, weeks):
+    """Key of the week a number of weeks before (negative) or after a week"""
+    return iso_week_key(week_start(key) + timedelta(weeks=weeks))
+
+def label_key_expression(label_column):
+    """SQL computing the week key of a work_week label column"""
+    return (cast(func.substr(label_column, 1, 4), Integer) * 100
+            + cast(func.substr(label_column, 8, 2), Integer))
+
+def fiscal_period(week_monday, start_month=1):
+    """(fiscal year, quarter, period) of the week starting on a Monday"""
+    thursday = week_monday + timedelta(days=3)
+    period = (thursday.month - start_month) % 12 + 1
+    fiscal_year = thursday.year + (1 if start_month > 1 and thursday.month >= start_month else 0)
+    return fiscal_year, (period - 1) // 3 + 1, period
+
+def calendar_row(key, start_month=1):
+    monday = week_start(key)
+    fiscal_year, fiscal_quarter, period = fiscal_period(monday, start_month)
+    return {
+        'week_key': key,
+        'iso_year': key // 100,
+        'iso_week': key % 100,
+        'label': week_label(key),
+        'week_start': monday,
+        'week_end': monday + timedelta(days=6),
+        'fiscal_year': fiscal_year,
+        'fiscal_quarter': fiscal_quarter,
+        'fiscal_period': period
+    }
+
+def ensure_calendar_weeks(connection, first_key, last_key, start_month=None):
+    """Add the calendar_week rows missing between two week keys, returning how many"""
+    start_month = _fiscal_start_month if start_month is None else start_month
+    table = _calendar_table
+    existing = set(connection.execute(
+        select(table.c.week_key).where(table.c.week_key.between(first_key, last_key))
+    ).scalars())
+
+    rows = []
+    monday = week_start(first_key)
+    last_monday = week_start(last_key)
+    while monday <= last_monday:
+        key = iso_week_key(monday)
+        if key not in existing:
+            rows.append(calendar_row(key, start_month))
+        monday += timedelta(weeks=1)
+    if rows:
+        connection.execute(table.insert(), rows)
+    return len(rows)
+
+def relabel_boundary_weeks(connection, log_table):
+    """Fix logs labelled with the calendar year instead of the ISO year
+
+    Only weeks 1, 52 and 53 can be affected. A log is relabelled when its
+    check date falls in the labelled week number of a different ISO year,
+    in the calendar year of the label, which is what the old labels did.
+    Relabelled logs lose their change sequence so they are numbered again
+    and reach /api/changes clients.
+    """
+    candidates = connection.execute(
+        select(log_table.c.log_id, log_table.c.work_week, log_table.c.check_date).where(
+            func.substr(log_table.c.work_week, 6, 4).in_(['WW01', 'WW52', 'WW53'])
+        )
+    ).all()
+
+    changes = []
+    for log_id, label, check_date in candidates:
+        if check_date is None or not WORK_WEEK_PATTERN.match(label or ''):
+            continue
+        if isinstance(check_date, str):
+            check_date = date.fromisoformat(check_date[:10])
+        iso_year, week, _ = check_date.isocalendar()
+        label_year, label_week = int(label[:4]), int(label[7:])
+        if week == label_week and iso_year != label_year and check_date.year == label_year:
+            key = iso_year * 100 + week
+            changes.append({'target_id': log_id, 'new_label': week_label(key), 'new_key': key})
+
+    if changes:
+        connection.execute(
+            log_table.update().where(log_table.c.log_id == bindparam('target_id'))
+            .values(work_week=bindparam('new_label'), week_key=bindparam('new_key'), change_seq=None),
+            changes
+        )
+    return len(changes)
+
+def backfill_week_keys(engine, log_table, other_tables=(), today=None):
+    """Give logs their week key, fix boundary labels and fill calendar_week
+
+    other_tables are further tables with work_week and week_key columns
+    whose missing keys are filled in. Returns the number of relabelled logs,
+    so callers can rebuild anything grouped by work week. Safe to run on
+    every start.
+    """
+    today = today or datetime.now().date()
+    with engine.begin() as connection:
+        relabelled = relabel_boundary_weeks(connection, log_table)
+        for table in (log_table,) + tuple(other_tables):
+            result = connection.execute(
+                table.update()
+                .where(table.c.week_key.is_(None), table.c.work_week.isnot(None))
+                .values(week_key=label_key_expression(table.c.work_week))
+            )
+            if result.rowcount:
+                logger.info(f"Assigned week keys to {result.rowcount} {table.name} rows")
+        if relabelled:
+            logger.info(f"Relabelled {relabelled} maintenance logs with their ISO year")
+
+        first_date = connection.execute(select(func.min(log_table.c.check_date))).scalar()
+        if isinstance(first_date, str):
+            first_date = date.fromisoformat(first_date[:10])
+        last_key = iso_week_key(today + timedelta(weeks=CALENDAR_WEEKS_AHEAD))
+        added = ensure_calendar_weeks(connection, iso_week_key(min(first_date or today, today)), last_key)
+        if added:
+            logger.info(f"Added {added} weeks to calendar_week")
+    return relabelled
+
+def setup_work_weeks(app, db, calendar_model):
+    """Read the fiscal calendar settings and register /api/calendar-weeks"""
+    global _calendar_table, _fiscal_start_month
+    _calendar_table = calendar_model.__table__
+
+    app.config.setdefault('FISCAL_YEAR_START_MONTH', int(os.environ.get('FISCAL_YEAR_START_MONTH', '1')))
+    _fiscal_start_month = app.config['FISCAL_YEAR_START_MONTH']
+    if not 1 <= _fiscal_start_month <= 12:
+        raise ValueError("FISCAL_YEAR_START_MONTH must be between 1 and 12")
+
+    @app.route('/api/calendar-weeks')
+    def calendar_weeks():
+        """Calendar weeks between from and to (work weeks like 2025-WW07), default the last 13"""
+        current = iso_week_key(datetime.now().date())
+        first = week_key(request.args['from']) if 'from' in request.args else shift_week(current, -12)
+        last = week_key(request.args['to']) if 'to' in request.args else current
+        if first is None or last is None:
+            return jsonify({"error": "from and to must be work weeks like 2025-WW07"}), 400
+
+        try:
+            rows = calendar_model.query.filter(
+                calendar_model.week_key.between(first, last)
+            ).order_by(calendar_model.week_key).all()
+            return jsonify({'weeks': [row.to_dict() for row in rows]})
+        except Exception as e:
+            logger.error(f"Error loading calendar weeks: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    return _calendar_table